@@ -0,0 +1,297 @@
+"""Load-test harness for the deployed stack: gunicorn (optionally behind local nginx) + asyncio load generator"""
+
+import os
+import io
+import sys
+import time
+import random
+import shutil
+import socket
+import asyncio
+import tempfile
+import subprocess
+
+import servicectl
+
+HERE = servicectl.HERE
+
+NGINX_CONF = """
+daemon off;
+worker_processes auto;
+pid {prefix}/nginx.pid;
+error_log {prefix}/error.log;
+
+events {{
+  worker_connections 4096;
+}}
+
+http {{
+  include /etc/nginx/mime.types;
+  default_type application/octet-stream;
+  access_log off;
+  log_format combined_plus '$remote_addr - $remote_user [$time_local]'
+                           ' "$request" $status $body_bytes_sent "$http_referer"'
+                           ' "$http_user_agent" $request_time $upstream_cache_status'
+                           ' [$upstream_response_time]';
+  client_body_temp_path {prefix}/client_body;
+  proxy_temp_path {prefix}/proxy;
+  fastcgi_temp_path {prefix}/fastcgi;
+  uwsgi_temp_path {prefix}/uwsgi;
+  scgi_temp_path {prefix}/scgi;
+  proxy_cache_path {prefix}/cache levels=1:2 keys_zone=MYAPP:10m inactive=60m;
+  proxy_cache_key "$scheme$request_method$host$request_uri";
+  include {prefix}/site.conf;
+}}
+"""
+
+
+def parse_urls(urls):
+    """Parse `path[:weight]` items into (paths, weights)"""
+    paths, weights = [], []
+    for url in urls:
+        path, sep, weight = url.rpartition(':')
+        if not sep or not weight.isdigit():
+            path, weight = url, '1'
+        paths.append(path)
+        weights.append(int(weight))
+    return paths, weights
+
+
+def free_tcp_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_socket(socket_path, deadline):
+    delay = 0.05
+    while time.monotonic() < deadline:
+        if os.path.exists(socket_path) and servicectl.probe_http(socket_path, '/health/', 1.0):
+            return True
+        time.sleep(delay)
+        delay = min(delay * 2, 0.5)
+    return False
+
+
+def wait_for_port(port, deadline):
+    delay = 0.05
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1.0):
+                return True
+        except OSError:
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+    return False
+
+
+def start_gunicorn(settings, socket_path, logfile):
+    gunicorn_cmd = os.path.join(os.path.dirname(settings['PYTHON_CMD']), 'gunicorn')
+    if not os.path.exists(gunicorn_cmd):
+        gunicorn_cmd = shutil.which('gunicorn') or gunicorn_cmd
+    env = dict(os.environ)
+    env.update({k: str(v) for k, v in (settings.get('env') or {}).items()})
+    env.update({k: str(v) for k, v in servicectl.gunicorn_environment(settings.get('gunicorn') or {}).items()})
+    env['METRICS_DIR'] = os.path.join(os.path.dirname(socket_path), 'metrics')
+    command = [
+        gunicorn_cmd, '{}:application'.format(settings['WSGI_MODULE']),
+        '--bind', 'unix:{}'.format(socket_path),
+        '--config', os.path.join(HERE, 'services', 'gunicorn_config.py'),
+    ]
+    return subprocess.Popen(command, cwd=HERE, env=env, stdout=logfile, stderr=subprocess.STDOUT)
+
+
+def start_nginx(config, prefix, socket_path, port, logfile):
+    settings, error = servicectl.load_settings('nginxsite', config)
+    if error is not None:
+        raise Exception(error)
+    settings['listen'] = '127.0.0.1:{}'.format(port)
+    settings['tls'] = None  # load goes over plain HTTP, certs are not installed under prefix
+    settings['upstream'] = dict(settings.get('upstream') or {}, servers=[socket_path])
+    settings['nginx_log_dir'] = prefix
+    settings['project_root'] = os.path.join(HERE, 'djangosite', 'project_static')  # of `make build`, not deployed release
+    includesdir = os.path.join(prefix, 'includes', config)
+    os.makedirs(includesdir)
+    for filename in settings.get('includes', []) or []:
+        with io.open(os.path.join(includesdir, filename), 'w', encoding='utf-8') as ostream:
+            ostream.write(servicectl.render_template(os.path.join('nginxsite', 'includes', filename), settings))
+    with io.open(os.path.join(prefix, 'site.conf'), 'w', encoding='utf-8') as ostream:
+        ostream.write(servicectl.render_template(os.path.join('nginxsite', '{}.conf'.format(config)), settings))
+    with io.open(os.path.join(prefix, 'nginx.conf'), 'w', encoding='utf-8') as ostream:
+        ostream.write(NGINX_CONF.format(prefix=prefix))
+    command = [shutil.which('nginx') or 'nginx', '-p', prefix, '-c', os.path.join(prefix, 'nginx.conf')]
+    return subprocess.Popen(command, stdout=logfile, stderr=subprocess.STDOUT)
+
+
+class ServerClosed(ConnectionError):
+    """Server closed connection before sending response"""
+
+
+async def read_response(reader):
+    """Read one HTTP/1.1 response, return (status, keep_alive)"""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ServerClosed('Connection closed by server')
+    version, status = status_line.split()[:2]
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, __, value = line.partition(b':')
+        headers[name.strip().lower()] = value.strip()
+    keep_alive = version == b'HTTP/1.1' and headers.get(b'connection', b'').lower() != b'close'
+    if b'content-length' in headers:
+        await reader.readexactly(int(headers[b'content-length']))
+    elif headers.get(b'transfer-encoding', b'').lower() == b'chunked':
+        while True:
+            size = int((await reader.readline()).split(b';')[0], 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.read()
+        keep_alive = False
+    return int(status), keep_alive
+
+
+async def run_load(connect, host, paths, weights, concurrency, duration, warmup, timeout):
+    latencies = []
+    statuses = {}
+    errors = {}
+    started = time.monotonic()
+    measure_from = started + warmup
+    stop_at = measure_from + duration
+
+    def record_error(kind):
+        if time.monotonic() >= measure_from:
+            errors[kind] = errors.get(kind, 0) + 1
+
+    async def client():
+        reader = writer = None
+        reused = False
+        while time.monotonic() < stop_at:
+            path = random.choices(paths, weights)[0]
+            request = 'GET {} HTTP/1.1\r\nHost: {}\r\nUser-Agent: service.py-bench\r\n\r\n'.format(path, host).encode('ascii')
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.wait_for(connect(), timeout)
+                    reused = False
+                sent = time.monotonic()
+                writer.write(request)
+                status, keep_alive = await asyncio.wait_for(read_response(reader), timeout)
+                received = time.monotonic()
+                if sent >= measure_from:
+                    latencies.append(received - sent)
+                    statuses[status] = statuses.get(status, 0) + 1
+                if not keep_alive:
+                    writer.close()
+                    reader = writer = None
+                reused = True
+            except asyncio.TimeoutError:
+                record_error('timeout')
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError) as e:
+                # idle keep-alive connection closed by server is retried like HTTP clients do
+                if not (reused and isinstance(e, (ServerClosed, ConnectionResetError, BrokenPipeError))):
+                    record_error('connection')
+            else:
+                continue
+            if writer is not None:
+                writer.close()
+            reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    await asyncio.gather(*[client() for __ in range(concurrency)])
+    return latencies, statuses, errors
+
+
+def percentile(ordered, fraction):
+    if not ordered:
+        return None
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(latencies, statuses, errors, duration):
+    ordered = sorted(latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+
+    requests = len(ordered)
+    failed = sum(count for status, count in statuses.items() if status >= 500)
+    return {
+        'requests': requests,
+        'rps': round(requests / duration, 1) if duration else None,
+        'latency_ms': {
+            'mean': ms(sum(ordered) / requests) if requests else None,
+            'p50': ms(percentile(ordered, 0.50)),
+            'p95': ms(percentile(ordered, 0.95)),
+            'p99': ms(percentile(ordered, 0.99)),
+            'max': ms(ordered[-1]) if ordered else None,
+        },
+        'status': {str(status): count for status, count in sorted(statuses.items())},
+        'errors': dict(errors, http_5xx=failed),
+    }
+
+
+def git_commit():
+    job = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+    return job.stdout.strip() or None
+
+
+def bench(config, urls, concurrency, duration, warmup, timeout, with_nginx, boot_deadline=60.0):
+    """Boot webapp for config on temporary socket, drive load through it and return report"""
+    settings, error = servicectl.load_settings('webapp', config)
+    if error is not None:
+        return None, error
+    paths, weights = parse_urls(urls)
+    processes = []
+    with tempfile.TemporaryDirectory(prefix='bench-') as tempdir:
+        socket_path = os.path.join(tempdir, 'webapp.socket')
+        logpath = os.path.join(tempdir, 'bench.log')
+        try:
+            with io.open(logpath, 'wb') as logfile:
+                deadline = time.monotonic() + boot_deadline
+                processes.append(start_gunicorn(settings, socket_path, logfile))
+                if not wait_for_socket(socket_path, deadline):
+                    raise Exception('gunicorn did not become ready')
+                if with_nginx:
+                    port = free_tcp_port()
+                    processes.append(start_nginx(config, tempdir, socket_path, port, logfile))
+                    if not wait_for_port(port, deadline):
+                        raise Exception('nginx did not become ready')
+
+                    def connect():
+                        return asyncio.open_connection('127.0.0.1', port)
+                    host = 'example.com'
+                else:
+                    def connect():
+                        return asyncio.open_unix_connection(socket_path)
+                    host = '127.0.0.1'
+                latencies, statuses, errors = asyncio.run(
+                    run_load(connect, host, paths, weights, concurrency, duration, warmup, timeout))
+        except Exception as e:
+            with io.open(logpath, encoding='utf-8', errors='replace') as istream:
+                print(istream.read()[-4000:], file=sys.stderr)
+            return None, 'Benchmark failed: {}'.format(e)
+        finally:
+            for process in reversed(processes):
+                process.terminate()
+            for process in reversed(processes):
+                try:
+                    process.wait(10)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+    report = {
+        'config': config,
+        'commit': git_commit(),
+        'target': 'nginx' if with_nginx else 'gunicorn',
+        'gunicorn': settings.get('gunicorn') or {},
+        'concurrency': concurrency,
+        'duration': duration,
+        'urls': dict(zip(paths, weights)),
+    }
+    report.update(summarize(latencies, statuses, errors, duration))
+    return report, None
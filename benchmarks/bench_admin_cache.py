@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""DB queries and latency of admin pages without and with cache layer (cached sessions and template loader)"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PAGES = ['/admin/', '/admin/auth/user/', '/admin/auth/group/']
+ROUNDS = 50
+
+SCENARIOS = [
+    ('without cache', {'SESSION_BACKEND': 'db', 'TEMPLATE_CACHE': '0', 'CACHE_BACKEND': 'locmem'}),
+    ('with cache', {'SESSION_BACKEND': 'cached_db', 'TEMPLATE_CACHE': '1', 'CACHE_BACKEND': 'file'}),
+]
+
+
+def measure():
+    import django
+    django.setup()
+    from django.core.management import call_command
+    from django.contrib.auth import get_user_model
+    from django.db import connection
+    from django.test import Client
+    from django.test.utils import CaptureQueriesContext
+
+    call_command('migrate', verbosity=0)
+    user = get_user_model().objects.create_superuser('admin', 'admin@example.com', 'admin')
+    client = Client(HTTP_HOST='127.0.0.1')
+    client.force_login(user)
+    results = {}
+    for page in PAGES:
+        assert client.get(page).status_code == 200, page  # first request loads templates
+        latencies = []
+        queries = 0
+        for __ in range(ROUNDS):
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                client.get(page)
+                latencies.append(time.perf_counter() - started)
+            queries += len(context.captured_queries)
+        latencies.sort()
+        results[page] = {
+            'queries': queries / ROUNDS,
+            'p50_ms': latencies[len(latencies) // 2] * 1000.0,
+            'mean_ms': sum(latencies) / len(latencies) * 1000.0,
+        }
+    print(json.dumps(results))
+
+
+def main():
+    reports = []
+    for name, env in SCENARIOS:
+        with tempfile.TemporaryDirectory(prefix='bench-admin-') as tempdir:
+            child_env = dict(os.environ, DJANGO_SETTINGS_MODULE='djangosite.mysite.settings',
+                             DATABASE_NAME=os.path.join(tempdir, 'db.sqlite3'), CACHE_LOCATION=os.path.join(tempdir, 'cache'), **env)
+            job = subprocess.run([sys.executable, os.path.abspath(__file__), '--measure'], cwd=HERE,
+                                 env=child_env, check=True, stdout=subprocess.PIPE)
+        reports.append((name, json.loads(job.stdout.decode('utf-8').splitlines()[-1])))
+
+    print('{:<22} {:<16} {:>10} {:>10} {:>10}'.format('page', 'scenario', 'queries', 'p50 [ms]', 'mean [ms]'))
+    for page in PAGES:
+        for name, results in reports:
+            result = results[page]
+            print('{:<22} {:<16} {:>10.1f} {:>10.2f} {:>10.2f}'.format(page, name, result['queries'], result['p50_ms'], result['mean_ms']))
+
+
+if __name__ == '__main__':
+    if '--measure' in sys.argv:
+        sys.path.insert(0, HERE)
+        measure()
+    else:
+        main()
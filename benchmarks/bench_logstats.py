@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+"""Parsing throughput of `service.py logstats` on synthetic nginx `combined_plus` log"""
+
+import os
+import sys
+import random
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import logstats  # noqa: E402
+
+LINES = 2000000
+ROUTES = ['/', '/health/', '/admin/', '/admin/auth/user/{}/change/', '/static/app.css', '/api/items/{}/?page=2']
+LINE = '10.0.0.{} - - [18/Oct/2026:01:00:00 +0000] "GET {} HTTP/1.1" {} 512 "-" "Mozilla/5.0 (X11; Linux x86_64)" {:.3f} {} [{:.3f}]\n'
+
+
+def write_log(path):
+    rng = random.Random(0)
+    with open(path, 'w') as ostream:
+        for __ in range(LINES):
+            upstream = rng.lognormvariate(-4, 1)
+            ostream.write(LINE.format(
+                rng.randint(1, 254), rng.choice(ROUTES).format(rng.randint(1, 10000)), rng.choice((200, 200, 200, 304, 404, 502)),
+                upstream + rng.choice((0.0, 0.001, 0.002)), rng.choice(('HIT', 'MISS', 'EXPIRED', '-')), upstream))
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix='bench-logstats-') as tempdir:
+        path = os.path.join(tempdir, 'dev.access.log')
+        write_log(path)
+        size_mb = os.path.getsize(path) / 1e6
+        for jobs in sorted({1, os.cpu_count() or 1}):
+            started = time.perf_counter()
+            stats = logstats.scan(logstats.plan_chunks([path]), jobs)
+            elapsed = time.perf_counter() - started
+            print('{} line(s), {:.0f} MB, {} job(s): {:.2f}s, {:.0f} MB/s, {:.2f} us/line'.format(
+                stats.lines, size_mb, jobs, elapsed, size_mb / elapsed, elapsed / stats.lines * 1e6))
+
+
+if __name__ == '__main__':
+    main()
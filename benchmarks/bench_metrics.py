@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+"""Per-request overhead of MetricsMiddleware and cost of /metrics aggregation"""
+
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+ROUNDS = 100000
+WORKERS = 9
+
+
+def per_call_us(func, rounds):
+    started = time.perf_counter()
+    for __ in range(rounds):
+        func()
+    return (time.perf_counter() - started) / rounds * 1e6
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangosite.mysite.settings')
+    with tempfile.TemporaryDirectory(prefix='bench-metrics-') as tempdir:
+        os.environ['METRICS_DIR'] = tempdir
+        import django
+        django.setup()
+        from django.http import HttpResponse
+        from django.test import RequestFactory
+        from django.urls import resolve
+        from djangosite.mysite import metrics
+
+        response = HttpResponse(b'ok')
+        request = RequestFactory().get('/health/')
+        request.resolver_match = resolve('/health/')
+
+        def view(request):
+            return response
+
+        middleware = metrics.MetricsMiddleware(view)
+        middleware(request)  # opens process file and allocates route slot
+        bare = per_call_us(lambda: view(request), ROUNDS)
+        wrapped = per_call_us(lambda: middleware(request), ROUNDS)
+        print('request hot path: {:.2f} us/request overhead ({:.2f} us bare, {:.2f} us with metrics)'.format(
+            wrapped - bare, bare, wrapped))
+
+        store = metrics.process_store()
+        for pid in range(1, WORKERS):
+            other = metrics.MetricsFile(os.path.join(tempdir, '{}.db'.format(10 ** 6 + pid)))
+            other.merge(store)
+            other.close()
+        scrape = per_call_us(lambda: metrics.render_prometheus(*metrics.aggregate()), 200)
+        print('/metrics scrape: {:.0f} us for {} worker files'.format(scrape, WORKERS))
+
+
+if __name__ == '__main__':
+    main()
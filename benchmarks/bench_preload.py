@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""Per-worker memory and first-request latency of fresh (e.g. recycled) workers, without and with `preload`"""
+
+import os
+import io
+import sys
+import time
+import signal
+import socket
+import tempfile
+import contextlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bench  # noqa: E402
+import servicectl  # noqa: E402
+
+WORKERS = 4
+ROUNDS = 5
+PAGES = ['/admin/login/', '/admin/', '/health/']
+LOAD = 50  # request(s) before memory is measured
+
+
+def get(socket_path, path):
+    """Duration of plain HTTP/1.0 request over unix socket"""
+    started = time.perf_counter()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.settimeout(30)
+        client.connect(socket_path)
+        client.sendall('GET {} HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n'.format(path).encode('ascii'))
+        while client.recv(65536):
+            pass
+    return time.perf_counter() - started
+
+
+def memory_kib(pid):
+    """Rss, Pss and private (not shared with other processes) memory of process"""
+    values = {}
+    with io.open('/proc/{}/smaps_rollup'.format(pid)) as istream:
+        for line in istream:
+            fields = line.split()
+            if len(fields) == 3 and fields[2] == 'kB':
+                values[fields[0].rstrip(':')] = int(fields[1])
+    return values['Rss'], values['Pss'], values['Private_Clean'] + values['Private_Dirty']
+
+
+def wait_for_new_worker(master, old, deadline=30.0):
+    deadline = time.monotonic() + deadline
+    while time.monotonic() < deadline:
+        workers = set(servicectl.child_pids(master)) - old
+        if workers:
+            time.sleep(2.0)  # until worker imported application (if not preloaded) and accepts
+            return workers.pop()
+        time.sleep(0.05)
+    raise Exception('worker was not respawned')
+
+
+@contextlib.contextmanager
+def running_gunicorn(preload, workers, tempdir):
+    """(master pid, socket path) of dev webapp config with given workers and preload"""
+    settings, error = servicectl.load_settings('webapp', 'dev')
+    if error is not None:
+        raise Exception(error)
+    settings['gunicorn'] = dict(settings.get('gunicorn') or {}, workers=workers, max_requests=0, preload=preload)
+    settings['env'] = dict(settings.get('env') or {}, DATABASE_NAME=os.path.join(tempdir, 'db.sqlite3'))
+    socket_path = os.path.join(tempdir, 'webapp.socket')
+    with io.open(os.path.join(tempdir, 'gunicorn.log'), 'wb') as logfile:
+        process = bench.start_gunicorn(settings, socket_path, logfile)
+        try:
+            if not bench.wait_for_socket(socket_path, time.monotonic() + 60):
+                raise Exception('gunicorn did not become ready')
+            yield process.pid, socket_path
+        finally:
+            process.terminate()
+            process.wait(10)
+
+
+def first_requests(preload):
+    """Latency of first request to every page on each of ROUNDS freshly forked workers"""
+    latencies = {page: [] for page in PAGES}
+    warm = {page: [] for page in PAGES}
+    with tempfile.TemporaryDirectory(prefix='bench-preload-') as tempdir:
+        with running_gunicorn(preload, 1, tempdir) as (master, socket_path):
+            worker, = servicectl.child_pids(master)
+            for __ in range(ROUNDS):
+                # same as recycle after max_requests: worker exits and master forks new one
+                os.kill(worker, signal.SIGTERM)
+                worker = wait_for_new_worker(master, {worker})
+                for page in PAGES:
+                    latencies[page].append(get(socket_path, page))
+                for page in PAGES:
+                    warm[page].append(get(socket_path, page))
+    return latencies, warm
+
+
+def worker_memory(preload):
+    with tempfile.TemporaryDirectory(prefix='bench-preload-') as tempdir:
+        with running_gunicorn(preload, WORKERS, tempdir) as (master, socket_path):
+            for index in range(LOAD):
+                get(socket_path, PAGES[index % len(PAGES)])
+            time.sleep(0.5)
+            workers = [memory_kib(pid) for pid in servicectl.child_pids(master)]
+            total_pss = memory_kib(master)[1] + sum(pss for __, pss, __ in workers)
+    mean = [sum(values) / len(workers) / 1024.0 for values in zip(*workers)]
+    return mean, total_pss / 1024.0
+
+
+def median_ms(values):
+    return sorted(values)[len(values) // 2] * 1000.0
+
+
+def main():
+    print('{:<10} {:>14} {:>14} {:>18} {:>22}'.format('preload', 'RSS/worker', 'PSS/worker', 'private/worker', 'PSS master+{} workers'.format(WORKERS)))
+    for preload in (False, True):
+        (rss, pss, private), total = worker_memory(preload)
+        print('{:<10} {:>11.1f} MB {:>11.1f} MB {:>15.1f} MB {:>19.1f} MB'.format(str(preload), rss, pss, private, total))
+    print()
+    print('{:<10} {:<16} {:>22} {:>18}'.format('preload', 'page', 'first request [ms]', 'warm [ms]'))
+    for preload in (False, True):
+        latencies, warm = first_requests(preload)
+        for page in PAGES:
+            print('{:<10} {:<16} {:>22.2f} {:>18.2f}'.format(str(preload), page, median_ms(latencies[page]), median_ms(warm[page])))
+
+
+if __name__ == '__main__':
+    main()
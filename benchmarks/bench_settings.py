@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""Cold vs warm settings resolution and template rendering timings of servicectl.py"""
+
+import os
+import sys
+import shutil
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import servicectl  # noqa: E402
+
+CASES = [
+    ('webapp', 'dev', 'services/templates/systemd.gunicorn.service'),
+    ('nginxsite', 'dev', 'nginxsite/dev.conf'),
+]
+ROUNDS = 200
+
+
+def timed(func, rounds=1):
+    started = time.perf_counter()
+    for __ in range(rounds):
+        func()
+    return (time.perf_counter() - started) / rounds * 1000.0
+
+
+def settings_for(service_name, config):
+    settings, error = servicectl.load_settings(service_name, config)
+    assert error is None, error
+    settings.setdefault('GUNICORN_CMD', 'gunicorn')
+    settings.setdefault('GUNICORN_CONFIG_PATH', 'gunicorn_config.py')
+    return settings
+
+
+def forget_in_process_caches():
+    servicectl._descriptors.clear()
+    servicectl._template_env = None
+
+
+def resolve_all():
+    for service_name, config, __ in CASES:
+        settings_for(service_name, config)
+
+
+def render_all():
+    for service_name, config, template in CASES:
+        servicectl.render_template(template, settings_for(service_name, config))
+
+
+def main():
+    servicectl.CACHE_DIR = tempfile.mkdtemp(prefix='bench-settings-')
+    try:
+        forget_in_process_caches()
+        cold_settings = timed(resolve_all)
+        forget_in_process_caches()
+        disk_settings = timed(resolve_all)
+        memory_settings = timed(resolve_all, ROUNDS)
+
+        shutil.rmtree(os.path.join(servicectl.CACHE_DIR, 'jinja2'), ignore_errors=True)
+        forget_in_process_caches()
+        cold_render = timed(render_all)
+        forget_in_process_caches()
+        disk_render = timed(render_all)
+        memory_render = timed(render_all, ROUNDS)
+    finally:
+        shutil.rmtree(servicectl.CACHE_DIR, ignore_errors=True)
+
+    print('{:<24} {:>10} {:>12} {:>14}'.format('ms per {} case(s)'.format(len(CASES)), 'cold', 'warm (disk)', 'warm (memory)'))
+    print('{:<24} {:>10.3f} {:>12.3f} {:>14.3f}'.format('settings resolution', cold_settings, disk_settings, memory_settings))
+    print('{:<24} {:>10.3f} {:>12.3f} {:>14.3f}'.format('settings + rendering', cold_render, disk_render, memory_render))
+
+
+if __name__ == '__main__':
+    main()
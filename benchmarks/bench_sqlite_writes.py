@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+"""Concurrent writers (and readers) on one SQLite file, as gunicorn workers do: tuned backend against stock Django one
+
+Tuned backend is djangosite.mysite.db.sqlite3 (WAL journal, synchronous NORMAL, busy timeout),
+stock one is django.db.backends.sqlite3 with rollback journal and no busy timeout.
+"""
+
+import os
+import sys
+import tempfile
+import time
+import multiprocessing
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, HERE)
+
+WRITERS = 8
+READERS = 4
+WRITES = 200  # transaction(s) per writer
+
+BACKENDS = {
+    'tuned': ('djangosite.mysite.db.sqlite3', {}),
+    'stock': ('django.db.backends.sqlite3', {'timeout': 0}),
+}
+
+
+def open_database(engine, options, name):
+    from django.db import connections
+    from django.utils.module_loading import import_string
+    settings_dict = dict(connections.settings['default'], ENGINE=engine, NAME=name, OPTIONS=options)
+    return import_string(engine + '.base.DatabaseWrapper')(settings_dict, alias='bench')
+
+
+def writer(engine, options, name, results):
+    from django.db import OperationalError
+    database = open_database(engine, options, name)
+    done = failed = 0
+    for i in range(WRITES):
+        try:
+            with database.cursor() as cursor:
+                cursor.execute('BEGIN IMMEDIATE')
+                cursor.execute('INSERT INTO hits (pid, n) VALUES (%s, %s)', [os.getpid(), i])
+                cursor.execute('COMMIT')
+            done += 1
+        except OperationalError:  # database is locked
+            database.close()
+            failed += 1
+    database.close()
+    results.put(('write', done, failed))
+
+
+def reader(engine, options, name, results, stop):
+    from django.db import OperationalError
+    database = open_database(engine, options, name)
+    done = failed = 0
+    while not stop.is_set():
+        try:
+            with database.cursor() as cursor:
+                cursor.execute('SELECT COUNT(*) FROM hits')
+                cursor.fetchone()
+            done += 1
+        except OperationalError:
+            database.close()
+            failed += 1
+    database.close()
+    results.put(('read', done, failed))
+
+
+def run(engine, options, tempdir):
+    name = os.path.join(tempdir, '{}.sqlite3'.format(engine.replace('.', '-')))
+    database = open_database(engine, options, name)
+    with database.cursor() as cursor:
+        cursor.execute('CREATE TABLE hits (id INTEGER PRIMARY KEY, pid INTEGER, n INTEGER)')
+    database.close()
+
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    stop = context.Event()
+    readers = [context.Process(target=reader, args=(engine, options, name, results, stop)) for __ in range(READERS)]
+    writers = [context.Process(target=writer, args=(engine, options, name, results)) for __ in range(WRITERS)]
+    for process in readers:
+        process.start()
+    started = time.perf_counter()
+    for process in writers:
+        process.start()
+    totals = {'write': [0, 0], 'read': [0, 0]}
+    for __ in writers:
+        kind, done, failed = results.get()
+        totals[kind][0] += done
+        totals[kind][1] += failed
+    elapsed = time.perf_counter() - started
+    stop.set()
+    for __ in readers:
+        kind, done, failed = results.get()
+        totals[kind][0] += done
+        totals[kind][1] += failed
+    for process in readers + writers:
+        process.join()
+    return elapsed, totals
+
+
+def main():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangosite.mysite.settings')
+    import django
+    django.setup()
+    print('{} writer(s) x {} transaction(s), {} reader(s)'.format(WRITERS, WRITES, READERS))
+    with tempfile.TemporaryDirectory(prefix='bench-sqlite-') as tempdir:
+        for label, (engine, options) in BACKENDS.items():
+            elapsed, totals = run(engine, options, tempdir)
+            print('{:<6} {:>8.0f} commits/s, {:>5} locked write(s), {:>8.0f} reads/s, {:>5} locked read(s)'.format(
+                label, totals['write'][0] / elapsed, totals['write'][1], totals['read'][0] / elapsed, totals['read'][1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+"""Cold start of `start`/`reload`/`stop` commands in fresh interpreter against bare interpreter baseline, exits nonzero over budget
+
+Measured path is the one of `service.py stop webapp dev` up to the request: importing servicectl.py, resolving settings,
+finding units and setting up systemd backend (jeepney and system bus connection when available), then one unit state query.
+"""
+
+import os
+import sys
+import json
+import tempfile
+import subprocess
+import time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ROUNDS = 20
+
+# Command may take this many times the wall time of bare interpreter start until systemd request
+BUDGET_RATIO = float(os.environ.get('START_BUDGET_RATIO', 2.0))
+
+PROBE = """
+import sys, json, time
+started = time.perf_counter()
+import servicectl
+settings, error = servicectl.load_settings('webapp', 'dev')
+units = servicectl.derive_systemd_units('webapp', 'dev')
+backend = servicectl.systemd()
+ready = time.perf_counter()
+servicectl.systemd_state(units[0])
+print(json.dumps({
+    'ready_ms': (ready - started) * 1000.0,
+    'query_ms': (time.perf_counter() - ready) * 1000.0,
+    'backend': type(backend).__name__,
+    'loaded': [name for name in ('click', 'jinja2', 'ruamel.yaml', 'concurrent.futures', 'jeepney') if name in sys.modules],
+}))
+"""
+
+
+def run(source, env):
+    """(wall seconds of whole interpreter run, its JSON report or None)"""
+    started = time.perf_counter()
+    job = subprocess.run([sys.executable, '-c', source], cwd=HERE, env=env, check=True, stdout=subprocess.PIPE)
+    elapsed = time.perf_counter() - started
+    return elapsed, json.loads(job.stdout) if job.stdout.strip() else None
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def main():
+    with tempfile.TemporaryDirectory(prefix='bench-startup-') as tempdir:
+        env = dict(os.environ, SERVICE_CACHE_DIR=tempdir)
+        run(PROBE, env)  # warm descriptor cache
+        baseline = median([run('pass', env)[0] for __ in range(ROUNDS)]) * 1000.0
+        runs = [run(PROBE, env) for __ in range(ROUNDS)]
+    # wall time of probe up to systemd request: interpreter start plus what servicectl does before it
+    command = median([(elapsed * 1000.0 - report['query_ms']) for elapsed, report in runs])
+    report = runs[-1][1]
+    print('{:<40} {:>10}'.format('median of {} run(s)'.format(ROUNDS), 'ms'))
+    print('{:<40} {:>10.3f}'.format('bare interpreter', baseline))
+    print('{:<40} {:>10.3f}'.format('stop command until systemd request', command))
+    print('{:<40} {:>10.3f}'.format('  of it in servicectl', median([report['ready_ms'] for __, report in runs])))
+    print('{:<40} {:>10.3f}'.format('unit state query ({})'.format(report['backend']), median([report['query_ms'] for __, report in runs])))
+    print('modules loaded: {}'.format(', '.join(report['loaded']) or 'none'))
+    budget = baseline * BUDGET_RATIO
+    if command > budget:
+        sys.exit('Cold start {:.1f} ms is over budget {:.1f} ms ({}x bare interpreter)'.format(command, budget, BUDGET_RATIO))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python
+"""Full vs resumed TLS handshakes against bundled certificate with `tls` settings of nginxsite config
+
+By default handshakes go to local OpenSSL server (the library Nginx uses) configured from the descriptor,
+`--connect HOST:PORT` measures installed Nginx instead, e.g. `--connect 127.0.0.1:443`.
+"""
+
+import os
+import sys
+import time
+import socket
+import argparse
+import multiprocessing
+import ssl
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import servicectl  # noqa: E402
+
+HANDSHAKES = 500
+REQUEST = b'HEAD / HTTP/1.1\r\nHost: example.com\r\nConnection: close\r\n\r\n'
+RESPONSE = b'HTTP/1.1 204 No Content\r\nConnection: close\r\n\r\n'
+VERSIONS = [('TLSv1.2', ssl.TLSVersion.TLSv1_2), ('TLSv1.3', ssl.TLSVersion.TLSv1_3)]
+
+
+def server_context(config, tls):
+    certs = os.path.join(servicectl.HERE, 'nginxsite', 'certs')
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(os.path.join(certs, tls.get('certificate', 'site.crt')), os.path.join(certs, tls.get('certificate_key', 'site.key')))
+    context.set_ciphers(tls.get('ciphers', 'ECDHE+AESGCM'))
+    # OpenSSL of Python takes single group, Nginx takes whole preference list
+    context.set_ecdh_curve(tls.get('ecdh_curve', 'X25519').split(':')[0])
+    if not tls.get('session_tickets', True):
+        context.options |= ssl.OP_NO_TICKET
+    return context
+
+
+def serve(listener, context):
+    while True:
+        client, __ = listener.accept()
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            with context.wrap_socket(client, server_side=True) as connection:
+                data = b''
+                while b'\r\n\r\n' not in data:
+                    chunk = connection.recv(4096)
+                    if not chunk:
+                        break
+                    data += chunk
+                connection.sendall(RESPONSE)
+                connection.unwrap()
+        except (OSError, ssl.SSLError):
+            client.close()
+
+
+def handshake(address, context, session=None):
+    """(handshake seconds, whole exchange seconds, session, whether it was resumed)"""
+    started = time.perf_counter()
+    with socket.create_connection(address) as raw:
+        raw.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)  # small records, no delayed ACK waits
+        with context.wrap_socket(raw, server_hostname='example.com', session=session, do_handshake_on_connect=False) as connection:
+            connection.do_handshake()
+            handshaked = time.perf_counter()
+            connection.sendall(REQUEST)
+            # reading response also receives TLSv1.3 session tickets, sent after handshake
+            while connection.recv(4096):
+                pass
+            session, reused = connection.session, connection.session_reused
+            # without close_notify OpenSSL takes session as not resumable
+            connection.unwrap()
+            return handshaked - started, time.perf_counter() - started, session, reused
+
+
+def measure(address, context, resume, count):
+    durations, totals, resumed = [], [], 0
+    session = handshake(address, context)[2] if resume else None
+    for __ in range(count):
+        seconds, total, new_session, reused = handshake(address, context, session if resume else None)
+        durations.append(seconds)
+        totals.append(total)
+        resumed += reused
+        if resume:
+            session = new_session  # TLSv1.3 tickets are single use by default
+    durations.sort()
+    return {
+        'p50_ms': durations[len(durations) // 2] * 1000.0,
+        'p99_ms': durations[int(len(durations) * 0.99)] * 1000.0,
+        'per_second': count / sum(totals),
+        'resumed': resumed / count,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--config', default='dev', help='nginxsite config whose `tls` section is used')
+    parser.add_argument('--connect', help='HOST:PORT of running Nginx instead of local OpenSSL server')
+    parser.add_argument('--handshakes', type=int, default=HANDSHAKES)
+    args = parser.parse_args()
+    settings, error = servicectl.load_settings('nginxsite', args.config)
+    if error is not None:
+        sys.exit(error)
+    tls = settings.get('tls') or {}
+    protocols = tls.get('protocols', 'TLSv1.2 TLSv1.3').split()
+
+    server = None
+    if args.connect:
+        host, __, port = args.connect.rpartition(':')
+        address = (host, int(port))
+    else:
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(128)
+        address = listener.getsockname()
+        server = multiprocessing.Process(target=serve, args=(listener, server_context(args.config, tls)), daemon=True)
+        server.start()
+        listener.close()
+    try:
+        print('{:<10} {:<10} {:>10} {:>10} {:>14} {:>10}'.format('protocol', 'handshake', 'p50 [ms]', 'p99 [ms]', 'conn/s', 'resumed'))
+        for name, version in VERSIONS:
+            if name not in protocols:
+                continue
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+            context.load_verify_locations(os.path.join(servicectl.HERE, 'nginxsite', 'certs', tls.get('certificate', 'site.crt')))
+            context.minimum_version = context.maximum_version = version
+            for mode, resume in (('full', False), ('resumed', True)):
+                result = measure(address, context, resume, args.handshakes)
+                print('{:<10} {:<10} {:>10.3f} {:>10.3f} {:>14.0f} {:>9.0%}'.format(
+                    name, mode, result['p50_ms'], result['p99_ms'], result['per_second'], result['resumed']))
+    finally:
+        if server is not None:
+            server.terminate()
+
+
+if __name__ == '__main__':
+    main()
@@ -3,7 +3,9 @@ import os
 import sys
 
 if __name__ == "__main__":
-    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "mysite.settings")
+    # settings refer to project modules by full name (djangosite.mysite...) as services do
+    sys.path.insert(1, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    os.environ.setdefault("DJANGO_SETTINGS_MODULE", "djangosite.mysite.settings")
     try:
         from django.core.management import execute_from_command_line
     except ImportError as exc:
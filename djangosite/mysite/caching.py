@@ -0,0 +1,88 @@
+"""
+Per-view response caching with explicit eviction.
+
+Usage:
+
+    @cached_view(timeout=60)
+    def news(request):
+        ...
+
+    evict_view('/news/')  # after news are updated
+    evict_views()  # drop everything cached by cached_view at once
+"""
+
+import functools
+import hashlib
+
+from django.core.cache import cache
+
+KEY_PREFIX = 'view'
+
+
+def generation(key_prefix):
+    """Number mixed into keys: bumping it evicts all entries of key_prefix at once"""
+    key = '{}:generation'.format(key_prefix)
+    value = cache.get(key)
+    if value is None:
+        cache.add(key, 1, None)
+        value = cache.get(key, 1)
+    return value
+
+
+def view_cache_key(path, key_prefix=KEY_PREFIX):
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    return '{}:{}:{}'.format(key_prefix, generation(key_prefix), digest)
+
+
+def cacheable(request, response):
+    """Whether response is the same for every anonymous client of its path"""
+    if response.status_code != 200 or response.streaming or response.cookies:
+        return False
+    # page with CSRF token gets the cookie only later from CsrfViewMiddleware (CSRF_COOKIE_USED before Django 4.0)
+    if request.META.get('CSRF_COOKIE_USED') or request.META.get('CSRF_COOKIE_NEEDS_UPDATE'):
+        return False
+    # key is the path only, so response varying on any header (Cookie, Accept-Language...) is not cached
+    if response.has_header('Vary'):
+        return False
+    cache_control = {directive.strip().split('=')[0].lower() for directive in response.get('Cache-Control', '').split(',')}
+    return not cache_control & {'private', 'no-cache', 'no-store'}
+
+
+def cached_view(timeout=None, key_prefix=KEY_PREFIX):
+    """Cache successful GET/HEAD responses for anonymous users by full path (including query)"""
+
+    def decorator(view):
+
+        @functools.wraps(view)
+        def wrapper(request, *args, **kwargs):
+            user = getattr(request, 'user', None)
+            if request.method not in ('GET', 'HEAD') or (user is not None and user.is_authenticated):
+                return view(request, *args, **kwargs)
+            key = view_cache_key(request.get_full_path(), key_prefix)
+            response = cache.get(key)
+            if response is not None:
+                return response
+            response = view(request, *args, **kwargs)
+            if hasattr(response, 'render') and callable(response.render):
+                response = response.render()
+            if cacheable(request, response):
+                cache.set(key, response, timeout)
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+def evict_view(path, key_prefix=KEY_PREFIX):
+    """Drop cached response for exact full path"""
+    cache.delete(view_cache_key(path, key_prefix))
+
+
+def evict_views(key_prefix=KEY_PREFIX):
+    """Drop all responses cached under key_prefix"""
+    key = '{}:generation'.format(key_prefix)
+    try:
+        cache.incr(key)
+    except ValueError:
+        cache.set(key, 2, None)
@@ -0,0 +1,33 @@
+"""
+Celery application of the project, started by taskworker and taskplanner services:
+
+    celery -A djangosite.mysite.celery worker --queues default
+
+Configured from CELERY_* Django settings, tasks are discovered in `tasks` modules of installed apps.
+"""
+
+import os
+
+from celery import Celery
+from celery.signals import setup_logging, worker_process_shutdown
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangosite.mysite.settings')
+
+app = Celery('mysite')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
+
+
+@setup_logging.connect
+def configure_logging(**kwargs):
+    # LOGGING of Django settings (async handlers) instead of celery own handlers
+    import logging.config
+    from django.conf import settings
+    logging.config.dictConfig(settings.LOGGING)
+
+
+@worker_process_shutdown.connect
+def flush_logging(**kwargs):
+    # pool process ends by os._exit, write out its queued records
+    from djangosite.mysite import logconfig
+    logconfig.flush_handlers()
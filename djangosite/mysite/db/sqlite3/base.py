@@ -0,0 +1,30 @@
+"""
+SQLite backend tuned for several concurrent gunicorn workers.
+
+Applies PRAGMAs from PRAGMAS key of database settings to every new connection,
+by default WAL journal (readers do not block writer and vice versa)
+and busy timeout (writers wait for lock instead of failing with "database is locked").
+"""
+
+from django.db.backends.sqlite3 import base
+
+DEFAULT_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'synchronous': 'NORMAL',
+    'busy_timeout': 5000,  # millisecond(s)
+}
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        pragmas = dict(DEFAULT_PRAGMAS)
+        pragmas.update(self.settings_dict.get('PRAGMAS') or {})
+        cursor = connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                cursor.execute('PRAGMA {}={}'.format(name, value))
+        finally:
+            cursor.close()
+        return connection
@@ -0,0 +1,306 @@
+"""
+Logging of web application and task workers, configured per service by LOG_* environment variables
+which service.py renders into systemd units from `logging` section of service descriptor.
+
+Logging call only puts record into in-memory queue of its process, records are written
+by listener thread started lazily in every process (so also in forked gunicorn and celery workers),
+request threads never wait for disk or socket. When queue is full records are dropped, not waited for.
+
+Outputs (LOG_OUTPUT):
+    stream    stderr of process, i.e. log file of systemd unit (default)
+    file      LOG_FILE shared by all processes of service, rotated by size (LOG_MAX_BYTES)
+              and/or time (LOG_WHEN: H, D, W) keeping LOG_BACKUP_COUNT copies
+    journald  native journal protocol, records keep level, logger and source location as fields
+    datagram  syslog over unix datagram socket LOG_SOCKET (/dev/log, or collector like vector)
+"""
+
+import os
+import sys
+import copy
+import glob
+import time
+import queue
+import fcntl
+import socket
+import struct
+import logging
+import logging.handlers
+import threading
+import weakref
+
+OUTPUTS = ('stream', 'file', 'journald', 'datagram')
+
+# suffix of file rotated by time, sorted names are in chronological order
+WHEN_FORMATS = {
+    'H': '%Y-%m-%d_%H',
+    'D': '%Y-%m-%d',
+    'W': '%G-W%V',
+}
+
+LOG_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+
+JOURNAL_SOCKET = '/run/systemd/journal/socket'
+
+_async_handlers = weakref.WeakSet()
+
+
+def setting(name, default, cast=str):
+    value = os.environ.get('LOG_{}'.format(name.upper()))
+    if value is None or value == '':
+        return default
+    return cast(value)
+
+
+def log_options():
+    return {
+        'level': setting('level', 'INFO'),
+        'output': setting('output', 'stream'),
+        'file': setting('file', None),
+        'max_bytes': setting('max_bytes', 0, int),
+        'when': setting('when', None),
+        'backup_count': setting('backup_count', 7, int),
+        'socket': setting('socket', '/dev/log'),
+        'identifier': setting('identifier', os.path.basename(sys.argv[0]) or 'python'),
+        'queue_size': setting('queue_size', 10000, int),
+        'access_sample': setting('access_sample', 1.0, float),
+    }
+
+
+class QueueListener(logging.handlers.QueueListener):
+
+    def enqueue_sentinel(self):
+        # on stop wait a bit for room in full queue
+        self.queue.put(self._sentinel, timeout=1.0)
+
+
+class AsyncHandler(logging.handlers.QueueHandler):
+    """Queue records, `target` handler writes them in listener thread of current process"""
+
+    def __init__(self, target, queue_size=10000):
+        super().__init__(None)
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self.listener = None
+        self.pid = None
+        self.start_lock = threading.Lock()
+        _async_handlers.add(self)
+
+    def start(self):
+        pid = os.getpid()
+        if self.pid != pid:
+            with self.start_lock:
+                if self.pid != pid:
+                    # queue and thread of parent are not usable after fork
+                    self.queue = queue.Queue(self.queue_size)
+                    self.listener = QueueListener(self.queue, self.target, respect_handler_level=True)
+                    self.listener.start()
+                    self.pid = pid
+
+    def setFormatter(self, fmt):
+        # formatting is done by listener thread
+        self.target.setFormatter(fmt)
+
+    def prepare(self, record):
+        # resolve only what may change after logging call returns: message arguments and traceback
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        self.start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def reopen(self):
+        """Reopen file of target handler (on SIGUSR1 after external rotation)"""
+        if isinstance(self.target, logging.FileHandler):
+            with self.target.lock:
+                if self.target.stream:
+                    self.target.close()
+                    self.target.stream = self.target._open()
+
+    def stop(self):
+        """Write out queued records and stop listener, next record starts it again"""
+        with self.start_lock:
+            if self.listener is not None and self.pid == os.getpid():
+                try:
+                    self.listener.stop()
+                except queue.Full:
+                    pass  # listener is stuck, its daemon thread ends with process
+            self.listener = None
+            self.pid = None
+
+    def close(self):
+        self.stop()
+        self.target.close()
+        super().close()
+
+
+class SharedFileHandler(logging.handlers.WatchedFileHandler):
+    """
+    File appended by several processes and rotated by whichever of them notices it is due:
+    rotation is done under file lock and others reopen the file by its changed inode.
+    """
+
+    def __init__(self, filename, max_bytes=0, when=None, backup_count=7, encoding='utf-8'):
+        if when is not None and when not in WHEN_FORMATS:
+            raise ValueError('Unknown rotation interval: {} (expected one of {})'.format(when, ', '.join(WHEN_FORMATS)))
+        os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+        super().__init__(filename, encoding=encoding)
+        self.max_bytes = max_bytes
+        self.when = when
+        self.backup_count = backup_count
+        directory, name = os.path.split(self.baseFilename)
+        # hidden, so it is not taken for rotated copy
+        self.lock_path = os.path.join(directory, '.{}.lock'.format(name))
+
+    def rotation_due(self):
+        try:
+            stat = os.stat(self.baseFilename)
+        except FileNotFoundError:
+            return None
+        if not stat.st_size:
+            return None
+        if self.max_bytes and stat.st_size >= self.max_bytes:
+            return 'size'
+        if self.when and time.strftime(WHEN_FORMATS[self.when], time.localtime(stat.st_mtime)) != time.strftime(WHEN_FORMATS[self.when]):
+            return time.strftime(WHEN_FORMATS[self.when], time.localtime(stat.st_mtime))
+        return None
+
+    def rotate(self, due):
+        base = self.baseFilename
+        if due == 'size':
+            # .1 is the newest copy, the oldest one is overwritten
+            for index in range(self.backup_count, 0, -1):
+                source = base if index == 1 else '{}.{}'.format(base, index - 1)
+                if os.path.exists(source):
+                    os.replace(source, '{}.{}'.format(base, index))
+            if os.path.exists(base):
+                os.remove(base)
+            return
+        target = '{}.{}'.format(base, due)
+        if os.path.exists(target):
+            # name already taken, e.g. clock was set back
+            target = '{}.{}'.format(target, int(time.time()))
+        os.replace(base, target)
+        rotated = sorted(glob.glob(glob.escape(base) + '.[0-9][0-9][0-9][0-9]-*'))
+        for path in rotated[:max(0, len(rotated) - self.backup_count)]:
+            os.remove(path)
+
+    def emit(self, record):
+        if self.rotation_due():
+            try:
+                with open(self.lock_path, 'a') as lock:
+                    fcntl.flock(lock, fcntl.LOCK_EX)
+                    due = self.rotation_due()  # another process may have rotated meanwhile
+                    if due:
+                        self.rotate(due)
+            except OSError:
+                self.handleError(record)
+        super().emit(record)  # reopens file when its inode changed
+
+
+class JournalHandler(logging.Handler):
+    """Send records to systemd journal by its native datagram protocol"""
+
+    PRIORITIES = ((logging.CRITICAL, 2), (logging.ERROR, 3), (logging.WARNING, 4), (logging.INFO, 6))
+
+    def __init__(self, identifier, address=JOURNAL_SOCKET):
+        super().__init__()
+        self.identifier = identifier
+        self.address = address
+        self.socket = None
+
+    @staticmethod
+    def encode(fields):
+        data = []
+        for name, value in fields.items():
+            value = str(value).encode('utf-8', 'replace')
+            if b'\n' in value:
+                data.append(name.encode('ascii') + b'\n' + struct.pack('<Q', len(value)) + value + b'\n')
+            else:
+                data.append(name.encode('ascii') + b'=' + value + b'\n')
+        return b''.join(data)
+
+    def priority(self, levelno):
+        for level, priority in self.PRIORITIES:
+            if levelno >= level:
+                return priority
+        return 7
+
+    def emit(self, record):
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.socket.sendto(self.encode({
+                'MESSAGE': self.format(record),
+                'PRIORITY': self.priority(record.levelno),
+                'SYSLOG_IDENTIFIER': self.identifier,
+                'LOGGER': record.name,
+                'CODE_FILE': record.pathname,
+                'CODE_LINE': record.lineno,
+                'CODE_FUNC': record.funcName,
+            }), self.address)
+        except Exception:
+            self.handleError(record)
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        super().close()
+
+
+def flush_handlers():
+    """Write out records queued in this process, for workers which exit bypassing atexit (os._exit)"""
+    for handler in list(_async_handlers):
+        handler.stop()
+
+
+def output_handler(options):
+    """Handler writing to configured output"""
+    output = options['output']
+    if output == 'stream':
+        return logging.StreamHandler(sys.stderr)
+    if output == 'file':
+        if not options['file']:
+            raise ValueError('LOG_FILE is required by `file` output')
+        return SharedFileHandler(options['file'], options['max_bytes'], options['when'], options['backup_count'])
+    if output == 'journald':
+        return JournalHandler(options['identifier'])
+    if output == 'datagram':
+        return logging.handlers.SysLogHandler(address=options['socket'], socktype=socket.SOCK_DGRAM)
+    raise ValueError('Unknown LOG_OUTPUT: {} (expected one of {})'.format(output, ', '.join(OUTPUTS)))
+
+
+def async_handler(**overrides):
+    """Factory of handler used by LOGGING setting (`()` key of dictConfig)"""
+    options = dict(log_options(), **overrides)
+    return AsyncHandler(output_handler(options), options['queue_size'])
+
+
+def django_logging():
+    """LOGGING setting: root and django loggers write through single async handler"""
+    level = log_options()['level']
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {
+            'default': {'format': LOG_FORMAT},
+        },
+        'handlers': {
+            'default': {'()': 'djangosite.mysite.logconfig.async_handler', 'formatter': 'default'},
+        },
+        'root': {'handlers': ['default'], 'level': level},
+        'loggers': {
+            # instead of console and mail handlers of Django default logging
+            'django': {'handlers': ['default'], 'level': level, 'propagate': False},
+        },
+    }
@@ -0,0 +1,321 @@
+"""
+Request metrics shared by all gunicorn workers, exposed in Prometheus text format.
+
+Every process writes only its own memory-mapped file `<pid>.db` in METRICS_DIR,
+so processes never lock each other; /metrics view sums all files up.
+Files of exited workers are folded into `archive.db` by gunicorn master
+(see child_exit hook in services/gunicorn_config.py), so counters survive worker recycling.
+When several gunicorn instances run, each has own METRICS_DIR below METRICS_SCRAPE_DIR
+and /metrics of any of them sums up all.
+
+File layout: header (magic, slot count, used slots, in-flight gauge)
+followed by fixed-size slots, each is float64 values and route key.
+"""
+
+import os
+import mmap
+import bisect
+import struct
+import tempfile
+import threading
+import time
+
+MAGIC = b'EXMETR01'
+
+# Upper bounds (seconds) of latency histogram buckets, last one is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+COUNT, SUM, QUERIES, ERRORS = range(4)
+FIRST_BUCKET = 4
+VALUES = FIRST_BUCKET + len(BUCKETS)
+
+KEY_SIZE = 128
+SLOT_SIZE = VALUES * 8 + KEY_SIZE
+HEADER = struct.Struct('<8sIId')  # magic, slots, used, in-flight
+HEADER_SIZE = 64
+SLOTS = 1024
+
+OVERFLOW_KEY = 'OTHER <overflow>'
+ARCHIVE_NAME = 'archive.db'
+
+
+def metrics_dir():
+    return os.environ.get('METRICS_DIR') or os.path.join(tempfile.gettempdir(), 'example-metrics')
+
+
+def scrape_dir():
+    return os.environ.get('METRICS_SCRAPE_DIR') or metrics_dir()
+
+
+class MetricsFile:
+    """Memory-mapped file with per-route counters of single process"""
+
+    def __init__(self, path, slots=SLOTS, readonly=False):
+        """Open (or create) file of own process, readonly opens file of other one as it is.
+
+        Readonly file of process which has not written its header yet raises ValueError, so it is never
+        reinitialized under the process writing it.
+        """
+        self.path = path
+        self.lock = threading.Lock()  # threads of the same process only
+        if readonly:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                size = os.fstat(fd).st_size
+                if size < HEADER_SIZE:
+                    raise ValueError('Metrics file without header: {}'.format(path))
+                self.map = mmap.mmap(fd, size, access=mmap.ACCESS_READ)
+            finally:
+                os.close(fd)
+            magic, self.slots, used, __ = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC or size < HEADER_SIZE + self.slots * SLOT_SIZE:
+                self.map.close()
+                raise ValueError('Metrics file without valid header: {}'.format(path))
+            used = min(used, self.slots)
+        else:
+            size = HEADER_SIZE + slots * SLOT_SIZE
+            fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                if os.fstat(fd).st_size < size:
+                    os.ftruncate(fd, size)
+                self.map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            magic, self.slots, used, __ = HEADER.unpack_from(self.map, 0)
+            if magic != MAGIC:
+                self.slots, used = slots, 0
+                HEADER.pack_into(self.map, 0, MAGIC, self.slots, 0, 0.0)
+        self.in_flight_value = memoryview(self.map)[16:24].cast('d')
+        self.values = memoryview(self.map)[HEADER_SIZE:HEADER_SIZE + self.slots * SLOT_SIZE].cast('d')
+        self.index = {}
+        for slot in range(used):
+            self.index[self.read_key(slot)] = slot
+
+    def read_key(self, slot):
+        offset = HEADER_SIZE + slot * SLOT_SIZE + VALUES * 8
+        return self.map[offset:offset + KEY_SIZE].rstrip(b'\0').decode('utf-8')
+
+    def slot(self, key):
+        slot = self.index.get(key)
+        if slot is not None:
+            return slot
+        used = len(self.index)
+        if used >= self.slots - 1 and key != OVERFLOW_KEY:
+            return self.slot(OVERFLOW_KEY)
+        offset = HEADER_SIZE + used * SLOT_SIZE + VALUES * 8
+        self.map[offset:offset + KEY_SIZE] = key.encode('utf-8')[:KEY_SIZE].ljust(KEY_SIZE, b'\0')
+        struct.pack_into('<I', self.map, 12, used + 1)  # publish slot only after key is written
+        self.index[key] = used
+        return used
+
+    def add_in_flight(self, delta):
+        with self.lock:
+            self.in_flight_value[0] += delta
+
+    def finish(self, key, seconds, queries, error):
+        """Record finished request and decrement in-flight gauge"""
+        with self.lock:
+            self.in_flight_value[0] -= 1
+            base = self.slot(key) * (SLOT_SIZE // 8)
+            values = self.values
+            values[base + COUNT] += 1
+            values[base + SUM] += seconds
+            values[base + QUERIES] += queries
+            if error:
+                values[base + ERRORS] += 1
+            values[base + FIRST_BUCKET + bisect.bisect_left(BUCKETS, seconds)] += 1
+
+    def merge(self, other):
+        """Add counters of other file (in-flight gauge is not carried over)"""
+        with self.lock:
+            for key, values in other.read().items():
+                base = self.slot(key) * (SLOT_SIZE // 8)
+                for i, value in enumerate(values):
+                    self.values[base + i] += value
+
+    def read(self):
+        used = min(HEADER.unpack_from(self.map, 0)[2], self.slots)
+        result = {}
+        for slot in range(used):
+            base = slot * (SLOT_SIZE // 8)
+            result[self.read_key(slot)] = list(self.values[base:base + VALUES])
+        return result
+
+    def in_flight(self):
+        return HEADER.unpack_from(self.map, 0)[3]
+
+    def close(self):
+        self.in_flight_value.release()
+        self.values.release()
+        self.map.close()
+
+
+_store = None
+_store_pid = None
+_store_lock = threading.Lock()
+
+
+def process_store():
+    """Metrics file of current process, reopened after fork"""
+    global _store, _store_pid
+    pid = os.getpid()
+    if _store_pid != pid:
+        with _store_lock:
+            if _store_pid != pid:
+                directory = metrics_dir()
+                os.makedirs(directory, exist_ok=True)
+                _store = MetricsFile(os.path.join(directory, '{}.db'.format(pid)))
+                _store_pid = pid
+    return _store
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def mark_process_dead(pid, directory=None):
+    """Fold counters of exited process into archive file and remove its file"""
+    directory = directory or metrics_dir()
+    path = os.path.join(directory, '{}.db'.format(pid))
+    if not os.path.exists(path):
+        return
+    try:
+        dead = MetricsFile(path, readonly=True)
+    except ValueError:
+        dead = None  # process exited before writing anything
+    if dead is not None:
+        archive = MetricsFile(os.path.join(directory, ARCHIVE_NAME))
+        try:
+            archive.merge(dead)
+            archive.map.flush()
+        finally:
+            dead.close()
+            archive.close()
+    os.remove(path)
+
+
+def collect_dead(directory=None):
+    """Fold files left by processes which are not running anymore"""
+    directory = directory or metrics_dir()
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        stem, ext = os.path.splitext(name)
+        if ext == '.db' and stem.isdigit() and not pid_alive(int(stem)):
+            mark_process_dead(int(stem), directory)
+
+
+def aggregate(directory=None):
+    """Sum counters and in-flight gauges of all metrics files in directory and its subdirectories"""
+    directory = directory or scrape_dir()
+    totals = {}
+    in_flight = 0.0
+    paths = [os.path.join(dirpath, name) for dirpath, __, names in os.walk(directory) for name in names if name.endswith('.db')]
+    for path in sorted(paths):
+        try:
+            metrics = MetricsFile(path, readonly=True)
+        except (OSError, ValueError):
+            continue  # file of just exited worker or of one still writing its header
+        try:
+            in_flight += metrics.in_flight()
+            for key, values in metrics.read().items():
+                total = totals.setdefault(key, [0.0] * VALUES)
+                for i, value in enumerate(values):
+                    total[i] += value
+        finally:
+            metrics.close()
+    return totals, in_flight
+
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
+
+
+def render_prometheus(totals, in_flight):
+    lines = [
+        '# HELP django_http_request_duration_seconds Request latency by route.',
+        '# TYPE django_http_request_duration_seconds histogram',
+    ]
+    for key in sorted(totals):
+        values = totals[key]
+        method, __, route = key.partition(' ')
+        labels = 'method="{}",route="{}"'.format(method, route.replace('\\', '\\\\').replace('"', '\\"'))
+        cumulative = 0.0
+        for i, bound in enumerate(BUCKETS):
+            cumulative += values[FIRST_BUCKET + i]
+            lines.append('django_http_request_duration_seconds_bucket{{{},le="{}"}} {:g}'.format(labels, format_bound(bound), cumulative))
+        lines.append('django_http_request_duration_seconds_sum{{{}}} {!r}'.format(labels, values[SUM]))
+        lines.append('django_http_request_duration_seconds_count{{{}}} {:g}'.format(labels, values[COUNT]))
+    for name, index, help_text in (
+            ('django_http_requests_errors_total', ERRORS, 'Responses with 5xx status by route.'),
+            ('django_db_queries_total', QUERIES, 'Database queries made by requests by route.')):
+        lines.append('# HELP {} {}'.format(name, help_text))
+        lines.append('# TYPE {} counter'.format(name))
+        for key in sorted(totals):
+            method, __, route = key.partition(' ')
+            lines.append('{}{{method="{}",route="{}"}} {:g}'.format(name, method, route.replace('"', '\\"'), totals[key][index]))
+    lines.append('# HELP django_http_requests_in_flight Requests being processed by all workers.')
+    lines.append('# TYPE django_http_requests_in_flight gauge')
+    lines.append('django_http_requests_in_flight {:g}'.format(in_flight))
+    return '\n'.join(lines) + '\n'
+
+
+def route_of(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return '<unmatched>'
+    return getattr(match, 'route', None) or match.view_name or '<unnamed>'
+
+
+class QueryCount(threading.local):
+    count = 0
+
+
+_queries = QueryCount()
+
+
+def count_queries(execute, sql, params, many, context):
+    _queries.count += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    # wrapper stays on connection object, so entering context per request is not needed
+    if count_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(count_queries)
+
+
+class MetricsMiddleware:
+    """Record latency, DB query count and errors of every request by route"""
+
+    def __init__(self, get_response):
+        from django.db.backends.signals import connection_created
+        connection_created.connect(install_query_counter, dispatch_uid='metrics.install_query_counter')
+        self.get_response = get_response
+
+    def __call__(self, request):
+        store = process_store()
+        queries = _queries.count
+        store.add_in_flight(1)
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+        except Exception:
+            store.finish('{} {}'.format(request.method, route_of(request)), time.perf_counter() - started,
+                         _queries.count - queries, True)
+            raise
+        store.finish('{} {}'.format(request.method, route_of(request)), time.perf_counter() - started,
+                     _queries.count - queries, response.status_code >= 500)
+        return response
+
+
+def metrics_view(request):
+    from django.http import HttpResponse
+    totals, in_flight = aggregate()
+    return HttpResponse(render_prometheus(totals, in_flight), content_type='text/plain; version=0.0.4; charset=utf-8')
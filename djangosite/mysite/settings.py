@@ -12,6 +12,11 @@ https://docs.djangoproject.com/en/2.0/ref/settings/
 
 import os
 
+import django
+from django.core.exceptions import ImproperlyConfigured
+
+from djangosite.mysite import logconfig
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -31,6 +36,10 @@ ALLOWED_HOSTS = [
     'example.com',
 ]
 
+# Nginx terminates TLS and always sets this header (gunicorn listens on unix socket only),
+# so request.is_secure() and CSRF origin checks see https
+SECURE_PROXY_SSL_HEADER = ('HTTP_X_FORWARDED_PROTO', 'https')
+
 
 # Application definition
 
@@ -44,6 +53,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'djangosite.mysite.metrics.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -55,11 +65,20 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'djangosite.mysite.urls'
 
+TEMPLATE_LOADERS = [
+    'django.template.loaders.filesystem.Loader',
+    'django.template.loaders.app_directories.Loader',
+]
+
+# Compiled templates are kept in memory of each worker instead of being found and parsed on every render,
+# TEMPLATE_CACHE=0 is handy for development to pick up template changes without restart
+if os.environ.get('TEMPLATE_CACHE', '1') == '1':
+    TEMPLATE_LOADERS = [('django.template.loaders.cached.Loader', TEMPLATE_LOADERS)]
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
         'DIRS': [],
-        'APP_DIRS': True,
         'OPTIONS': {
             'context_processors': [
                 'django.template.context_processors.debug',
@@ -67,6 +86,7 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
             ],
+            'loaders': TEMPLATE_LOADERS,
         },
     },
 ]
@@ -76,14 +96,119 @@ WSGI_APPLICATION = 'mysite.wsgi.application'
 
 # Database
 # https://docs.djangoproject.com/en/2.0/ref/settings/#databases
+# Configured per service config with DATABASE_* variables of `env` section in services/webapp.yaml
+
+DATABASE_ENGINES = {
+    'sqlite3': 'djangosite.mysite.db.sqlite3',  # WAL journal and busy timeout applied on connect
+    'postgresql': 'django.db.backends.postgresql',
+    'mysql': 'django.db.backends.mysql',
+}
+
+DATABASE_ENGINE = os.environ.get('DATABASE_ENGINE', 'sqlite3')
 
 DATABASES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'ENGINE': DATABASE_ENGINES.get(DATABASE_ENGINE, DATABASE_ENGINE),
+        'NAME': os.environ.get('DATABASE_NAME') or os.path.join(BASE_DIR, 'db.sqlite3'),
+        'USER': os.environ.get('DATABASE_USER', ''),
+        'PASSWORD': os.environ.get('DATABASE_PASSWORD', ''),
+        'HOST': os.environ.get('DATABASE_HOST', ''),
+        'PORT': os.environ.get('DATABASE_PORT', ''),
+        # keep connection open between requests of the same worker thread instead of reconnecting
+        'CONN_MAX_AGE': int(os.environ.get('DATABASE_CONN_MAX_AGE', 60)),
+        # check persistent connection before reuse (Django 4.1+)
+        'CONN_HEALTH_CHECKS': os.environ.get('DATABASE_CONN_HEALTH_CHECKS', '1') == '1',
+        'OPTIONS': {},
+    }
+}
+
+if DATABASE_ENGINE == 'sqlite3':
+    DATABASES['default']['PRAGMAS'] = {
+        'journal_mode': os.environ.get('DATABASE_JOURNAL_MODE', 'WAL'),
+        'synchronous': os.environ.get('DATABASE_SYNCHRONOUS', 'NORMAL'),
+        'busy_timeout': int(os.environ.get('DATABASE_BUSY_TIMEOUT', 5000)),  # millisecond(s)
+    }
+    DATABASES['default']['OPTIONS']['timeout'] = int(os.environ.get('DATABASE_BUSY_TIMEOUT', 5000)) / 1000.0
+
+if os.environ.get('DATABASE_POOL_MAX_SIZE'):
+    # Connection pool of psycopg 3 (Django 5.1+, postgresql only),
+    # pooled connections are returned to pool after each request, so persistent ones are off
+    if django.VERSION < (5, 1) or DATABASE_ENGINE != 'postgresql':
+        raise ImproperlyConfigured('DATABASE_POOL_MAX_SIZE requires postgresql on Django 5.1+, use DATABASE_CONN_MAX_AGE instead')
+    DATABASES['default']['OPTIONS']['pool'] = {
+        'min_size': int(os.environ.get('DATABASE_POOL_MIN_SIZE', 1)),
+        'max_size': int(os.environ['DATABASE_POOL_MAX_SIZE']),
+        'timeout': float(os.environ.get('DATABASE_POOL_TIMEOUT', 10)),
     }
+    DATABASES['default']['CONN_MAX_AGE'] = 0
+
+
+# Cache
+# https://docs.djangoproject.com/en/2.0/topics/cache/
+# Configured per service config with CACHE_* variables of `env` section in services/webapp.yaml
+
+CACHE_BACKENDS = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',  # per process, also stand-in for tests
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',  # LOCATION is directory
+    # LOCATION like unix:/run/memcached/memcached.sock, client is pymemcache (Django 3.2+) or python-memcached
+    'memcached': 'django.core.cache.backends.memcached.{}'.format('PyMemcacheCache' if django.VERSION >= (3, 2) else 'MemcachedCache'),
 }
 
+# Backends every worker process sees the same data of
+SHARED_CACHE_BACKENDS = ('file', 'memcached')
+
+CACHE_BACKEND = os.environ.get('CACHE_BACKEND', 'locmem')
+
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKENDS.get(CACHE_BACKEND, CACHE_BACKEND),
+        'LOCATION': os.environ.get('CACHE_LOCATION', ''),
+        'TIMEOUT': int(os.environ.get('CACHE_TIMEOUT', 300)),
+        'KEY_PREFIX': os.environ.get('CACHE_KEY_PREFIX', 'example'),
+    }
+}
+
+# Sessions of `cache` and `cached_db` backends live in cache until they expire, so cache must be shared
+# by all workers: with per-process one, logout in one worker leaves session valid in the others
+SESSION_BACKEND = os.environ.get('SESSION_BACKEND', 'db')
+
+if SESSION_BACKEND in ('cache', 'cached_db') and CACHE_BACKEND not in SHARED_CACHE_BACKENDS:
+    raise ImproperlyConfigured('SESSION_BACKEND {} requires shared CACHE_BACKEND ({}), not {}'.format(
+        SESSION_BACKEND, ', '.join(SHARED_CACHE_BACKENDS), CACHE_BACKEND))
+
+SESSION_ENGINE = 'django.contrib.sessions.backends.{}'.format(SESSION_BACKEND)
+
+
+# Celery (read by djangosite/mysite/celery.py, used by taskworker and taskplanner services)
+# Worker pool, concurrency and prefetch are set per queue in services/taskworker.yaml
+
+CELERY_BROKER_URL = os.environ.get('CELERY_BROKER_URL', 'redis://localhost:6379/0')
+
+CELERY_RESULT_BACKEND = os.environ.get('CELERY_RESULT_BACKEND') or None
+
+CELERY_TASK_DEFAULT_QUEUE = 'default'
+
+# `task.name.pattern=queue,...` rendered by service.py from `routes` of services/taskworker.yaml
+CELERY_TASK_ROUTES = {
+    pattern: {'queue': queue}
+    for pattern, __, queue in (
+        route.partition('=') for route in os.environ.get('CELERY_TASK_ROUTES', '').split(',') if route
+    )
+}
+
+# with prefetch multiplier 1 long tasks do not hold back short ones, acknowledged after run to survive worker restarts
+CELERY_TASK_ACKS_LATE = True
+
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+
+
+# Logging
+# https://docs.djangoproject.com/en/2.0/topics/logging/
+# Records are written by background thread of every process, see djangosite/mysite/logconfig.py,
+# configured per service config with `logging` section of services/*.yaml (rendered to LOG_* variables)
+
+LOGGING = logconfig.django_logging()
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -122,3 +247,13 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/2.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+# collectstatic stores content-hashed copies listed in staticfiles.json,
+# `make build` then adds .gz/.br siblings of them for gzip_static of Nginx
+if django.VERSION >= (4, 2):
+    STORAGES = {
+        'default': {'BACKEND': 'django.core.files.storage.FileSystemStorage'},
+        'staticfiles': {'BACKEND': 'djangosite.mysite.storage.HashedStaticFilesStorage'},
+    }
+else:
+    STATICFILES_STORAGE = 'djangosite.mysite.storage.HashedStaticFilesStorage'
@@ -0,0 +1,13 @@
+from django.contrib.staticfiles.storage import ManifestStaticFilesStorage
+
+
+class HashedStaticFilesStorage(ManifestStaticFilesStorage):
+    """
+    Content-hashed names (e.g. `base.3f2a9c1d7e4b.css`) which Nginx serves as immutable.
+
+    Hashed names are used whenever collectstatic has written the manifest, DEBUG notwithstanding,
+    and plain ones without it, so runserver keeps serving from app directories.
+    """
+
+    def url(self, name, force=False):
+        return super().url(name, force=force or bool(self.hashed_files))
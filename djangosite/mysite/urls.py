@@ -15,7 +15,15 @@ Including another URLconf
 """
 from django.contrib import admin
 from django.urls import path
+from django.views.i18n import JavaScriptCatalog
+
+from . import metrics, views
+from .caching import cached_view
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # same for every client and changes only with deployed translations
+    path('jsi18n/', cached_view(timeout=3600)(JavaScriptCatalog.as_view()), name='javascript-catalog'),
+    path('health/', views.health, name='health'),
+    path('metrics', metrics.metrics_view, name='metrics'),
 ]
@@ -0,0 +1,11 @@
+import os
+
+from django.http import HttpResponse
+
+
+def health(request):
+    """Lightweight readiness probe: answers as soon as worker can serve requests"""
+    response = HttpResponse('OK', content_type='text/plain')
+    # graceful reload tells workers of new master from old ones by it
+    response['X-Worker-PID'] = str(os.getpid())
+    return response
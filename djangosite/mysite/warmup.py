@@ -0,0 +1,125 @@
+"""
+Warm-up of application preloaded by gunicorn master (GUNICORN_PRELOAD, see services/gunicorn_config.py):
+parts Django builds lazily on first requests are built once before fork, so forked workers share them
+copy-on-write and serve their first requests (also after every max_requests recycle) at full speed.
+"""
+
+import os
+
+TEMPLATE_EXTENSIONS = ('.html', '.txt', '.xml')
+
+# modules of installed apps imported by views only when they run
+APP_MODULES = ('views', 'forms', 'decorators')
+
+# classes named by settings, imported on first request
+CLASS_SETTINGS = ('MESSAGE_STORAGE', 'SESSION_SERIALIZER')
+
+
+def url_patterns(resolver):
+    """Every URL pattern under resolver, importing urlconf modules and views on the way"""
+    for pattern in resolver.url_patterns:
+        if hasattr(pattern, 'url_patterns'):
+            yield from url_patterns(pattern)
+        else:
+            pattern.callback
+            yield pattern
+
+
+def namespaces(resolver, prefix=''):
+    for namespace, (__, subresolver) in resolver.namespace_dict.items():
+        yield prefix + namespace
+        yield from namespaces(subresolver, prefix + namespace + ':')
+
+
+def populate_namespaces(resolver):
+    """Reversing within namespace (e.g. `admin:index`) goes through resolver of its own, built and cached on first use"""
+    from django.urls import NoReverseMatch, reverse
+    count = 0
+    for namespace in namespaces(resolver):
+        try:
+            reverse('{}:-warm-up-'.format(namespace))
+        except NoReverseMatch:
+            count += 1
+    return count
+
+
+def import_modules():
+    from importlib import import_module
+    from django.apps import apps
+    from django.conf import settings
+    from django.utils.module_loading import import_string, module_has_submodule
+    count = 0
+    for app_config in apps.get_app_configs():
+        for name in APP_MODULES:
+            if module_has_submodule(app_config.module, name):
+                import_module('{}.{}'.format(app_config.name, name))
+                count += 1
+    for name in CLASS_SETTINGS:
+        if getattr(settings, name, None):
+            import_string(getattr(settings, name))
+            count += 1
+    import_module(settings.SESSION_ENGINE)
+    return count + 1
+
+
+def template_names(directories):
+    for directory in directories:
+        for dirpath, __, filenames in os.walk(directory):
+            for filename in filenames:
+                if filename.endswith(TEMPLATE_EXTENSIONS):
+                    yield os.path.relpath(os.path.join(dirpath, filename), directory)
+
+
+def compile_templates():
+    """Parse every template of project and apps into template cache, return (compiled, failed)"""
+    from django.forms.renderers import get_default_renderer
+    from django.template import engines
+    from django.template.utils import get_app_template_dirs
+    compiled = failed = 0
+    renderer = get_default_renderer()
+    # form widgets are rendered by engine of form renderer, not of TEMPLATES setting
+    backends = engines.all() + ([renderer.engine] if hasattr(renderer, 'engine') else [])
+    for backend in backends:
+        engine = getattr(backend, 'engine', None)
+        if engine is None:
+            continue  # not Django template language
+        engine.template_context_processors
+        directories = list(engine.dirs) + (list(get_app_template_dirs('templates')) if engine.app_dirs or engine.loaders else [])
+        for name in sorted(set(template_names(directories))):
+            try:
+                engine.get_template(name)
+                compiled += 1
+            except Exception:
+                failed += 1  # e.g. fragment of other engine or language, rendering will tell
+    return compiled, failed
+
+
+def warm_up():
+    """Build URL resolvers, load views, model metadata, translations, templates, caches
+    and static files manifest; return what was loaded"""
+    from django.apps import apps
+    from django.conf import settings
+    from django.contrib.staticfiles.storage import staticfiles_storage
+    from django.core.cache import caches
+    from django.db import connections
+    from django.urls import get_resolver
+    from django.utils import formats, translation
+
+    with translation.override(settings.LANGUAGE_CODE):
+        translation.gettext('')
+        formats.get_format('DATE_FORMAT')
+        resolver = get_resolver()
+        resolver.reverse_dict  # compiles patterns of whole tree
+        patterns = sum(1 for __ in url_patterns(resolver))
+        namespaced = populate_namespaces(resolver)
+    modules = import_modules()
+    models = apps.get_models()
+    for model in models:
+        model._meta.get_fields()
+    for alias in settings.CACHES:
+        caches[alias]
+    staticfiles_storage.base_location  # storage and its manifest are set up lazily
+    templates, failed = compile_templates()
+    # sockets must not be shared by forked workers
+    connections.close_all()
+    return {'url_patterns': patterns, 'namespaces': namespaced, 'modules': modules, 'models': len(models), 'templates': templates, 'failed_templates': failed}
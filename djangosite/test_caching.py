@@ -0,0 +1,55 @@
+import os
+
+import django
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.middleware.csrf import get_token
+from django.test import RequestFactory
+from django.utils.cache import patch_vary_headers
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangosite.mysite.settings')
+django.setup()
+
+from djangosite.mysite import caching  # noqa: E402
+
+
+def counting_view(calls, prepare=None):
+    def view(request):
+        calls.append(request.get_full_path())
+        response = HttpResponse('page {}'.format(len(calls)))
+        if prepare is not None:
+            prepare(request, response)
+        return response
+    return caching.cached_view(timeout=60)(view)
+
+
+def test_cached_view_hit_miss_and_eviction():
+    cache.clear()
+    calls = []
+    view = counting_view(calls)
+    factory = RequestFactory()
+    assert view(factory.get('/news/')).content == b'page 1'
+    assert view(factory.get('/news/')).content == b'page 1'  # hit
+    assert view(factory.get('/news/?page=2')).content == b'page 2'  # miss, query is part of key
+    assert view(factory.post('/news/')).content == b'page 3'  # not cached
+
+    caching.evict_view('/news/')
+    assert view(factory.get('/news/')).content == b'page 4'
+    assert view(factory.get('/news/?page=2')).content == b'page 2'
+    caching.evict_views()
+    assert view(factory.get('/news/?page=2')).content == b'page 5'
+    assert view(factory.get('/news/')).content == b'page 6'
+
+
+def test_cached_view_skips_per_client_responses():
+    cache.clear()
+    factory = RequestFactory()
+    for prepare in (
+            lambda request, response: get_token(request),  # rendered {% csrf_token %}
+            lambda request, response: patch_vary_headers(response, ['Cookie']),
+            lambda request, response: response.__setitem__('Cache-Control', 'private, max-age=60')):
+        calls = []
+        view = counting_view(calls, prepare)
+        view(factory.get('/form/'))
+        view(factory.get('/form/'))
+        assert len(calls) == 2
@@ -0,0 +1,49 @@
+import logging
+
+from djangosite.mysite import logconfig
+
+
+def test_shared_file_rotated_once_for_all_writers(tmp_path):
+    path = str(tmp_path / 'app.log')
+    writers = [logconfig.SharedFileHandler(path, max_bytes=100, backup_count=2) for __ in range(2)]
+    handlers = [logconfig.AsyncHandler(writer) for writer in writers]
+    loggers = []
+    for index, handler in enumerate(handlers):
+        logger = logging.getLogger('test_logconfig.{}'.format(index))
+        logger.propagate = False
+        logger.addHandler(handler)
+        loggers.append(logger)
+    for line in range(40):
+        loggers[line % 2].warning('line %02d of twenty bytes', line)
+        logconfig.flush_handlers()  # keeps order of lines of the two writers
+    for logger, handler in zip(loggers, handlers):
+        logger.removeHandler(handler)
+        handler.close()
+
+    assert sorted(p.name for p in tmp_path.iterdir()) == ['.app.log.lock', 'app.log', 'app.log.1', 'app.log.2']
+    lines = [line for name in ('app.log.2', 'app.log.1', 'app.log') for line in (tmp_path / name).read_text().splitlines()]
+    assert lines == ['line {:02d} of twenty bytes'.format(line) for line in range(40)][-len(lines):]
+
+
+def test_async_handler_drops_instead_of_blocking():
+    class Blocked(logging.Handler):
+        def __init__(self):
+            super().__init__()
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record.getMessage())
+
+    target = Blocked()
+    handler = logconfig.AsyncHandler(target, queue_size=2)
+    with target.lock:  # listener thread cannot write
+        for index in range(10):
+            handler.handle(logging.makeLogRecord({'msg': 'record %d', 'args': (index,), 'levelno': logging.INFO}))
+    handler.close()
+    assert handler.dropped >= 7
+    assert target.records[0] == 'record 0'
+
+
+def test_journal_fields_encoding():
+    assert logconfig.JournalHandler.encode({'MESSAGE': 'one\ntwo', 'PRIORITY': 6}) == (
+        b'MESSAGE\n\x07\x00\x00\x00\x00\x00\x00\x00one\ntwo\nPRIORITY=6\n')
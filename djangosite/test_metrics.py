@@ -0,0 +1,59 @@
+from djangosite.mysite import metrics
+
+
+def test_metrics_survive_worker_exit(tmp_path):
+    first = metrics.MetricsFile(str(tmp_path / '999991.db'))
+    second = metrics.MetricsFile(str(tmp_path / '999992.db'))
+    first.add_in_flight(1)
+    first.finish('GET health/', 0.003, 2, False)
+    for __ in range(3):
+        second.add_in_flight(1)  # one request still running
+    second.finish('GET health/', 0.2, 1, True)
+    second.finish('GET admin/', 20.0, 0, False)
+    first.close()
+    second.close()
+
+    metrics.mark_process_dead(999991, str(tmp_path))
+    assert not (tmp_path / '999991.db').exists()
+    totals, in_flight = metrics.aggregate(str(tmp_path))
+    assert in_flight == 1
+    health = totals['GET health/']
+    assert health[metrics.COUNT] == 2
+    assert health[metrics.QUERIES] == 3
+    assert health[metrics.ERRORS] == 1
+
+    text = metrics.render_prometheus(totals, in_flight)
+    assert 'django_http_request_duration_seconds_bucket{method="GET",route="health/",le="0.005"} 1\n' in text
+    assert 'django_http_request_duration_seconds_bucket{method="GET",route="health/",le="0.25"} 2\n' in text
+    assert 'django_http_request_duration_seconds_bucket{method="GET",route="admin/",le="10.0"} 0\n' in text
+    assert 'django_http_request_duration_seconds_count{method="GET",route="admin/"} 1\n' in text
+    assert 'django_http_requests_in_flight 1\n' in text
+
+
+def test_scrape_never_writes_worker_files(tmp_path):
+    worker = metrics.MetricsFile(str(tmp_path / '999993.db'))
+    worker.add_in_flight(1)
+    worker.finish('GET health/', 0.003, 2, False)
+    worker.map.flush()
+    before = (tmp_path / '999993.db').read_bytes()
+    # worker just created its file and has not written header yet
+    (tmp_path / '999994.db').write_bytes(b'\0' * (metrics.HEADER_SIZE + metrics.SLOT_SIZE))
+    (tmp_path / '999995.db').write_bytes(b'')
+
+    totals, in_flight = metrics.aggregate(str(tmp_path))
+    assert list(totals) == ['GET health/'] and totals['GET health/'][metrics.COUNT] == 1
+    assert (tmp_path / '999993.db').read_bytes() == before
+    assert (tmp_path / '999994.db').read_bytes() == b'\0' * (metrics.HEADER_SIZE + metrics.SLOT_SIZE)
+    assert (tmp_path / '999995.db').read_bytes() == b''
+
+    # worker goes on with its own header and slots after the scrape
+    late = metrics.MetricsFile(str(tmp_path / '999994.db'))
+    late.add_in_flight(1)
+    late.finish('GET admin/', 0.01, 0, False)
+    late.close()
+    worker.close()
+    totals, in_flight = metrics.aggregate(str(tmp_path))
+    assert totals['GET admin/'][metrics.COUNT] == 1 and in_flight == 0
+
+    metrics.mark_process_dead(999995, str(tmp_path))
+    assert not (tmp_path / '999995.db').exists()
@@ -0,0 +1,43 @@
+import os
+
+import django
+from django.db import connections
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'djangosite.mysite.settings')
+django.setup()
+
+from djangosite.mysite.db.sqlite3.base import DatabaseWrapper  # noqa: E402
+
+
+def open_database(tmp_path, **settings):
+    settings_dict = dict(connections.settings['default'], NAME=str(tmp_path / 'db.sqlite3'), **settings)
+    return DatabaseWrapper(settings_dict, alias='pragmas')
+
+
+def pragma(database, name):
+    with database.cursor() as cursor:
+        cursor.execute('PRAGMA {}'.format(name))
+        return cursor.fetchone()[0]
+
+
+def test_sqlite_pragmas_applied_on_connect(tmp_path):
+    database = open_database(tmp_path, PRAGMAS={})
+    try:
+        assert pragma(database, 'journal_mode') == 'wal'
+        assert pragma(database, 'busy_timeout') == 5000
+        assert pragma(database, 'synchronous') == 1  # NORMAL
+    finally:
+        database.close()
+
+
+def test_sqlite_pragmas_from_settings(tmp_path):
+    database = open_database(tmp_path, PRAGMAS={'busy_timeout': 250, 'synchronous': 'FULL'})
+    try:
+        assert pragma(database, 'journal_mode') == 'wal'
+        assert pragma(database, 'busy_timeout') == 250
+        assert pragma(database, 'synchronous') == 2  # FULL
+        database.close()
+        # applied again to every new connection, not just the first one
+        assert pragma(database, 'busy_timeout') == 250
+    finally:
+        database.close()
@@ -0,0 +1,382 @@
+"""Streaming statistics of nginx `combined_plus` and gunicorn access logs: latency per route, cache hit ratio, status mix"""
+
+import os
+import io
+import re
+import glob
+import gzip
+import math
+import time
+
+import servicectl
+
+GUNICORN_LOG_DIR = '/var/log/gunicorn/example'
+
+# Latency histogram buckets grow by PRECISION, so percentiles are within 1% of exact value
+# and one route never holds more than ~2200 buckets (1us..1h) whatever the log size
+PRECISION = 0.01
+SCALE = 1.0 / math.log1p(PRECISION)
+
+MAX_ROUTES = 1000
+OTHER_ROUTE = '<other>'
+MAX_CACHED_TOKENS = 100000
+MAX_PENDING = 4096
+CHUNK_SIZE = 64 * 1024 * 1024
+
+CACHE_HITS = ('HIT', 'STALE', 'UPDATING', 'REVALIDATED')
+
+ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F]{8,}|[0-9a-fA-F]{8}(-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12})$')
+
+
+def access_log_path(service, config):
+    """Path service config writes its access log to, whether it exists yet or not"""
+    if service == 'nginxsite':
+        settings, error = servicectl.load_settings(service, config)
+        if error is not None:
+            return None, error
+        return os.path.join(settings['nginx_log_dir'], '{}.access.log'.format(config)), None
+    if service == 'webapp':
+        return os.path.join(GUNICORN_LOG_DIR, '{}.{}.access.log'.format(service, config)), None
+    return None, 'Service [{}] does not write access log'.format(service)
+
+
+def expand_rotated(base):
+    """Log file with rotated copies (`.1`, `.2.gz`, `-20200101.gz`...), oldest first"""
+    rotated = [path for path in glob.glob(glob.escape(base) + '[.-]*') if os.path.isfile(path)]
+    rotated.sort(key=lambda path: os.stat(path).st_mtime)
+    return rotated + ([base] if os.path.exists(base) else [])
+
+
+def bucket_index(seconds):
+    return int(math.log1p(seconds * 1e6) * SCALE) if seconds > 0 else 0
+
+
+def bucket_value(index):
+    return math.expm1((index + 0.5) / SCALE) / 1e6
+
+
+class Histogram(dict):
+    """Log-bucketed (HDR-like) histogram of durations with bounded memory: bucket index -> count"""
+
+    def merge(self, other):
+        for index, count in other.items():
+            self[index] = self.get(index, 0) + count
+
+    def quantile(self, fraction):
+        total = sum(self.values())
+        if not total:
+            return None
+        rank = fraction * total
+        seen = 0
+        for index in sorted(self):
+            seen += self[index]
+            if seen >= rank:
+                return bucket_value(index)
+        return bucket_value(max(self))
+
+
+class RouteStats:
+
+    __slots__ = ('pending', 'latency', 'upstream', 'nginx', 'statuses', 'cache')
+
+    def __init__(self):
+        # lines are counted by raw timing text first (one dict update per line), folded into histograms by flush()
+        self.pending = {}
+        self.latency = Histogram()  # whole request: $request_time or gunicorn %(D)s
+        self.upstream = Histogram()  # $upstream_response_time
+        self.nginx = Histogram()  # $request_time minus $upstream_response_time
+        self.statuses = {}
+        self.cache = {}
+
+    @property
+    def requests(self):
+        return sum(self.statuses.values())
+
+    def flush(self, timings=None):
+        timings = timings or {}
+        for tail, count in self.pending.items():
+            latency, cache_status, upstream, nginx = timings.get(tail) or parse_timing(tail)
+            self.latency[latency] = self.latency.get(latency, 0) + count
+            if cache_status is not None:
+                self.cache[cache_status] = self.cache.get(cache_status, 0) + count
+            if upstream is not None:
+                self.upstream[upstream] = self.upstream.get(upstream, 0) + count
+                self.nginx[nginx] = self.nginx.get(nginx, 0) + count
+        self.pending.clear()
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.latency.merge(other.latency)
+        self.upstream.merge(other.upstream)
+        self.nginx.merge(other.nginx)
+        for status, count in other.statuses.items():
+            self.statuses[status] = self.statuses.get(status, 0) + count
+        for status, count in other.cache.items():
+            self.cache[status] = self.cache.get(status, 0) + count
+
+
+def normalize_route(target):
+    """`/api/users/42/?page=2` -> `/api/users/{id}/`"""
+    path = target.split(b'?', 1)[0].decode('latin-1')
+    return '/'.join('{id}' if ID_SEGMENT.match(segment) else segment for segment in path.split('/'))
+
+
+def parse_timing(tail):
+    """(latency bucket, cache status, upstream bucket, nginx bucket) from text after user agent, () if malformed"""
+    fields = tail.split()
+    try:
+        if len(fields) == 1:
+            return bucket_index(int(fields[0]) / 1e6), None, None, None
+        request_time = float(fields[0])
+        # several upstreams tried: "[0.002, 0.004]" or "[0.002 : 0.004]"
+        upstreams = [float(value) for value in re.split(rb'[ ,:]+', b' '.join(fields[2:]).strip(b'[]')) if value not in (b'', b'-')]
+    except (ValueError, IndexError):
+        return ()
+    cache_status = fields[1] if fields[1] != b'-' else None
+    if not upstreams:
+        return bucket_index(request_time), cache_status, None, None
+    upstream = sum(upstreams)
+    return bucket_index(request_time), cache_status, bucket_index(upstream), bucket_index(request_time - upstream)
+
+
+class LogStats:
+    """Accumulates access log lines of both formats:
+
+    nginx `combined_plus`: ... "$request" $status $bytes "$referer" "$ua" $request_time $cache_status [$upstream_response_time]
+    gunicorn: ... "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s
+    """
+
+    def __init__(self, max_routes=MAX_ROUTES):
+        self.max_routes = max_routes
+        self.routes = {}
+        self.lines = 0
+        self.malformed = 0
+        # distinct targets and timing tails are few (times have ms resolution), so parsing is cached
+        self._routes = {}
+        self._timings = {}
+
+    def __getstate__(self):
+        self.flush()
+        return {'max_routes': self.max_routes, 'routes': self.routes, 'lines': self.lines, 'malformed': self.malformed}
+
+    def __setstate__(self, state):
+        self.__init__(state['max_routes'])
+        self.routes, self.lines, self.malformed = state['routes'], state['lines'], state['malformed']
+
+    def route_stats(self, target):
+        route = normalize_route(target)
+        if route not in self.routes and len(self.routes) >= self.max_routes:
+            route = OTHER_ROUTE
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = RouteStats()
+        if len(self._routes) >= MAX_CACHED_TOKENS:
+            self._routes.clear()
+        self._routes[target] = stats
+        return stats
+
+    def timing(self, tail):
+        if len(self._timings) >= MAX_CACHED_TOKENS:
+            self._timings.clear()
+        timing = self._timings[tail] = parse_timing(tail)
+        return timing
+
+    def consume(self, lines):
+        routes = self._routes
+        timings = self._timings
+        count = malformed = 0
+        for line in lines:
+            count += 1
+            parts = line.split(b'"')
+            if len(parts) < 7:
+                malformed += 1
+                continue
+            request = parts[1].split(b' ', 2)
+            tail = parts[-1]
+            timing = timings.get(tail) or self.timing(tail)
+            if len(request) < 2 or not timing:
+                malformed += 1
+                continue
+            target = request[1]
+            stats = routes.get(target) or self.route_stats(target)
+            pending = stats.pending
+            seen = pending.get(tail)
+            if seen is None:
+                if len(pending) >= MAX_PENDING:
+                    stats.flush(timings)
+                pending[tail] = 1
+            else:
+                pending[tail] = seen + 1
+            status = parts[2][1:4]  # ' 200 512 '
+            statuses = stats.statuses
+            statuses[status] = statuses.get(status, 0) + 1
+        self.lines += count
+        self.malformed += malformed
+
+    def flush(self):
+        for stats in self.routes.values():
+            stats.flush(self._timings)
+
+    def merge(self, other):
+        for route, stats in other.routes.items():
+            if route not in self.routes and len(self.routes) >= self.max_routes:
+                route = OTHER_ROUTE
+            if route not in self.routes:
+                self.routes[route] = RouteStats()
+            self.routes[route].merge(stats)
+        self.lines += other.lines
+        self.malformed += other.malformed
+        self._routes.clear()
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return io.BufferedReader(gzip.open(path, 'rb'), CHUNK_SIZE // 64)
+    return io.open(path, 'rb', buffering=1024 * 1024)
+
+
+def chunk_lines(istream, start, end):
+    """Lines starting within [start, end) of plain file"""
+    position = start
+    if start:
+        istream.seek(start - 1)
+        position = start - 1 + len(istream.readline())
+    for line in istream:
+        if position >= end:
+            break
+        position += len(line)
+        yield line
+
+
+def scan_chunk(path, start, end, max_routes):
+    stats = LogStats(max_routes)
+    with open_log(path) as istream:
+        if end is None:
+            stats.consume(istream)
+        else:
+            stats.consume(chunk_lines(istream, start, end))
+    return stats
+
+
+def plan_chunks(paths):
+    """Split plain files into CHUNK_SIZE ranges aligned to lines by workers, gzipped ones are scanned whole"""
+    chunks = []
+    for path in paths:
+        if path.endswith('.gz'):
+            chunks.append((path, 0, None))
+            continue
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), CHUNK_SIZE):
+            chunks.append((path, start, min(start + CHUNK_SIZE, size)))
+    return chunks
+
+
+def scan(chunks, jobs, max_routes=MAX_ROUTES):
+    """Statistics of planned chunks, parsed by `jobs` processes in parallel"""
+    stats = LogStats(max_routes)
+    if jobs <= 1 or len(chunks) <= 1:
+        for path, start, end in chunks:
+            stats.merge(scan_chunk(path, start, end, max_routes))
+        return stats
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(min(jobs, len(chunks))) as executor:
+        futures = [executor.submit(scan_chunk, path, start, end, max_routes) for path, start, end in chunks]
+        for future in futures:
+            stats.merge(future.result())
+    return stats
+
+
+def follow(path, stats, interval, report, position=0, poll=0.2):
+    """Tail growing log (reopened after rotation, waited for while missing), call report(stats) every `interval` seconds"""
+    istream = None
+    partial = b''
+    next_report = time.monotonic() + interval
+    try:
+        while True:
+            if istream is None:
+                try:
+                    istream = io.open(path, 'rb')
+                except FileNotFoundError:
+                    if time.monotonic() >= next_report:
+                        report(stats)
+                        next_report = time.monotonic() + interval
+                    time.sleep(poll)
+                    continue
+                istream.seek(position)
+            data = istream.read(CHUNK_SIZE)
+            if data:
+                lines = (partial + data).split(b'\n')
+                partial = lines.pop()
+                stats.consume(lines)
+                continue
+            if time.monotonic() >= next_report:
+                report(stats)
+                next_report = time.monotonic() + interval
+            try:
+                rotated = os.stat(path).st_ino != os.fstat(istream.fileno()).st_ino or os.path.getsize(path) < istream.tell()
+            except FileNotFoundError:
+                rotated = False
+            if rotated:
+                istream.close()
+                istream, position, partial = None, 0, b''
+                continue
+            time.sleep(poll)
+    finally:
+        if istream is not None:
+            istream.close()
+
+
+def summarize(stats, top):
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+
+    def describe(route_stats):
+        requests = route_stats.requests
+        classes = {}
+        for status, count in route_stats.statuses.items():
+            key = '{}xx'.format(status[:1].decode('ascii', 'replace'))
+            classes[key] = classes.get(key, 0) + count
+        cached = sum(route_stats.cache.values())
+        hits = sum(count for status, count in route_stats.cache.items() if status.decode('ascii', 'replace') in CACHE_HITS)
+        return {
+            'requests': requests,
+            'p50_ms': ms(route_stats.latency.quantile(0.50)),
+            'p99_ms': ms(route_stats.latency.quantile(0.99)),
+            'upstream_p50_ms': ms(route_stats.upstream.quantile(0.50)),
+            'upstream_p99_ms': ms(route_stats.upstream.quantile(0.99)),
+            'nginx_p50_ms': ms(route_stats.nginx.quantile(0.50)),
+            'nginx_p99_ms': ms(route_stats.nginx.quantile(0.99)),
+            'cache_hit_ratio': round(hits / cached, 4) if cached else None,
+            'status': {key: round(count / requests, 4) for key, count in sorted(classes.items())} if requests else {},
+        }
+
+    total = RouteStats()
+    for route_stats in stats.routes.values():
+        total.merge(route_stats)
+    ordered = sorted(stats.routes.items(), key=lambda item: item[1].requests, reverse=True)
+    return {
+        'lines': stats.lines,
+        'malformed': stats.malformed,
+        'total': describe(total),
+        'routes': {route: describe(route_stats) for route, route_stats in ordered[:top]},
+    }
+
+
+def format_table(summary):
+    def cell(value, pattern='{:.1f}'):
+        return '-' if value is None else pattern.format(value)
+
+    header = '{:<40} {:>9} {:>8} {:>8} {:>9} {:>9} {:>8} {:>7}  {}'.format(
+        'route', 'requests', 'p50 ms', 'p99 ms', 'up p50', 'up p99', 'nginx', 'hit %', 'status')
+    lines = [header]
+    rows = [('TOTAL', summary['total'])] + list(summary['routes'].items())
+    for route, row in rows:
+        ratio = row['cache_hit_ratio']
+        lines.append('{:<40} {:>9} {:>8} {:>8} {:>9} {:>9} {:>8} {:>7}  {}'.format(
+            route if len(route) <= 40 else route[:37] + '...', row['requests'],
+            cell(row['p50_ms']), cell(row['p99_ms']), cell(row['upstream_p50_ms']), cell(row['upstream_p99_ms']),
+            cell(row['nginx_p50_ms']), cell(None if ratio is None else ratio * 100.0),
+            ' '.join('{}:{:.1f}%'.format(key, share * 100.0) for key, share in row['status'].items())))
+    lines.append('{} line(s), {} malformed'.format(summary['lines'], summary['malformed']))
+    return '\n'.join(lines)
@@ -0,0 +1,98 @@
+"""
+Precompressed `.gz` (and `.br` when brotli package is installed) siblings of collected static files,
+Nginx serves them by `gzip_static`/`brotli_static` instead of compressing on every request.
+"""
+
+import os
+import gzip
+import time
+
+# Text formats worth compressing, images and fonts (woff2) are compressed already
+EXTENSIONS = ('.css', '.js', '.mjs', '.map', '.json', '.svg', '.txt', '.html', '.xml', '.ico', '.eot', '.ttf', '.otf')
+
+MIN_SIZE = 256  # byte(s), smaller files gain nothing over headers
+MAX_RATIO = 0.95  # compressed copy is kept only when it saves at least 5%
+
+
+def brotli_module():
+    try:
+        import brotli
+    except ImportError:
+        return None
+    return brotli
+
+
+def compressible_files(root):
+    for dirpath, __, filenames in os.walk(root):
+        for filename in filenames:
+            if filename.lower().endswith(EXTENSIONS):
+                yield os.path.join(dirpath, filename)
+
+
+def up_to_date(path, sibling):
+    # siblings are stamped with mtime of their source, any other one is stale
+    try:
+        return os.stat(sibling).st_mtime_ns == os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+
+def write_sibling(path, suffix, data, compressed):
+    """Write compressed copy when it pays off, otherwise remove stale one; return its size or None"""
+    sibling = path + suffix
+    if compressed is None or len(compressed) > len(data) * MAX_RATIO:
+        if os.path.exists(sibling):
+            os.remove(sibling)
+        return None
+    temppath = '{}.{}.tmp'.format(sibling, os.getpid())
+    with open(temppath, 'wb') as ostream:
+        ostream.write(compressed)
+    stat = os.stat(path)
+    os.utime(temppath, ns=(stat.st_atime_ns, stat.st_mtime_ns))  # also not rehashed by release manifest until source changes
+    os.replace(temppath, sibling)
+    return len(compressed)
+
+
+def compress_file(path, with_brotli=True, force=False):
+    """(path, original size, gzip size or None, brotli size or None), sizes are None when skipped"""
+    brotli = brotli_module() if with_brotli else None
+    suffixes = ['.gz'] + (['.br'] if brotli is not None else [])
+    if not force and all(up_to_date(path, path + suffix) for suffix in suffixes):
+        return path, None, None, None
+    with open(path, 'rb') as istream:
+        data = istream.read()
+    if len(data) < MIN_SIZE:
+        for suffix in suffixes:
+            write_sibling(path, suffix, data, None)
+        return path, len(data), None, None
+    # mtime=0 keeps output reproducible, so unchanged file gives the same release hash
+    gzip_size = write_sibling(path, '.gz', data, gzip.compress(data, 9, mtime=0))
+    brotli_size = None
+    if brotli is not None:
+        brotli_size = write_sibling(path, '.br', data, brotli.compress(data, quality=11))
+    return path, len(data), gzip_size, brotli_size
+
+
+def compress_tree(root, jobs, with_brotli=True, force=False):
+    """Compress every file under root in `jobs` processes, return totals"""
+    started = time.perf_counter()
+    paths = sorted(compressible_files(root))
+    totals = {'files': len(paths), 'compressed': 0, 'skipped': 0, 'bytes': 0, 'gzip_bytes': 0, 'brotli_bytes': 0}
+    if jobs > 1 and len(paths) > 1:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(min(jobs, len(paths))) as executor:
+            results = list(executor.map(compress_file, paths, [with_brotli] * len(paths), [force] * len(paths), chunksize=16))
+    else:
+        results = [compress_file(path, with_brotli, force) for path in paths]
+    for __, size, gzip_size, brotli_size in results:
+        if size is None:
+            totals['skipped'] += 1
+            continue
+        totals['bytes'] += size
+        if gzip_size is not None:
+            totals['compressed'] += 1
+            totals['gzip_bytes'] += gzip_size
+        totals['brotli_bytes'] += brotli_size or 0
+    totals['brotli'] = with_brotli and brotli_module() is not None
+    totals['seconds'] = round(time.perf_counter() - started, 3)
+    return totals
@@ -0,0 +1,2233 @@
+import os
+import io
+import sys
+import json
+import copy
+import hashlib
+import socket
+import shutil
+import functools
+import threading
+import subprocess
+import tempfile
+import time
+
+# NOTE: third-party and heavy stdlib modules (click, ruamel.yaml, jinja2, concurrent.futures)
+# are imported at the place of use, so frequent short commands like `start` and `stop`
+# do not pay for imports they do not need
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+
+def print_error(*args):
+    print('ERROR:', *args, file=sys.stderr)
+
+
+CACHE_DIR = os.environ.get('SERVICE_CACHE_DIR') or os.path.join(HERE, '.cache')
+
+_descriptors = {}
+_descriptors_lock = threading.Lock()
+
+
+def trusted_cache_path(path):
+    """Whether cache file or directory may be used: owned by effective user and writable by nobody else.
+
+    Cache lives in the checkout, which may be written by other users than root running install,
+    so entries they could have written are neither read nor written.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return stat.st_uid == os.geteuid() and not stat.st_mode & 0o022
+
+
+def trusted_cache_dir(path):
+    """Create cache directory (under CACHE_DIR) when missing, return whether it and CACHE_DIR are trusted"""
+    try:
+        os.makedirs(CACHE_DIR, mode=0o755, exist_ok=True)  # intermediate directories would get default mode
+        os.makedirs(path, mode=0o755, exist_ok=True)
+    except OSError:
+        return False
+    return all(trusted_cache_path(dirpath) for dirpath in (CACHE_DIR, path))
+
+
+def store_cache_entry(path, entry):
+    try:
+        if not trusted_cache_dir(os.path.dirname(path)):
+            return
+        content = json.dumps(entry)
+        if json.loads(content) != entry:
+            return  # e.g. non-string keys or dates, which JSON would change
+        fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path))
+        with io.open(fd, 'w', encoding='utf-8') as ostream:
+            ostream.write(content)
+        os.replace(temppath, path)
+    except Exception:
+        pass  # cache is optimization only
+
+
+def load_cache_entry(path):
+    if not (trusted_cache_path(CACHE_DIR) and trusted_cache_path(os.path.dirname(path)) and trusted_cache_path(path)):
+        return None
+    try:
+        with io.open(path, encoding='utf-8') as istream:
+            entry = json.load(istream)
+    except Exception:
+        return None
+    return entry if isinstance(entry, dict) else None
+
+
+def load_descriptor(filepath):
+    """Load YAML file via in-process and on-disk cache keyed by file mtime/size and content hash"""
+    stat = os.stat(filepath)
+    key = [stat.st_mtime_ns, stat.st_size]
+    with _descriptors_lock:
+        cached = _descriptors.get(filepath)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    # descriptors are plain data, stored as JSON: loading cache entry never runs code
+    cachepath = os.path.join(CACHE_DIR, 'descriptors', '{}.json'.format(filepath.replace(os.sep, '%')))
+    entry = load_cache_entry(cachepath)
+    if entry is not None and entry.get('key') == key:
+        descriptor = entry['descriptor']
+    else:
+        with io.open(filepath, 'rb') as istream:
+            content = istream.read()
+        sha256 = hashlib.sha256(content).hexdigest()
+        if entry is not None and entry.get('sha256') == sha256:
+            descriptor = entry['descriptor']
+        else:
+            import ruamel.yaml as ryaml
+            yaml = ryaml.YAML(typ='safe')
+            descriptor = yaml.load(content.decode('utf-8'))
+        store_cache_entry(cachepath, {'key': key, 'sha256': sha256, 'descriptor': descriptor})
+    with _descriptors_lock:
+        _descriptors[filepath] = (key, descriptor)
+    return descriptor
+
+
+def load_settings(service, config):
+    service_descriptor_filepath = os.path.join(HERE, 'services', '{}.yaml'.format(service))
+    try:
+        descriptor = load_descriptor(service_descriptor_filepath)
+    except Exception as e:
+        return None, 'Failed to load descriptor for service [{}]: {}'.format(service, e)
+    else:
+        if not descriptor or 'configs' not in descriptor:
+            return None, 'Service descriptor invalid or empty'
+        if config not in descriptor['configs']:
+            return None, 'Config definition not found: {}'.format(config)
+
+        def deep_format(obj):
+            if isinstance(obj, dict):
+                return {k: deep_format(v) for k, v in obj.items()}
+            if isinstance(obj, str):
+                return obj.format(service=service, config=config)
+            return obj
+
+        settings_common = copy.deepcopy(descriptor.get('common', {}))
+        settings = deep_format(settings_common)
+        settings.update(copy.deepcopy(descriptor['configs'][config] or {}))
+        settings['SERVICE'] = service
+        settings['CONFIG'] = config
+        settings['HOME'] = HERE
+        settings['PYTHON_CMD'] = sys.executable
+        settings['LOGGING_DIR'] = '/var/log/example'
+        # settings['env']['LOG_CONFIG'] = os.path.join(os.getcwd(), 'services', 'logging', '{}.yaml'.format(settings['logconfig']))
+        env_prefix = descriptor.get('env_prefix')
+        if env_prefix:
+            settings['env'] = {'{}_{}'.format(env_prefix, k): v for k, v in settings['env'].items()}
+        return settings, None
+
+
+_template_env = None
+_template_env_lock = threading.Lock()
+
+
+def template_environment():
+    """Shared Jinja environment: templates are compiled once per process and cached on disk"""
+    global _template_env
+    import jinja2
+    with _template_env_lock:
+        if _template_env is None:
+            bytecode_cache = None
+            cachedir = os.path.join(CACHE_DIR, 'jinja2')
+            # bytecode is unmarshalled and run, so only cache nobody else could write is used
+            if trusted_cache_dir(cachedir):
+                bytecode_cache = jinja2.FileSystemBytecodeCache(cachedir)
+            loader = jinja2.FileSystemLoader(HERE)
+            _template_env = jinja2.Environment(loader=loader, bytecode_cache=bytecode_cache, undefined=jinja2.StrictUndefined)
+        return _template_env
+
+
+def render_template(localpath, context):
+    template = template_environment().get_template(localpath)
+    result = template.render(context)
+    return result
+
+
+def derive_systemd_name(service, config):
+    return 'example.{}.{}.service'.format(service, config)
+
+
+def derive_systemd_socket_name(service, config):
+    return 'example.{}.{}.socket'.format(service, config)
+
+
+# Services listening on socket held open by systemd socket unit, so it outlives restarts
+SOCKET_ACTIVATED_SERVICES = ('webapp',)
+
+
+# Services run as one systemd unit per queue listed in `queues` descriptor section
+QUEUE_SERVICES = ('taskworker',)
+
+
+def derive_queue_unit_name(service, config, queue):
+    return 'example.{}.{}.{}.service'.format(service, config, queue)
+
+
+def installed_queue_units(service, config):
+    """Queue units present in systemd directory, including ones of queues since removed from descriptor"""
+    prefix, __, suffix = derive_queue_unit_name(service, config, '\0').partition('\0')
+    try:
+        filenames = os.listdir(systemd_service_path(''))
+    except OSError:
+        return []
+    return sorted(name for name in filenames if name.startswith(prefix) and name.endswith(suffix) and '.' not in name[len(prefix):-len(suffix)])
+
+
+def derive_instance_name(service, config, instance, suffix='service'):
+    """Instance of systemd template unit, empty instance gives the template itself"""
+    return 'example.{}.{}@{}.{}'.format(service, config, instance, suffix)
+
+
+def webapp_instances(settings):
+    return int(settings.get('instances') or 1)
+
+
+def instance_socket_name(settings, instance):
+    root, ext = os.path.splitext(settings['SOCKET_NAME'])
+    return '{}@{}{}'.format(root, instance, ext)
+
+
+def webapp_socket_paths(config):
+    """Sockets of every gunicorn instance of webapp config, upstream servers of nginxsite"""
+    settings, error = load_settings('webapp', config)
+    if error is not None:
+        raise Exception(error)
+    instances = webapp_instances(settings)
+    if instances == 1:
+        return [os.path.join('/run', settings['SOCKET_NAME'])]
+    return [os.path.join('/run', instance_socket_name(settings, instance)) for instance in range(1, instances + 1)]
+
+
+def webapp_project_root(config):
+    """Path of `current` release of webapp config, root of static files served by nginxsite"""
+    settings, error = load_settings('webapp', config)
+    if error is not None:
+        raise Exception(error)
+    return os.path.join(settings['targetroot'], 'current')
+
+
+def installed_instances(service, config):
+    """Instance numbers of service template unit enabled in systemd"""
+    prefix, __, suffix = derive_instance_name(service, config, '\0').partition('\0')
+    try:
+        filenames = os.listdir(systemd_service_path('multi-user.target.wants'))
+    except OSError:
+        return []
+    names = [name[len(prefix):-len(suffix)] for name in filenames if name.startswith(prefix) and name.endswith(suffix)]
+    return sorted(int(name) for name in names if name.isdigit())
+
+
+def derive_systemd_units(service, config):
+    if service in QUEUE_SERVICES:
+        return installed_queue_units(service, config)
+    if service in SOCKET_ACTIVATED_SERVICES and os.path.exists(systemd_service_path(derive_instance_name(service, config, ''))):
+        units = []
+        for instance in installed_instances(service, config):
+            units += [derive_instance_name(service, config, instance), derive_instance_name(service, config, instance, 'socket')]
+        return units
+    units = [derive_systemd_name(service, config)]
+    if service in SOCKET_ACTIVATED_SERVICES:
+        units.append(derive_systemd_socket_name(service, config))
+    return units
+
+
+def systemd_service_path(service_name):
+    return os.path.join('/etc/systemd/system', service_name)
+
+
+def systemd_write_unit(service_name, service_def):
+    systemd_path = systemd_service_path(service_name)
+    with io.open(systemd_path, 'w', encoding='utf-8') as ostream:
+        shutil.copyfileobj(io.StringIO(service_def), ostream)
+
+
+class SystemdError(Exception):
+    """systemd refused request or its job did not complete"""
+
+
+class SystemctlBackend:
+    """systemd control by `systemctl` subprocess per batch of units, fallback when D-Bus is not available"""
+
+    def run(self, command, units=()):
+        job = subprocess.run(['systemctl', command] + list(units))
+        if job.returncode != 0:
+            raise SystemdError('systemctl {} failed: {}'.format(command, ' '.join(units)))
+
+    def daemon_reload(self):
+        self.run('daemon-reload')
+
+    def enable(self, units):
+        self.run('enable', units)
+
+    def disable(self, units):
+        self.run('disable', units)
+
+    def start(self, units):
+        self.run('start', units)
+
+    def restart(self, units):
+        self.run('restart', units)
+
+    def reload(self, units):
+        self.run('reload', units)
+
+    def stop(self, units):
+        self.run('stop', units)
+
+    def properties(self, unit, *names):
+        command = ['systemctl', 'show'] + ['--property={}'.format(name) for name in names] + [unit]
+        job = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+        return dict(line.partition('=')[::2] for line in job.stdout.splitlines())
+
+
+class DBusBackend:
+    """
+    systemd Manager API over single system bus connection (optional `jeepney` package):
+    many unit files are enabled by one call and start/stop jobs are awaited by JobRemoved signals.
+    """
+
+    PATH = '/org/freedesktop/systemd1'
+    NAME = 'org.freedesktop.systemd1'
+    MANAGER = 'org.freedesktop.systemd1.Manager'
+    # properties not of org.freedesktop.systemd1.Unit interface
+    PROPERTY_INTERFACES = {
+        'MainPID': 'org.freedesktop.systemd1.Service',
+    }
+
+    def __init__(self, timeout=300.0):
+        from jeepney import MatchRule
+        from jeepney.bus_messages import message_bus
+        from jeepney.io.blocking import open_dbus_connection
+        self.timeout = timeout
+        self.lock = threading.Lock()  # connection is shared by threads of install-all
+        self.connection = open_dbus_connection(bus='SYSTEM')
+        self.job_removed = MatchRule(type='signal', interface=self.MANAGER, member='JobRemoved', path=self.PATH)
+        self.call(message_bus.AddMatch(self.job_removed))
+        self.manager('Subscribe')
+
+    def call(self, message):
+        from jeepney.wrappers import unwrap_msg, DBusErrorResponse
+        try:
+            return unwrap_msg(self.connection.send_and_get_reply(message, timeout=self.timeout))
+        except DBusErrorResponse as e:
+            raise SystemdError('{}: {}'.format(e.name, ' '.join(map(str, e.data))))
+
+    def manager(self, method, signature=None, *args):
+        from jeepney import DBusAddress, new_method_call
+        address = DBusAddress(self.PATH, bus_name=self.NAME, interface=self.MANAGER)
+        return self.call(new_method_call(address, method, signature, args))
+
+    def daemon_reload(self):
+        with self.lock:
+            self.manager('Reload')
+
+    def enable(self, units):
+        with self.lock:
+            self.manager('EnableUnitFiles', 'asbb', list(units), False, True)
+
+    def disable(self, units):
+        with self.lock:
+            self.manager('DisableUnitFiles', 'asb', list(units), False)
+
+    def run_jobs(self, method, units):
+        """Queue job for every unit at once and wait until all of them are done"""
+        failed = []
+        with self.lock, self.connection.filter(self.job_removed, bufsize=1024) as signals:
+            # subscribed before jobs are queued, so no completion is missed
+            pending = {}
+            for unit in units:
+                job, = self.manager(method, 'ss', unit, 'replace')
+                pending[job] = unit
+            deadline = time.monotonic() + self.timeout
+            while pending:
+                try:
+                    signal = self.connection.recv_until_filtered(signals, timeout=max(deadline - time.monotonic(), 0.0))
+                except TimeoutError:
+                    raise SystemdError('{} not done within {} second(s): {}'.format(method, self.timeout, ' '.join(pending.values())))
+                __, job, unit, result = signal.body
+                if pending.pop(job, None) is not None and result != 'done':
+                    failed.append('{} ({})'.format(unit, result))
+        if failed:
+            raise SystemdError('{} failed: {}'.format(method, ', '.join(failed)))
+
+    def start(self, units):
+        self.run_jobs('StartUnit', units)
+
+    def restart(self, units):
+        self.run_jobs('RestartUnit', units)
+
+    def reload(self, units):
+        self.run_jobs('ReloadUnit', units)
+
+    def stop(self, units):
+        self.run_jobs('StopUnit', units)
+
+    def properties(self, unit, *names):
+        from jeepney import DBusAddress, Properties
+        with self.lock:
+            path, = self.manager('LoadUnit', 's', unit)
+            values = {}
+            for name in names:
+                address = DBusAddress(path, bus_name=self.NAME, interface=self.PROPERTY_INTERFACES.get(name, 'org.freedesktop.systemd1.Unit'))
+                (__, value), = self.call(Properties(address).get(name))
+                values[name] = str(value)
+        return values
+
+
+_systemd = None
+_systemd_lock = threading.Lock()
+
+
+def systemd():
+    """Backend for systemd control: D-Bus when jeepney is installed and system bus is reachable, systemctl otherwise"""
+    global _systemd
+    with _systemd_lock:
+        if _systemd is None:
+            try:
+                _systemd = DBusBackend()
+            except Exception:
+                _systemd = SystemctlBackend()
+        return _systemd
+
+
+# Readiness check defaults, overridable by `readiness` section of service descriptor
+READINESS_DEFAULTS = {
+    'deadline': 30.0,  # second(s) to wait for service to become ready
+    'settle': 0.5,  # second(s) service must stay active when there is no health probe
+    'initial_delay': 0.05,  # second(s) between first checks, doubled after each one
+    'max_delay': 1.0,  # second(s), upper bound for delay between checks
+    'http_path': None,  # health probe path requested via service unix socket
+    'probe_timeout': 1.0,  # second(s) one health probe may take, hung one is retried until deadline
+}
+
+
+def readiness_settings(settings):
+    readiness = dict(READINESS_DEFAULTS)
+    readiness.update(settings.get('readiness') or {})
+    if readiness['http_path'] and settings.get('SOCKET_NAME'):
+        readiness['socket_path'] = os.path.join('/run', settings['SOCKET_NAME'])
+    else:
+        readiness['socket_path'] = None
+    return readiness
+
+
+def probe_response(socket_path, http_path, timeout):
+    """(status code, headers with lowercase names) of probe request, None when service does not answer"""
+    request = 'GET {} HTTP/1.0\r\nHost: 127.0.0.1\r\n\r\n'.format(http_path).encode('ascii')
+    headers = {}
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(timeout)
+            sock.connect(socket_path)
+            sock.sendall(request)
+            with sock.makefile('rb') as istream:
+                status_line = istream.readline()
+                for line in iter(istream.readline, b''):
+                    name, colon, value = line.decode('latin-1').partition(':')
+                    if not colon:
+                        break
+                    headers[name.strip().lower()] = value.strip()
+    except OSError:
+        return None
+    parts = status_line.split()
+    if len(parts) < 2 or not parts[1].isdigit():
+        return None
+    return int(parts[1]), headers
+
+
+def probe_timeout(readiness, deadline, now):
+    """Timeout of one health probe, short so that probe hung on starting service does not use up whole deadline"""
+    return max(min(readiness['probe_timeout'], deadline - now), 0.1)
+
+
+def probe_http(socket_path, http_path, timeout):
+    response = probe_response(socket_path, http_path, timeout)
+    return response is not None and response[0] == 200
+
+
+def systemd_show(service_name, *properties):
+    try:
+        return systemd().properties(service_name, *properties)
+    except SystemdError:
+        return {}
+
+
+def systemd_state(service_name):
+    properties = systemd_show(service_name, 'ActiveState', 'SubState')
+    return properties.get('ActiveState'), properties.get('SubState')
+
+
+def child_pids(pid):
+    children = []
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            with io.open('/proc/{}/stat'.format(name), 'rb') as istream:
+                stat = istream.read()
+        except OSError:
+            continue
+        # process name may contain spaces, fields after it are fixed
+        fields = stat[stat.rfind(b')') + 2:].split()
+        if int(fields[1]) == pid:
+            children.append(int(name))
+    return children
+
+
+def wait_until_ready(service_name, readiness):
+    """Poll service state (and health probe if configured) with exponential backoff"""
+    started = time.monotonic()
+    deadline = started + readiness['deadline']
+    delay = readiness['initial_delay']
+    active_since = None
+    while True:
+        active_state, sub_state = systemd_state(service_name)
+        now = time.monotonic()
+        if active_state == 'failed' or sub_state == 'auto-restart':
+            return None, 'Service failed on startup: {}'.format(service_name)
+        if active_state == 'active':
+            if readiness['socket_path']:
+                timeout = probe_timeout(readiness, deadline, now)
+                if probe_http(readiness['socket_path'], readiness['http_path'], timeout):
+                    return now - started, None
+            else:
+                if active_since is None:
+                    active_since = now
+                if now - active_since >= readiness['settle']:
+                    return now - started, None
+        else:
+            active_since = None
+        now = time.monotonic()
+        if now >= deadline:
+            return None, 'Service not ready within {} second(s): {}'.format(readiness['deadline'], service_name)
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, readiness['max_delay'])
+
+
+def systemd_start(service_name, readiness, socket_name=None):
+    try:
+        if socket_name is not None:
+            # listening socket is opened by systemd and queues connections while service restarts
+            systemd().start([socket_name])
+        systemd().restart([service_name])
+    except SystemdError as e:
+        return None, 'Failed to start service {}: {}'.format(service_name, e)
+    elapsed, error = wait_until_ready(service_name, readiness)
+    if error is not None:
+        # TODO: inconsistent behavior: service remains enabled
+        try:
+            systemd().stop([service_name])
+        except SystemdError:
+            pass
+        return None, error
+    return elapsed, None
+
+
+def pid_exists(pid):
+    """Whether process runs, exited one waiting to be reaped (zombie) does not"""
+    try:
+        with io.open('/proc/{}/stat'.format(pid), 'rb') as istream:
+            stat = istream.read()
+    except OSError:
+        return False
+    return stat[stat.rfind(b')') + 2:].split()[0] != b'Z'
+
+
+def read_pidfile(path):
+    try:
+        with io.open(path, encoding='ascii') as istream:
+            return int(istream.read().strip() or 0) or None
+    except (OSError, ValueError):
+        return None
+
+
+def notify_main_pid(pid):
+    """Make systemd track pid as main process of its service (unit needs NotifyAccess=all).
+
+    Message is sent on behalf of pid itself, which is what systemd checks against the unit, this needs root.
+    """
+    import struct
+    message = 'MAINPID={}'.format(pid).encode('ascii')
+    credentials = struct.pack('iII', pid, os.getuid(), os.getgid())
+    with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+        sock.sendmsg([message], [(socket.SOL_SOCKET, socket.SCM_CREDENTIALS, credentials)], 0, '/run/systemd/notify')
+
+
+def wait_for_new_master(pidfile, readiness, deadline):
+    """Pid of master started by USR2 once one of its workers answers health probe (or they stay up), None on timeout"""
+    delay = readiness['initial_delay']
+    active_since = None
+    while True:
+        now = time.monotonic()
+        new_pid = read_pidfile(pidfile)
+        workers = set(child_pids(new_pid)) if new_pid and pid_exists(new_pid) else set()
+        if workers and readiness['socket_path']:
+            # old workers keep accepting on the same socket, so only answer of new one counts,
+            # several probes in a row give new workers their share of connections
+            for __ in range(4 * len(workers)):
+                timeout = probe_timeout(readiness, deadline, time.monotonic())
+                response = probe_response(readiness['socket_path'], readiness['http_path'], timeout)
+                if response is None or response[0] != 200:
+                    break
+                if int(response[1].get('x-worker-pid') or 0) in workers:
+                    return new_pid
+        elif workers:
+            if active_since is None:
+                active_since = now
+            if now - active_since >= readiness['settle']:
+                return new_pid
+        else:
+            active_since = None
+        now = time.monotonic()
+        if now >= deadline:
+            return None
+        time.sleep(min(delay, deadline - now))
+        delay = min(delay * 2, readiness['max_delay'])
+
+
+def systemd_graceful_reload(service_name, readiness):
+    """Re-exec gunicorn master by USR2 and switch to it once its workers are ready.
+
+    New master (running current code) starts own workers on the same listening socket next to old ones.
+    When one of them answers health probe, new master becomes main process of the unit and old master
+    stops gracefully by TERM; otherwise new master is stopped and old one keeps serving.
+    """
+    import signal
+    started = time.monotonic()
+    deadline = started + readiness['deadline']
+    main_pid = int(systemd_show(service_name, 'MainPID').get('MainPID') or 0)
+    if not main_pid:
+        return None, 'Service is not running: {}'.format(service_name)
+    # gunicorn writes pidfile of re-executed master with .2 suffix while old one exists
+    new_pidfile = readiness['pidfile'] + '.2'
+    try:
+        os.kill(main_pid, signal.SIGUSR2)
+    except OSError as e:
+        return None, 'Failed to reload service {}: {}'.format(service_name, e)
+    new_pid = wait_for_new_master(new_pidfile, readiness, deadline)
+    if new_pid is None:
+        new_pid = read_pidfile(new_pidfile)
+        if new_pid and new_pid != main_pid and pid_exists(new_pid):
+            os.kill(new_pid, signal.SIGTERM)
+        return None, 'New master not ready within {} second(s), old one keeps serving: {}'.format(readiness['deadline'], service_name)
+    try:
+        notify_main_pid(new_pid)
+    except OSError as e:
+        os.kill(new_pid, signal.SIGTERM)
+        return None, 'Failed to hand service {} over to new master: {}'.format(service_name, e)
+    elapsed = time.monotonic() - started
+    # old workers finish requests in flight, new master then takes over pidfile and accepts next USR2
+    os.kill(main_pid, signal.SIGTERM)
+    deadline = time.monotonic() + readiness['deadline']
+    while pid_exists(main_pid) and time.monotonic() < deadline:
+        time.sleep(readiness['initial_delay'])
+    if pid_exists(main_pid):
+        return None, 'Old master {} of service {} did not stop within {} second(s)'.format(main_pid, service_name, readiness['deadline'])
+    return elapsed, None
+
+
+def systemd_stop(*service_names):
+    try:
+        systemd().stop(service_names)
+    except SystemdError as e:
+        return None, 'Failed to stop service: {}'.format(e)
+    return None, None
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with io.open(path, 'rb') as istream:
+        for chunk in iter(functools.partial(istream.read, 1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with io.open(path, encoding='utf-8') as istream:
+            return json.load(istream)
+    except (OSError, ValueError):
+        return {}
+
+
+def build_manifest(srcdir, previous):
+    """Map relative path of every file under srcdir to its content hash.
+
+    Files with size and mtime unchanged since previous manifest are not rehashed.
+    """
+    manifest = {}
+    for dirpath, __, filenames in os.walk(srcdir):
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            relpath = os.path.relpath(path, srcdir)
+            stat = os.stat(path)
+            known = previous.get(relpath)
+            if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+                sha256 = known['sha256']
+            else:
+                sha256 = file_digest(path)
+            manifest[relpath] = {'sha256': sha256, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+    return manifest
+
+
+def derive_release_id(manifest):
+    digest = hashlib.sha256()
+    for relpath in sorted(manifest):
+        digest.update('{}\0{}\n'.format(relpath, manifest[relpath]['sha256']).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def current_release(targetroot):
+    link = os.path.join(targetroot, 'current')
+    if not os.path.islink(link):
+        return None
+    return os.path.basename(os.readlink(link))
+
+
+def switch_release(targetroot, release_id):
+    """Atomically point `current` symlink to given release (or remove it)"""
+    link = os.path.join(targetroot, 'current')
+    if release_id is None:
+        if os.path.islink(link):
+            os.remove(link)
+        return
+    templink = os.path.join(targetroot, '.current.tmp')
+    if os.path.lexists(templink):
+        os.remove(templink)
+    os.symlink(os.path.join('releases', release_id), templink)
+    os.replace(templink, link)
+
+
+def prune_releases(releasesdir, keep):
+    releases = [name for name in os.listdir(releasesdir) if os.path.isdir(os.path.join(releasesdir, name)) and not name.startswith('.')]
+    releases.sort(key=lambda name: os.path.getmtime(os.path.join(releasesdir, name)), reverse=True)
+    for name in releases[keep:]:
+        shutil.rmtree(os.path.join(releasesdir, name), ignore_errors=True)
+        manifestpath = os.path.join(releasesdir, '{}.manifest.json'.format(name))
+        if os.path.exists(manifestpath):
+            os.remove(manifestpath)
+
+
+def missing_release_source(srcdir):
+    if not os.path.isdir(srcdir):
+        return 'Source directory not exists: {} (run `make build` first)'.format(srcdir)
+    return None
+
+
+def plan_release(srcdir, targetroot):
+    """(current release id, release id srcdir would be deployed as) without writing anything"""
+    error = missing_release_source(srcdir)
+    if error is not None:
+        return None, error
+    previous_id = current_release(targetroot)
+    previous = {}
+    if previous_id is not None:
+        previous = load_manifest(os.path.join(targetroot, 'releases', '{}.manifest.json'.format(previous_id)))
+    return (previous_id, derive_release_id(build_manifest(srcdir, previous))), None
+
+
+def deploy_files(srcdir, targetroot, keep_releases=3):
+    """Deploy srcdir as new release under targetroot and switch `current` symlink to it.
+
+    Files unchanged since current release are hard-linked, only changed ones are copied.
+    Returns (previous_release_id, release_id) so caller is able to switch back.
+    """
+    error = missing_release_source(srcdir)
+    if error is not None:
+        return None, error
+    releasesdir = os.path.join(targetroot, 'releases')
+    try:
+        ensure_dir_exists(releasesdir)
+        previous_id = current_release(targetroot)
+        previous_dir = None
+        previous = {}
+        if previous_id is not None:
+            previous_dir = os.path.join(releasesdir, previous_id)
+            previous = load_manifest(os.path.join(releasesdir, '{}.manifest.json'.format(previous_id)))
+        manifest = build_manifest(srcdir, previous)
+        release_id = derive_release_id(manifest)
+        release_dir = os.path.join(releasesdir, release_id)
+        if not os.path.isdir(release_dir):
+            tempdir = tempfile.mkdtemp(prefix='.{}.'.format(release_id), dir=releasesdir)
+            try:
+                for relpath, entry in manifest.items():
+                    dst = os.path.join(tempdir, relpath)
+                    ensure_dir_exists(os.path.dirname(dst))
+                    known = previous.get(relpath)
+                    if known and known['sha256'] == entry['sha256']:
+                        try:
+                            os.link(os.path.join(previous_dir, relpath), dst)
+                            continue
+                        except OSError:
+                            pass
+                    shutil.copy2(os.path.join(srcdir, relpath), dst)
+                os.chmod(tempdir, 0o755)
+                with io.open(os.path.join(releasesdir, '{}.manifest.json'.format(release_id)), 'w', encoding='utf-8') as ostream:
+                    json.dump(manifest, ostream, indent=1, sort_keys=True)
+                os.rename(tempdir, release_dir)
+            except Exception:
+                shutil.rmtree(tempdir, ignore_errors=True)
+                raise
+        else:
+            os.utime(release_dir)
+        if release_id != previous_id:
+            switch_release(targetroot, release_id)
+        prune_releases(releasesdir, max(keep_releases, 2))
+    except Exception as e:
+        return None, 'Failed to deploy files: {}'.format(e)
+    return (previous_id, release_id), None
+
+
+def ensure_dir_exists(path):
+    os.makedirs(path, exist_ok=True)
+    if not os.path.isdir(path):
+        raise Exception('Target path is not directory: {}'.format(path))
+
+
+NGINX_ROOT = '/etc/nginx'
+
+
+def nginx_site_paths(config):
+    return [
+        'sites-available/{}.conf'.format(config),
+        'sites-enabled/{}.conf'.format(config),
+        'includes/{}'.format(config),
+        'certs/{}'.format(config),
+    ]
+
+
+def snapshot_files(root, relpaths, with_data=True):
+    """Map every file, directory and symlink under given paths to its type, mode and content hash"""
+    snapshot = {}
+
+    def record(relpath):
+        path = os.path.join(root, relpath)
+        if os.path.islink(path):
+            snapshot[relpath] = {'type': 'symlink', 'target': os.readlink(path)}
+        elif os.path.isdir(path):
+            snapshot[relpath] = {'type': 'dir', 'mode': os.stat(path).st_mode & 0o7777}
+            for name in os.listdir(path):
+                record(os.path.join(relpath, name))
+        elif os.path.exists(path):
+            with io.open(path, 'rb') as istream:
+                data = istream.read()
+            entry = {'type': 'file', 'mode': os.stat(path).st_mode & 0o7777, 'sha256': hashlib.sha256(data).hexdigest()}
+            if with_data:
+                entry['data'] = data
+            snapshot[relpath] = entry
+
+    for relpath in relpaths:
+        record(relpath)
+    return snapshot
+
+
+def restore_files(root, relpaths, snapshot):
+    """Bring given paths back to snapshot state rewriting only entries which differ"""
+    current = snapshot_files(root, relpaths, with_data=False)
+    for relpath in sorted(set(current) - set(snapshot), reverse=True):
+        path = os.path.join(root, relpath)
+        if current[relpath]['type'] == 'dir':
+            shutil.rmtree(path, ignore_errors=True)
+        elif os.path.lexists(path):
+            os.remove(path)
+    for relpath in sorted(snapshot):
+        entry = snapshot[relpath]
+        present = current.get(relpath)
+        if present is not None and present == {k: v for k, v in entry.items() if k != 'data'}:
+            continue
+        path = os.path.join(root, relpath)
+        if present is not None and present['type'] != entry['type']:
+            if present['type'] == 'dir':
+                shutil.rmtree(path)
+            else:
+                os.remove(path)
+        if entry['type'] == 'dir':
+            os.makedirs(path, exist_ok=True)
+            os.chmod(path, entry['mode'])
+        elif entry['type'] == 'symlink':
+            if os.path.lexists(path):
+                os.remove(path)
+            os.symlink(entry['target'], path)
+        else:
+            fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path))
+            with io.open(fd, 'wb') as ostream:
+                ostream.write(entry['data'])
+            os.chmod(temppath, entry['mode'])
+            os.replace(temppath, path)
+
+
+def render_nginx_site(config, settings):
+    """{path relative to NGINX_ROOT: (content, mode)} of site config, its includes and certs"""
+    files = {}
+    for filename in settings.get('certs', []) or []:
+        src = os.path.join(HERE, 'nginxsite', 'certs', filename)
+        with io.open(src, encoding='utf-8') as istream:
+            # private keys are readable by root (Nginx master) only
+            mode = 0o600 if filename.endswith('.key') else os.stat(src).st_mode & 0o777
+            files[os.path.join('certs', config, filename)] = (istream.read(), mode)
+    for filename in settings.get('includes', []) or []:
+        files[os.path.join('includes', config, filename)] = (render_template(os.path.join('nginxsite', 'includes', filename), settings), None)
+    siteconf = os.path.join('sites-available', '{}.conf'.format(config))
+    files[siteconf] = (render_template(os.path.join('nginxsite', '{}.conf'.format(config)), settings), None)
+    return files
+
+
+TICKET_KEY_SIZE = 80  # AES-256 session ticket key of Nginx 1.11.8+
+
+
+def ticket_key_paths(config, count):
+    """Session ticket keys of site config, the first one encrypts new tickets, all of them decrypt"""
+    return [os.path.join(NGINX_ROOT, 'certs', config, 'tickets', '{}.key'.format(index)) for index in range(count)]
+
+
+def write_ticket_key(path):
+    ensure_dir_exists(os.path.dirname(path))
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}.'.format(os.path.basename(path)))
+    with io.open(fd, 'wb') as ostream:
+        ostream.write(os.urandom(TICKET_KEY_SIZE))
+    os.replace(temppath, path)  # mkstemp creates it readable by owner only
+
+
+def stage_ticket_keys(batch, config, settings):
+    """Create missing session ticket keys, existing ones are left to rotate_ticket_keys"""
+    tls = settings.get('tls') or {}
+    if not tls or not tls.get('session_tickets', True):
+        return False
+    changed = False
+    for path in ticket_key_paths(config, tls.get('ticket_keys', 3)):
+        if os.path.exists(path):
+            continue
+        changed = True
+        batch.update(changes=(path, None, '<{} random bytes>'.format(TICKET_KEY_SIZE)))
+        if not batch.dry_run:
+            batch.update(undo=functools.partial(os.remove, path))
+            write_ticket_key(path)
+    return changed
+
+
+def rotate_ticket_keys(config):
+    """Shift session ticket keys by one and put new key first: tickets issued with previous keys stay valid until the oldest one is dropped"""
+    settings, error = load_settings('nginxsite', config)
+    if error is not None:
+        return None, error
+    tls = settings.get('tls') or {}
+    if not tls or not tls.get('session_tickets', True):
+        return None, 'Session tickets are not enabled for nginxsite config [{}]'.format(config)
+    paths = ticket_key_paths(config, tls.get('ticket_keys', 3))
+    if not all(os.path.exists(path) for path in paths):
+        return None, 'Session ticket keys are not installed, install nginxsite config [{}] first'.format(config)
+    try:
+        for older, newer in zip(reversed(paths), reversed(paths[:-1])):
+            os.replace(newer, older)
+        write_ticket_key(paths[0])
+        test_nginx_config()
+        reload_nginx_config()
+    except Exception as e:
+        return None, 'Failed to rotate session ticket keys: {}'.format(e)
+    return len(paths), None
+
+
+def stage_nginx_site(batch, config, settings):
+    """Write changed site files only, so unchanged site does not reload nginx"""
+    changed = False
+    for relpath, (content, mode) in sorted(render_nginx_site(config, settings).items()):
+        changed = stage_file(batch, os.path.join(NGINX_ROOT, relpath), content, mode) or changed
+    changed = stage_ticket_keys(batch, config, settings) or changed
+    siteconf_dst = os.path.join(NGINX_ROOT, 'sites-available', '{}.conf'.format(config))
+    changed = stage_symlink(batch, os.path.join(NGINX_ROOT, 'sites-enabled', os.path.basename(siteconf_dst)), siteconf_dst) or changed
+    if not batch.dry_run:
+        for dirpath in settings.get('mkdirs', []) or []:
+            ensure_dir_exists(dirpath)
+    if changed:
+        batch.update(nginx_changed=True)
+
+
+def uninstall_nginx_files(config, settings):
+    targetroot = NGINX_ROOT
+    targetincludes = os.path.join(targetroot, 'includes', config)
+    targetcerts = os.path.join(targetroot, 'certs', config)
+    siteconf_dst = os.path.join(targetroot, 'sites-available', '{}.conf'.format(config))
+    siteconf_linkname = os.path.join(targetroot, 'sites-enabled', os.path.basename(siteconf_dst))
+    if os.path.exists(siteconf_linkname):
+        os.remove(siteconf_linkname)
+    if os.path.exists(siteconf_dst):
+        os.remove(siteconf_dst)
+    if os.path.exists(targetincludes):
+        shutil.rmtree(targetincludes)
+    if os.path.exists(targetcerts):
+        shutil.rmtree(targetcerts)
+
+
+def test_nginx_config():
+    command = 'nginx -t'
+    subprocess.run(command.split(), check=True)
+
+
+def reload_nginx_config():
+    command = 'nginx -s reload'
+    subprocess.run(command.split(), check=True)
+
+
+SYSTEMD_SERVICES = ('webapp', 'taskplanner', 'taskworker')
+
+# Services which must be installed before the given one (and removed after it)
+SERVICE_DEPENDENCIES = {
+    'nginxsite': ('nginxmain',),
+}
+
+
+def reverse_dependencies(dependencies):
+    reversed_dependencies = {}
+    for service, requires in dependencies.items():
+        for required in requires:
+            reversed_dependencies.setdefault(required, []).append(service)
+    return reversed_dependencies
+
+
+class Batch:
+    """Collects side effects of several services to apply them once at the end"""
+
+    def __init__(self, dry_run=False):
+        self.lock = threading.Lock()
+        self.dry_run = dry_run  # only collect changes, nothing is written (see `plan` command)
+        self.nginx_changed = False
+        self.systemd_changed = False
+        self.enable = []
+        self.disable = []
+        self.remove = []
+        self.undo = []
+        self.changes = []  # (path, installed content or None, new content or None)
+
+    def update(self, **kwargs):
+        with self.lock:
+            for name, value in kwargs.items():
+                current = getattr(self, name)
+                if isinstance(current, list):
+                    current.append(value)
+                else:
+                    setattr(self, name, value)
+
+
+# Installed file exists but current user may not read it (e.g. private key when planning as non-root)
+UNREADABLE = '<unknown (unreadable)>'
+
+
+def read_installed(path):
+    """Content of installed text file, symlink as `-> target`, None when there is none, UNREADABLE when it is not readable"""
+    if os.path.islink(path):
+        return '-> {}'.format(os.readlink(path))
+    try:
+        with io.open(path, encoding='utf-8') as istream:
+            return istream.read()
+    except (FileNotFoundError, NotADirectoryError):
+        return None
+    except PermissionError:
+        return UNREADABLE
+
+
+def is_secret(path, mode=None):
+    """Private keys and files readable by owner only"""
+    if path.endswith('.key') or (mode is not None and not mode & 0o077):
+        return True
+    try:
+        return not os.stat(path).st_mode & 0o077
+    except OSError:
+        return False
+
+
+def secret_placeholder(content):
+    """What plan shows instead of secret content: its digest only, never the content itself"""
+    if content is None or content is UNREADABLE:
+        return content
+    return '<secret, sha256 {}>'.format(content_digest(content))
+
+
+def stage_file(batch, path, content, mode=None):
+    """Write file when installed one differs, content None removes it; return whether it changes"""
+    previous = read_installed(path)
+    if previous == content:
+        return False
+    if is_secret(path, mode):
+        batch.update(changes=(path, secret_placeholder(previous), secret_placeholder(content)))
+    else:
+        batch.update(changes=(path, previous, content))
+    if batch.dry_run:
+        return True
+    if previous is UNREADABLE:
+        raise Exception('Cannot read installed {}, it could not be restored on failure'.format(path))
+    previous_mode = os.stat(path).st_mode & 0o7777 if previous is not None else None
+
+    def undo():
+        if previous is None:
+            if os.path.exists(path):
+                os.remove(path)
+        else:
+            write_file(path, previous, previous_mode)
+
+    batch.update(undo=undo)
+    if content is None:
+        os.remove(path)
+    else:
+        write_file(path, content, mode)
+    return True
+
+
+def write_file(path, content, mode=None):
+    """Replace file atomically, so readers never see it half-written"""
+    ensure_dir_exists(os.path.dirname(path))
+    fd, temppath = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.{}.'.format(os.path.basename(path)))
+    try:
+        with io.open(fd, 'w', encoding='utf-8') as ostream:
+            ostream.write(content)
+        os.chmod(temppath, 0o644 if mode is None else mode)
+        os.replace(temppath, path)
+    except Exception:
+        os.remove(temppath)
+        raise
+
+
+def stage_symlink(batch, path, target):
+    """Point symlink to target unless it already does; return whether it changes"""
+    previous = read_installed(path)
+    if previous == '-> {}'.format(target):
+        return False
+    batch.update(changes=(path, previous, '-> {}'.format(target)))
+    if batch.dry_run:
+        return True
+    previous_target = os.readlink(path) if os.path.islink(path) else None
+
+    def undo():
+        if os.path.lexists(path):
+            os.remove(path)
+        if previous_target is not None:
+            os.symlink(previous_target, path)
+
+    batch.update(undo=undo)
+    if os.path.lexists(path):
+        os.remove(path)
+    ensure_dir_exists(os.path.dirname(path))
+    os.symlink(target, path)
+    return True
+
+
+# Targets units are enabled for (WantedBy of templates in services/templates)
+WANTED_BY_TARGETS = ('multi-user.target', 'sockets.target')
+
+
+def unit_enabled(unit_name):
+    return any(os.path.lexists(systemd_service_path(os.path.join('{}.wants'.format(target), unit_name))) for target in WANTED_BY_TARGETS)
+
+
+def stage_unit_install(batch, service_name, service_def, instances=None):
+    """Write unit file and enable it, or given instances of it when it is template; unchanged enabled unit is left alone"""
+    enable = [service_name] if instances is None else instances
+    systemd_path = systemd_service_path(service_name)
+    existed = os.path.exists(systemd_path)
+    changed = stage_file(batch, systemd_path, service_def)
+    if changed:
+        batch.update(systemd_changed=True)
+        if not existed and not batch.dry_run:
+            # runs before file removal on rollback
+            batch.update(undo=lambda: systemd().disable(enable))
+    for unit_name in enable:
+        if changed or not unit_enabled(unit_name):
+            batch.update(enable=unit_name)
+
+
+def stage_unit_uninstall(batch, service_name, instances=None, keep_file=False):
+    """Stop, disable and remove unit (or given instances of it when it is template)"""
+    disable = [service_name] if instances is None else instances
+    systemd_path = systemd_service_path(service_name)
+    if not os.path.exists(systemd_path):
+        return
+    with io.open(systemd_path, encoding='utf-8') as istream:
+        previous_def = istream.read()
+
+    def undo():
+        if not os.path.exists(systemd_path):
+            systemd_write_unit(service_name, previous_def)
+            systemd().daemon_reload()
+        systemd().enable(disable)
+
+    batch.update(undo=undo)
+    batch.update(systemd_changed=True)
+    for unit_name in disable:
+        batch.update(disable=unit_name)
+    if not keep_file:
+        batch.update(remove=systemd_path)
+        batch.update(changes=(systemd_path, previous_def, None))
+
+
+def stage_unit_dropin(batch, unit_name, dropin_name, content):
+    """Write drop-in overriding unit settings, content None removes it"""
+    dropin_path = os.path.join(systemd_service_path('{}.d'.format(unit_name)), dropin_name)
+    if stage_file(batch, dropin_path, content):
+        batch.update(systemd_changed=True)
+
+
+# Options of `gunicorn` descriptor section passed to services/gunicorn_config.py
+GUNICORN_OPTIONS = (
+    'workers', 'max_workers', 'worker_class', 'threads', 'worker_connections',
+    'keepalive', 'backlog', 'timeout', 'graceful_timeout', 'max_requests', 'max_requests_jitter', 'preload',
+)
+
+
+def gunicorn_environment(options):
+    unknown = set(options) - set(GUNICORN_OPTIONS)
+    if unknown:
+        raise Exception('Unknown gunicorn option(s): {}'.format(', '.join(sorted(unknown))))
+    return {'GUNICORN_{}'.format(name.upper()): value for name, value in options.items()}
+
+
+# Options of `logging` section of service descriptor passed to djangosite/mysite/logconfig.py as LOG_* variables
+LOGGING_OPTIONS = (
+    'level', 'output', 'file', 'max_bytes', 'when', 'backup_count', 'socket', 'queue_size', 'access_sample',
+)
+
+LOG_OUTPUTS = ('stream', 'file', 'journald', 'datagram')
+
+
+def logging_environment(options, settings):
+    unknown = set(options) - set(LOGGING_OPTIONS)
+    if unknown:
+        raise Exception('Unknown logging option(s): {}'.format(', '.join(sorted(unknown))))
+    output = options.get('output') or 'stream'
+    if output not in LOG_OUTPUTS:
+        raise Exception('Unknown logging output: {} (expected one of {})'.format(output, ', '.join(LOG_OUTPUTS)))
+    if options.get('when') not in (None, 'H', 'D', 'W'):
+        raise Exception('Unknown logging rotation interval: {} (expected H, D or W)'.format(options['when']))
+    if not 0 < float(options.get('access_sample', 1)) <= 1:
+        raise Exception('Logging access_sample must be in (0, 1]: {}'.format(options['access_sample']))
+    env = {'LOG_{}'.format(name.upper()): value for name, value in options.items() if value is not None}
+    if output == 'file':
+        env.setdefault('LOG_FILE', os.path.join(settings['LOGGING_DIR'], '{}.{}.app.log'.format(settings['SERVICE'], settings['CONFIG'])))
+    env.setdefault('LOG_IDENTIFIER', 'example.{}.{}'.format(settings['SERVICE'], settings['CONFIG']))
+    return env
+
+
+# Options of `celery` section of taskworker descriptor, every entry of `queues` may override them
+CELERY_WORKER_DEFAULTS = {
+    'pool': 'prefork',  # prefork, threads, gevent, eventlet, solo
+    'concurrency': None,  # default: sized by CPUs and memory, see celery_concurrency()
+    'autoscale': None,  # {'min': N, 'max': M} instead of fixed concurrency
+    'prefetch_multiplier': 1,  # tasks reserved per pool process
+    'max_tasks_per_child': None,  # prefork child is replaced after this many tasks
+    'max_memory_per_child': None,  # KiB, prefork child is replaced above this RSS, also caps derived concurrency
+    'loglevel': 'INFO',
+    'stop_timeout': 60,  # second(s) given to running tasks on stop (warm shutdown)
+}
+
+# Options of `celery` section of taskplanner descriptor
+CELERY_BEAT_DEFAULTS = {
+    'max_interval': 60,  # second(s) between schedule checks at most
+    'loglevel': 'INFO',
+    'stop_timeout': 10,
+}
+
+# Pool size per CPU of pools which do not run tasks in parallel processes
+CELERY_POOL_CPU_FACTORS = {
+    'threads': 4,
+    'gevent': 50,
+    'eventlet': 50,
+}
+
+
+def celery_options(defaults, *sections):
+    options = dict(defaults)
+    for section in sections:
+        unknown = set(section or {}) - set(defaults)
+        if unknown:
+            raise Exception('Unknown celery option(s): {}'.format(', '.join(sorted(unknown))))
+        options.update(section or {})
+    return options
+
+
+def celery_queue_options(settings):
+    """Options of every queue worker: `celery` section overridden by queue entry of `queues` section"""
+    queues = settings.get('queues') or {'default': None}
+    for queue in queues:
+        if not queue.replace('-', '').replace('_', '').isalnum():
+            raise Exception('Queue name must be alphanumeric (dashes and underscores allowed): {}'.format(queue))
+    return {queue: celery_options(CELERY_WORKER_DEFAULTS, settings.get('celery'), overrides) for queue, overrides in queues.items()}
+
+
+def host_resources():
+    """(CPUs available to this process, total memory in KiB or None)"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    memory_kib = None
+    try:
+        with io.open('/proc/meminfo', encoding='ascii') as istream:
+            for line in istream:
+                if line.startswith('MemTotal:'):
+                    memory_kib = int(line.split()[1])
+                    break
+    except (OSError, ValueError):
+        pass
+    return cpus, memory_kib
+
+
+# systemd resource control directives accepted in `resources` section of service descriptor
+RESOURCE_OPTIONS = ('CPUQuota', 'CPUWeight', 'AllowedCPUs', 'MemoryHigh', 'MemoryMax', 'IOWeight', 'LimitNOFILE', 'Nice')
+
+MEMORY_UNITS = {'K': 1, 'M': 1024, 'G': 1024 ** 2, 'T': 1024 ** 3}
+
+
+def host_nr_open():
+    """Largest LimitNOFILE kernel accepts"""
+    try:
+        with io.open('/proc/sys/fs/nr_open', encoding='ascii') as istream:
+            return int(istream.read())
+    except (OSError, ValueError):
+        return 1048576
+
+
+def parse_memory_kib(value, memory_kib):
+    """`512M`, `2G`, `50%` (of host memory) or bytes -> KiB, `infinity` -> None"""
+    text = str(value).strip().upper()
+    if text == 'INFINITY':
+        return None
+    if text.endswith('%'):
+        if memory_kib is None:
+            raise Exception('Host memory is unknown, use absolute value instead of {}'.format(value))
+        return int(memory_kib * float(text[:-1]) / 100)
+    if text[-1:] in MEMORY_UNITS:
+        return int(float(text[:-1]) * MEMORY_UNITS[text[-1]])
+    return int(text) // 1024
+
+
+def parse_cpu_quota(value):
+    """`150%` or CPU count 1.5 -> percent of one CPU"""
+    text = str(value).strip()
+    return float(text[:-1]) if text.endswith('%') else float(text) * 100
+
+
+def resource_directives(resources, cpus=None, memory_kib=None, nr_open=None):
+    """Unit directives of `resources` section, checked against host CPUs, memory and open files limit"""
+    resources = resources or {}
+    unknown = set(resources) - set(RESOURCE_OPTIONS)
+    if unknown:
+        raise Exception('Unknown resource option(s): {}'.format(', '.join(sorted(unknown))))
+    if cpus is None:
+        try:
+            cpus = sorted(os.sched_getaffinity(0))
+        except AttributeError:
+            cpus = list(range(os.cpu_count() or 1))
+    if memory_kib is None:
+        memory_kib = host_resources()[1]
+    directives = []
+    if resources.get('CPUQuota') is not None:
+        quota = parse_cpu_quota(resources['CPUQuota'])
+        if not 0 < quota <= 100 * len(cpus):
+            raise Exception('CPUQuota {} is out of 1%..{}% ({} CPU(s) available)'.format(resources['CPUQuota'], 100 * len(cpus), len(cpus)))
+        directives.append('CPUQuota={:g}%'.format(quota))
+    for name in ('CPUWeight', 'IOWeight'):
+        if resources.get(name) is not None:
+            if not 1 <= int(resources[name]) <= 10000:
+                raise Exception('{} {} is out of 1..10000'.format(name, resources[name]))
+            directives.append('{}={}'.format(name, int(resources[name])))
+    if resources.get('AllowedCPUs') is not None:
+        allowed = parse_cpu_list(str(resources['AllowedCPUs']))
+        missing = sorted(set(allowed) - set(cpus))
+        if not allowed or missing:
+            raise Exception('AllowedCPUs {} not available on host: {}'.format(resources['AllowedCPUs'], format_cpu_list(missing) or 'empty'))
+        directives.append('AllowedCPUs={}'.format(format_cpu_list(allowed)))
+    limits = {}
+    for name in ('MemoryHigh', 'MemoryMax'):
+        if resources.get(name) is not None:
+            limits[name] = parse_memory_kib(resources[name], memory_kib)
+            if limits[name] is not None and memory_kib and limits[name] > memory_kib:
+                raise Exception('{} {} exceeds host memory of {}M'.format(name, resources[name], memory_kib // 1024))
+            directives.append('{}={}'.format(name, 'infinity' if limits[name] is None else '{}K'.format(limits[name])))
+    if limits.get('MemoryHigh') and limits.get('MemoryMax') and limits['MemoryHigh'] > limits['MemoryMax']:
+        raise Exception('MemoryHigh {MemoryHigh} is above MemoryMax {MemoryMax}'.format(**resources))
+    if resources.get('LimitNOFILE') is not None:
+        nr_open = host_nr_open() if nr_open is None else nr_open
+        soft, __, hard = str(resources['LimitNOFILE']).partition(':')
+        if int(soft) > int(hard or soft) or int(hard or soft) > nr_open:
+            raise Exception('LimitNOFILE {} must be soft <= hard <= {} (fs.nr_open)'.format(resources['LimitNOFILE'], nr_open))
+        directives.append('LimitNOFILE={}'.format(resources['LimitNOFILE']))
+    if resources.get('Nice') is not None:
+        if not -20 <= int(resources['Nice']) <= 19:
+            raise Exception('Nice {} is out of -20..19'.format(resources['Nice']))
+        directives.append('Nice={}'.format(int(resources['Nice'])))
+    return directives
+
+
+def budget_resources(resources, cpus, memory_kib):
+    """(CPUs, memory KiB) left to service by its AllowedCPUs, CPUQuota and MemoryHigh/MemoryMax"""
+    resources = resources or {}
+    if resources.get('AllowedCPUs') is not None:
+        cpus = min(cpus, len(parse_cpu_list(str(resources['AllowedCPUs']))))
+    if resources.get('CPUQuota') is not None:
+        cpus = min(cpus, max(1, -(-int(parse_cpu_quota(resources['CPUQuota'])) // 100)))
+    for name in ('MemoryHigh', 'MemoryMax'):
+        if resources.get(name) is not None:
+            limit = parse_memory_kib(resources[name], memory_kib)
+            if limit is not None:
+                memory_kib = min(memory_kib, limit) if memory_kib else limit
+    return cpus, memory_kib
+
+
+def celery_concurrency(options, cpus, memory_kib, prefork_queues):
+    """Pool size of queue worker: explicit, or CPUs shared by prefork queues capped by their memory budget"""
+    if options['concurrency']:
+        return int(options['concurrency'])
+    pool = options['pool']
+    if pool == 'solo':
+        return 1
+    if pool in CELERY_POOL_CPU_FACTORS:
+        return CELERY_POOL_CPU_FACTORS[pool] * cpus
+    concurrency = max(1, cpus // max(prefork_queues, 1))
+    if options['max_memory_per_child'] and memory_kib:
+        # leave fifth of memory to the rest of host
+        budget = memory_kib * 0.8 / max(prefork_queues, 1)
+        concurrency = min(concurrency, max(1, int(budget // int(options['max_memory_per_child']))))
+    return concurrency
+
+
+def celery_worker_args(settings, queue, options, concurrency):
+    args = ['-A', settings['CELERY_APP'], 'worker', '--hostname', '{}@%%h'.format(queue), '--queues', queue, '--pool', options['pool']]
+    if options['autoscale']:
+        args += ['--autoscale', '{},{}'.format(options['autoscale']['max'], options['autoscale']['min'])]
+    else:
+        args += ['--concurrency', str(concurrency)]
+    args += ['--prefetch-multiplier', str(options['prefetch_multiplier'])]
+    if options['pool'] == 'prefork':
+        if options['max_tasks_per_child']:
+            args += ['--max-tasks-per-child', str(options['max_tasks_per_child'])]
+        if options['max_memory_per_child']:
+            args += ['--max-memory-per-child', str(options['max_memory_per_child'])]
+    args += ['--loglevel', options['loglevel']]
+    return ' '.join(args)
+
+
+def celery_beat_args(settings, options):
+    schedule = os.path.join('/var/lib/example', '{}.{}.schedule'.format(settings['SERVICE'], settings['CONFIG']))
+    args = ['-A', settings['CELERY_APP'], 'beat', '--schedule', schedule,
+            '--max-interval', str(options['max_interval']), '--loglevel', options['loglevel']]
+    return ' '.join(args)
+
+
+def celery_task_routes(config):
+    """`routes` of taskworker config as CELERY_TASK_ROUTES value, so every producer routes tasks alike"""
+    settings, error = load_settings('taskworker', config)
+    if error is not None:
+        return ''
+    return ','.join('{}={}'.format(pattern, queue) for pattern, queue in (settings.get('routes') or {}).items())
+
+
+# URL schemes of broker and result backend served by `redis` client package
+REDIS_SCHEMES = ('redis', 'rediss', 'redis+socket')
+
+
+def missing_celery_packages(settings):
+    """Packages units of celery service need but environment of PYTHON_CMD lacks (celery is not in Pipfile)"""
+    from importlib.util import find_spec
+    missing = []
+    if find_spec('celery') is None or not os.path.exists(settings['CELERY_CMD']):
+        missing.append('celery')
+    env = settings.get('env') or {}
+    urls = [env.get('CELERY_BROKER_URL') or 'redis://', env.get('CELERY_RESULT_BACKEND') or '']
+    if any(url.partition('://')[0] in REDIS_SCHEMES for url in urls) and find_spec('redis') is None:
+        missing.append('redis')
+    return missing
+
+
+def stage_celery_install(batch, service, config, settings):
+    settings['CELERY_CMD'] = os.path.join(os.path.dirname(settings['PYTHON_CMD']), 'celery')
+    missing = missing_celery_packages(settings)
+    if missing:
+        raise Exception('Service [{}] needs package(s) not installed for {}: {} (e.g. `pipenv install {}`)'.format(
+            service, settings['PYTHON_CMD'], ', '.join(missing), ' '.join(missing)))
+    routes = celery_task_routes(config)
+    if routes:
+        settings['env']['CELERY_TASK_ROUTES'] = routes
+    service_template_path = os.path.join('services', 'templates', 'systemd.celery.service')
+    if service not in QUEUE_SERVICES:
+        options = celery_options(CELERY_BEAT_DEFAULTS, settings.get('celery'))
+        settings.update(CELERY_ARGS=celery_beat_args(settings, options), STOP_TIMEOUT=options['stop_timeout'])
+        stage_unit_install(batch, derive_systemd_name(service, config), render_template(service_template_path, settings))
+        return
+    queues = celery_queue_options(settings)
+    cpus, memory_kib = budget_resources(settings.get('resources'), *host_resources())
+    prefork_queues = sum(1 for options in queues.values() if options['pool'] == 'prefork' and not options['concurrency'])
+    units = {}
+    for queue, options in queues.items():
+        concurrency = celery_concurrency(options, cpus, memory_kib, prefork_queues)
+        print('Queue [{}]: {} pool, concurrency {}'.format(
+            queue, options['pool'], 'autoscale {max}..{min}'.format(**options['autoscale']) if options['autoscale'] else concurrency))
+        queue_settings = dict(settings, QUEUE=queue, description='{} [{}]'.format(settings['description'], queue),
+                              CELERY_ARGS=celery_worker_args(settings, queue, options, concurrency), STOP_TIMEOUT=options['stop_timeout'])
+        units[derive_queue_unit_name(service, config, queue)] = render_template(service_template_path, queue_settings)
+    for unit_name in installed_queue_units(service, config):
+        if unit_name not in units:
+            stage_unit_uninstall(batch, unit_name)
+    for unit_name, unit_def in units.items():
+        stage_unit_install(batch, unit_name, unit_def)
+
+
+def parse_cpu_list(text):
+    """`0-3,8-11` (as in /sys/devices/system/node/node0/cpulist) -> [0, 1, 2, 3, 8, 9, 10, 11]"""
+    cpus = []
+    for item in text.replace(' ', ',').split(','):
+        if item:
+            first, __, last = item.partition('-')
+            cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def format_cpu_list(cpus):
+    ranges = []
+    for cpu in sorted(cpus):
+        if ranges and ranges[-1][1] == cpu - 1:
+            ranges[-1][1] = cpu
+        else:
+            ranges.append([cpu, cpu])
+    return ' '.join(str(first) if first == last else '{}-{}'.format(first, last) for first, last in ranges)
+
+
+def numa_nodes():
+    """NUMA node number -> its CPUs"""
+    root = '/sys/devices/system/node'
+    nodes = {}
+    try:
+        names = os.listdir(root)
+    except OSError:
+        return nodes
+    for name in names:
+        if name.startswith('node') and name[4:].isdigit():
+            try:
+                with io.open(os.path.join(root, name, 'cpulist'), encoding='ascii') as istream:
+                    nodes[int(name[4:])] = parse_cpu_list(istream.read().strip())
+            except (OSError, ValueError):
+                continue
+    return nodes
+
+
+def split_evenly(items, parts):
+    size, extra = divmod(len(items), parts)
+    chunks, start = [], 0
+    for index in range(parts):
+        end = start + size + (1 if index < extra else 0)
+        chunks.append(items[start:end])
+        start = end
+    return chunks
+
+
+def instance_cpu_sets(instances, cpu_affinity, cpus=None, nodes=None):
+    """[(cpu list, NUMA node or None)] per instance from `cpu_affinity` setting: `auto` or explicit list"""
+    if isinstance(cpu_affinity, (list, tuple)):
+        if len(cpu_affinity) != instances:
+            raise Exception('cpu_affinity must list CPU set of every one of {} instance(s)'.format(instances))
+        return [(parse_cpu_list(str(item)), None) for item in cpu_affinity]
+    if cpu_affinity != 'auto':
+        raise Exception('Unknown cpu_affinity: {}'.format(cpu_affinity))
+    cpus = sorted(os.sched_getaffinity(0)) if cpus is None else cpus
+    nodes = numa_nodes() if nodes is None else nodes
+    if len(nodes) > 1 and instances % len(nodes) == 0:
+        # whole instances per NUMA node, so workers use node-local memory
+        sets = []
+        for node, node_cpus in sorted(nodes.items()):
+            node_cpus = [cpu for cpu in node_cpus if cpu in cpus]
+            sets += [(chunk, node) for chunk in split_evenly(node_cpus, instances // len(nodes))]
+    else:
+        sets = [(chunk, None) for chunk in split_evenly(cpus, instances)]
+    if not all(chunk for chunk, __ in sets):
+        raise Exception('Not enough CPUs for {} instance(s)'.format(instances))
+    return sets
+
+
+def cpu_affinity_dropin(cpus, node):
+    lines = ['[Service]', 'CPUAffinity={}'.format(format_cpu_list(cpus))]
+    if node is not None:
+        lines += ['NUMAPolicy=bind', 'NUMAMask={}'.format(node)]
+    return '\n'.join(lines) + '\n'
+
+
+def stage_webapp_units(batch, service, config, settings):
+    """Single gunicorn unit with its socket, or template units with `instances` enabled instances"""
+    service_template_path = os.path.join('services', 'templates', 'systemd.gunicorn.service')
+    socket_template_path = os.path.join('services', 'templates', 'systemd.gunicorn.socket')
+    instances = webapp_instances(settings)
+    template_name = derive_instance_name(service, config, '')
+    socket_template_name = derive_instance_name(service, config, '', 'socket')
+    installed = installed_instances(service, config)
+    if instances == 1:
+        if installed or os.path.exists(systemd_service_path(template_name)):
+            stage_unit_uninstall(batch, template_name, [derive_instance_name(service, config, i) for i in installed])
+            stage_unit_uninstall(batch, socket_template_name, [derive_instance_name(service, config, i, 'socket') for i in installed])
+            for instance in installed:
+                stage_unit_dropin(batch, derive_instance_name(service, config, instance), 'cpus.conf', None)
+        settings.update(SOCKET_UNIT=derive_systemd_socket_name(service, config), RUNTIME_DIRECTORY='example.{}.{}'.format(service, config))
+        stage_unit_install(batch, derive_systemd_socket_name(service, config), render_template(socket_template_path, settings))
+        stage_unit_install(batch, derive_systemd_name(service, config), render_template(service_template_path, settings))
+        return
+    for unit_name in (derive_systemd_name(service, config), derive_systemd_socket_name(service, config)):
+        stage_unit_uninstall(batch, unit_name)
+    stale = [instance for instance in installed if instance > instances]
+    if stale:
+        stage_unit_uninstall(batch, template_name, [derive_instance_name(service, config, i) for i in stale], keep_file=True)
+        stage_unit_uninstall(batch, socket_template_name, [derive_instance_name(service, config, i, 'socket') for i in stale], keep_file=True)
+    runtime_root = os.path.join('/run', 'example.{}.{}'.format(service, config))
+    env = dict(settings['env'])
+    metrics_dir = env.get('METRICS_DIR')
+    if metrics_dir and metrics_dir.startswith(runtime_root + os.sep):
+        # each instance writes own runtime directory, /metrics of any of them sums up all
+        env['METRICS_DIR'] = os.path.join(runtime_root, '%i', os.path.relpath(metrics_dir, runtime_root))
+        env['METRICS_SCRAPE_DIR'] = runtime_root
+    template_settings = dict(
+        settings, env=env, description='{} [%i]'.format(settings['description']),
+        SOCKET_NAME=instance_socket_name(settings, '%i'), SOCKET_UNIT=derive_instance_name(service, config, '%i', 'socket'),
+        RUNTIME_DIRECTORY='example.{}.{}/%i'.format(service, config))
+    numbers = range(1, instances + 1)
+    stage_unit_install(batch, socket_template_name, render_template(socket_template_path, template_settings),
+                       [derive_instance_name(service, config, i, 'socket') for i in numbers])
+    stage_unit_install(batch, template_name, render_template(service_template_path, template_settings),
+                       [derive_instance_name(service, config, i) for i in numbers])
+    allowed = (settings.get('resources') or {}).get('AllowedCPUs')
+    cpus = parse_cpu_list(str(allowed)) if allowed is not None else None
+    cpu_sets = instance_cpu_sets(instances, settings['cpu_affinity'], cpus) if settings.get('cpu_affinity') else [None] * instances
+    for instance in sorted(set(numbers) | set(installed)):
+        cpu_set = cpu_sets[instance - 1] if instance <= instances else None
+        content = cpu_affinity_dropin(*cpu_set) if cpu_set else None
+        stage_unit_dropin(batch, derive_instance_name(service, config, instance), 'cpus.conf', content)
+        if cpu_set:
+            print('Instance [{}]: CPUs {}{}'.format(instance, format_cpu_list(cpu_set[0]), '' if cpu_set[1] is None else ', NUMA node {}'.format(cpu_set[1])))
+
+
+def stage_nginx_snapshot(batch, relpaths):
+    snapshot = snapshot_files(NGINX_ROOT, relpaths)
+    batch.update(undo=functools.partial(restore_files, NGINX_ROOT, relpaths, snapshot))
+    batch.update(nginx_changed=True)
+
+
+def stage_install(batch, service, config):
+    print('{} service [{}] for config [{}]...'.format('Planning' if batch.dry_run else 'Setting up', service, config))
+    settings, error = load_settings(service, config)
+    if error is not None:
+        return None, error
+    try:
+        if service in SYSTEMD_SERVICES:
+            settings['RESOURCES'] = resource_directives(settings.get('resources'))
+            settings.setdefault('env', {}).update(logging_environment(settings.get('logging') or {}, settings))
+        if service == 'nginxsite':
+            upstream = settings.setdefault('upstream', {})
+            if not upstream.get('servers'):
+                upstream['servers'] = webapp_socket_paths(config)
+            if not settings.get('project_root'):
+                settings['project_root'] = webapp_project_root(config)
+            stage_nginx_site(batch, config, settings)
+        elif service == 'nginxmain':
+            with io.open(os.path.join(HERE, 'nginxmain', '{}.conf'.format(config)), encoding='utf-8') as istream:
+                if stage_file(batch, os.path.join(NGINX_ROOT, 'nginx.conf'), istream.read()):
+                    batch.update(nginx_changed=True)
+            # nginx.service comes with distribution package, so its limits (e.g. LimitNOFILE matching
+            # worker_rlimit_nofile) go to drop-in, they are applied on next restart of nginx, not on reload
+            directives = resource_directives(settings.get('resources'))
+            stage_unit_dropin(batch, 'nginx.service', 'example.conf', '\n'.join(['[Service]'] + directives) + '\n' if directives else None)
+        elif service in ('webapp',):
+            settings['GUNICORN_CMD'] = os.path.join(os.path.dirname(settings['PYTHON_CMD']), 'gunicorn')
+            settings['GUNICORN_CONFIG_PATH'] = os.path.join(settings['HOME'], 'services', 'gunicorn_config.py')
+            settings['GUNICORN_ENV'] = gunicorn_environment(settings.get('gunicorn') or {})
+            routes = celery_task_routes(config)
+            if routes:
+                settings['env']['CELERY_TASK_ROUTES'] = routes
+            targetroot = settings['targetroot']
+            srcdir = os.path.join(HERE, 'djangosite', 'project_static')
+            if batch.dry_run:
+                releases, error = plan_release(srcdir, targetroot)
+                if error is not None:
+                    return None, error
+                previous_id, release_id = releases
+                if previous_id != release_id:
+                    link = os.path.join(targetroot, 'current')
+                    batch.update(changes=(link, previous_id and '-> releases/{}'.format(previous_id), '-> releases/{}'.format(release_id)))
+            else:
+                releases, error = deploy_files(srcdir, targetroot, settings.get('keep_releases', 3))
+                if error is not None:
+                    return None, error
+                batch.update(undo=functools.partial(switch_release, targetroot, releases[0]))
+            stage_webapp_units(batch, service, config, settings)
+        elif service in ('taskplanner', 'taskworker'):
+            stage_celery_install(batch, service, config, settings)
+        else:
+            raise Exception('Unsupported service: {}'.format(service))
+    except Exception as e:
+        return None, 'Failed to install service [{}] configuration [{}]: {}'.format(service, config, e)
+    return None, None
+
+
+def stage_uninstall(batch, service, config):
+    print('Removing service [{}] for config [{}]...'.format(service, config))
+    settings, error = load_settings(service, config)
+    if error is not None:
+        return None, error
+    try:
+        if service == 'nginxsite':
+            stage_nginx_snapshot(batch, nginx_site_paths(config))
+            uninstall_nginx_files(config, settings)
+        elif service == 'nginxmain':
+            print('Fake uninstall of nginxmain')
+        elif service in SOCKET_ACTIVATED_SERVICES and os.path.exists(systemd_service_path(derive_instance_name(service, config, ''))):
+            installed = installed_instances(service, config)
+            stage_unit_uninstall(batch, derive_instance_name(service, config, ''), [derive_instance_name(service, config, i) for i in installed])
+            stage_unit_uninstall(batch, derive_instance_name(service, config, '', 'socket'), [derive_instance_name(service, config, i, 'socket') for i in installed])
+            for instance in installed:
+                stage_unit_dropin(batch, derive_instance_name(service, config, instance), 'cpus.conf', None)
+        elif service in SYSTEMD_SERVICES:
+            for unit_name in derive_systemd_units(service, config):
+                stage_unit_uninstall(batch, unit_name)
+        else:
+            raise Exception('Unsupported service: {}'.format(service))
+    except Exception as e:
+        return None, 'Failed to uninstall service [{}] configuration [{}]: {}'.format(service, config, e)
+    return None, None
+
+
+def commit_batch(batch):
+    try:
+        if batch.disable:
+            systemd().stop(batch.disable)
+            systemd().disable(batch.disable)
+            for path in batch.remove:
+                os.remove(path)
+        if batch.systemd_changed:
+            systemd().daemon_reload()
+        if batch.enable:
+            systemd().enable(batch.enable)
+        if batch.nginx_changed:
+            test_nginx_config()
+            reload_nginx_config()
+    except Exception as e:
+        return None, 'Failed to apply changes: {}'.format(e)
+    return None, None
+
+
+def rollback_batch(batch):
+    print('Restoring configuration to previous state...')
+    restored = True
+    for undo in reversed(batch.undo):
+        try:
+            undo()
+        except Exception as e:
+            restored = False
+            print_error('Failed to restore configuration:', e)
+    if batch.systemd_changed:
+        try:
+            systemd().daemon_reload()
+        except Exception as e:
+            restored = False
+            print_error('Failed to reload systemd configuration:', e)
+    if batch.nginx_changed:
+        try:
+            test_nginx_config()
+            reload_nginx_config()
+            print('Nginx previous configuration restored and loaded')
+        except Exception as e:
+            restored = False
+            print_error('Failed to restore Nginx config:', e)
+            print_error('Nginx config left corrupted!')
+    if restored:
+        print('Previous configuration restored')
+
+
+def run_ordered(items, func, dependencies, jobs):
+    """Run func over (service, config) items in a worker pool.
+
+    Item is scheduled only when no item of a service it depends on is pending or running.
+    After the first error no more items are scheduled.
+    """
+    from concurrent import futures
+    pending = list(items)
+    running = {}
+    errors = []
+    with futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while pending or running:
+            if not errors:
+                busy = [s for s, __ in pending] + [s for s, __ in running.values()]
+                for item in list(pending):
+                    service = item[0]
+                    blockers = dependencies.get(service, ())
+                    if any(s in blockers for s in busy):
+                        continue
+                    pending.remove(item)
+                    running[pool.submit(func, *item)] = item
+            elif not running:
+                break
+            if not running:
+                errors.append('Dependency cycle among: {}'.format(pending))
+                break
+            done, __ = futures.wait(running, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                running.pop(future)
+                try:
+                    __, error = future.result()
+                except Exception as e:
+                    error = str(e)
+                if error is not None:
+                    errors.append(error)
+    if errors:
+        return None, '; '.join(errors)
+    return None, None
+
+
+def run_batch(items, stage, dependencies, jobs=1):
+    batch = Batch()
+    __, error = run_ordered(items, functools.partial(stage, batch), dependencies, jobs)
+    if error is None:
+        __, error = commit_batch(batch)
+    if error is not None:
+        rollback_batch(batch)
+        return None, error
+    return None, None
+
+
+def load_codons_services():
+    codons_filepath = os.path.join(HERE, 'codons.yaml')
+    try:
+        codons = load_descriptor(codons_filepath)
+    except Exception as e:
+        return None, 'Failed to load codons: {}'.format(e)
+    services = (codons or {}).get('services') or {}
+    items = []
+    for service, definition in services.items():
+        for config in (definition or {}).get('configs') or []:
+            items.append((service, config))
+    return items, None
+
+
+def parse_batch_items(pairs):
+    if not pairs:
+        return load_codons_services()
+    items = []
+    for pair in pairs:
+        service, sep, config = pair.partition(':')
+        if not sep or not service or not config:
+            return None, 'Expected SERVICE:CONFIG, got: {}'.format(pair)
+        items.append((service, config))
+    return items, None
+
+
+def install(service, config):
+    __, error = run_batch([(service, config)], stage_install, SERVICE_DEPENDENCIES)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print('Service [{}] configuration [{}] installed'.format(service, config))
+
+
+def uninstall(service, config):
+    __, error = run_batch([(service, config)], stage_uninstall, reverse_dependencies(SERVICE_DEPENDENCIES))
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print('Service [{}] configuration [{}] uninstalled'.format(service, config))
+
+
+def install_all(jobs, pairs):
+    items, error = parse_batch_items(pairs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    __, error = run_batch(items, stage_install, SERVICE_DEPENDENCIES, jobs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print('Installed {} service configuration(s)'.format(len(items)))
+
+
+def uninstall_all(jobs, pairs):
+    items, error = parse_batch_items(pairs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    __, error = run_batch(items, stage_uninstall, reverse_dependencies(SERVICE_DEPENDENCIES), jobs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print('Uninstalled {} service configuration(s)'.format(len(items)))
+
+
+def content_digest(content):
+    if content is None:
+        return 'none'
+    if content is UNREADABLE:
+        return 'unknown (unreadable)'
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()[:12]
+
+
+def format_plan(batch):
+    """Unified diff of every artifact which would change and actions install would take, secrets are shown as digests"""
+    import difflib
+    lines = []
+    for path, previous, content in sorted(batch.changes, key=lambda change: change[0]):
+        mark = '+' if previous is None else '-' if content is None else '~'
+        lines.append('{} {} ({} -> {})'.format(mark, path, content_digest(previous), content_digest(content)))
+        if previous is UNREADABLE:
+            continue  # nothing to compare with
+        lines.extend(line.rstrip('\n') for line in difflib.unified_diff(
+            (previous or '').splitlines(True), (content or '').splitlines(True), 'installed', 'planned', n=2))
+    actions = []
+    if batch.disable:
+        actions.append('systemctl stop/disable {}'.format(' '.join(batch.disable)))
+    if batch.systemd_changed:
+        actions.append('systemctl daemon-reload')
+    if batch.enable:
+        actions.append('systemctl enable {}'.format(' '.join(batch.enable)))
+    if batch.nginx_changed:
+        actions.append('nginx -t && nginx -s reload')
+    lines.append('Actions: {}'.format('; '.join(actions) if actions else 'none'))
+    return '\n'.join(lines)
+
+
+def plan(jobs, pairs):
+    items, error = parse_batch_items(pairs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    batch = Batch(dry_run=True)
+    __, error = run_ordered(items, functools.partial(stage_install, batch), SERVICE_DEPENDENCIES, jobs)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print(format_plan(batch))
+    if batch.changes or batch.enable:
+        print('{} artifact(s) to change'.format(len(batch.changes)))
+    else:
+        print('Installed configuration is up to date')
+
+
+def gunicorn_pidfile(service, config, instance=None):
+    """Pidfile of gunicorn master in runtime directory of its unit (GUNICORN_PIDFILE of systemd.gunicorn.service)"""
+    runtime_dir = os.path.join('/run', 'example.{}.{}'.format(service, config))
+    if instance is not None:
+        runtime_dir = os.path.join(runtime_dir, str(instance))
+    return os.path.join(runtime_dir, 'gunicorn.pid')
+
+
+def systemd_group(service, config, settings):
+    """[(service unit, its socket unit or None, readiness settings)] of every unit service config runs as"""
+    readiness = readiness_settings(settings)
+    if service in QUEUE_SERVICES:
+        systemd_names = installed_queue_units(service, config)
+        if not systemd_names:
+            print_error('No queue units installed for service [{}] config [{}]'.format(service, config))
+            sys.exit(1)
+        return [(systemd_name, None, readiness) for systemd_name in systemd_names]
+    if service not in SOCKET_ACTIVATED_SERVICES:
+        return [(derive_systemd_name(service, config), None, readiness)]
+    instances = webapp_instances(settings)
+    if instances == 1:
+        return [(derive_systemd_name(service, config), derive_systemd_socket_name(service, config),
+                 dict(readiness, pidfile=gunicorn_pidfile(service, config)))]
+    group = []
+    for instance in range(1, instances + 1):
+        socket_path = os.path.join('/run', instance_socket_name(settings, instance))
+        group.append((derive_instance_name(service, config, instance), derive_instance_name(service, config, instance, 'socket'),
+                      dict(readiness, socket_path=socket_path if readiness['socket_path'] else None,
+                           pidfile=gunicorn_pidfile(service, config, instance))))
+    return group
+
+
+def start(service, config):
+    print('Starting service [{}] for config [{}]...'.format(service, config))
+    if service in SYSTEMD_SERVICES:
+        settings, error = load_settings(service, config)
+        if error is not None:
+            print_error(error)
+            sys.exit(1)
+        # instances are restarted one by one, so the rest keeps serving
+        for systemd_name, socket_name, readiness in systemd_group(service, config, settings):
+            elapsed, error = systemd_start(systemd_name, readiness, socket_name)
+            if error is not None:
+                print_error(error)
+                sys.exit(1)
+            print('Service started: {} (ready in {:.2f}s)'.format(systemd_name, elapsed))
+
+
+def reload(service, config):
+    if service not in SOCKET_ACTIVATED_SERVICES:
+        # there is no graceful reload for the rest, so just restart them
+        start(service, config)
+        return
+    print('Reloading service [{}] for config [{}]...'.format(service, config))
+    settings, error = load_settings(service, config)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    for systemd_name, __, readiness in systemd_group(service, config, settings):
+        elapsed, error = systemd_graceful_reload(systemd_name, readiness)
+        if error is not None:
+            print_error(error)
+            sys.exit(1)
+        print('Service reloaded: {} (ready in {:.2f}s)'.format(systemd_name, elapsed))
+
+
+def stop(service, config):
+    print('Stopping service [{}] for config [{}]...'.format(service, config))
+    if service in SYSTEMD_SERVICES:
+        # stop socket as well, otherwise next connection activates service again
+        unit_names = derive_systemd_units(service, config)
+        if not unit_names:
+            print('Service is not installed')
+            return
+        __, error = systemd_stop(*unit_names)
+        if error is not None:
+            print_error(error)
+            sys.exit(1)
+        print('Service stopped:', ' '.join(unit_names))
+
+
+def bench(config, urls, concurrency, duration, warmup, timeout, with_nginx, output):
+    import bench as benchmark
+    print('Benchmarking webapp config [{}]...'.format(config), file=sys.stderr)
+    report, error = benchmark.bench(config, urls, concurrency, duration, warmup, timeout, with_nginx)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    result = json.dumps(report, indent=2)
+    if output:
+        with io.open(output, 'w', encoding='utf-8') as ostream:
+            ostream.write(result + '\n')
+    print(result)
+
+
+def logstats(service, config, files, follow, interval, jobs, top, as_json):
+    import logstats as analyzer
+    if files:
+        current = files[-1]
+    else:
+        current, error = analyzer.access_log_path(service, config)
+        if error is not None:
+            print_error(error)
+            sys.exit(1)
+        files = [current]
+    paths = [path for filename in files for path in analyzer.expand_rotated(filename)]
+    if not paths and not follow:
+        print_error('No access log found for service [{}] config [{}]'.format(service, config))
+        sys.exit(1)
+
+    def report(stats):
+        summary = analyzer.summarize(stats, top)
+        print(json.dumps(summary, indent=2) if as_json else analyzer.format_table(summary))
+        sys.stdout.flush()
+
+    chunks = analyzer.plan_chunks(paths)
+    started = time.perf_counter()
+    stats = analyzer.scan(chunks, jobs or os.cpu_count() or 1)
+    print('Parsed {} line(s) of {} file(s) in {:.2f}s'.format(stats.lines, len(paths), time.perf_counter() - started), file=sys.stderr)
+    if not follow:
+        report(stats)
+        return
+    # keep reading current log from where scan stopped, also when it is rotated away or not written yet
+    position = max([end for path, start, end in chunks if path == current and end is not None] or [0])
+    try:
+        analyzer.follow(current, stats, interval, report, position)
+    except KeyboardInterrupt:
+        report(stats)
+
+
+def rotate_tickets(config):
+    print('Rotating session ticket keys of nginxsite config [{}]...'.format(config))
+    count, error = rotate_ticket_keys(config)
+    if error is not None:
+        print_error(error)
+        sys.exit(1)
+    print('Session ticket keys rotated ({} in use), Nginx reloaded'.format(count))
+
+
+def precompress(root, jobs, with_brotli, force):
+    import precompress as compressor
+    root = root or os.path.join(HERE, 'djangosite', 'project_static', 'static')
+    if not os.path.isdir(root):
+        print_error('Static directory not exists: {} (run collectstatic first)'.format(root))
+        sys.exit(1)
+    if with_brotli and compressor.brotli_module() is None:
+        # Nginx config serves .br siblings by brotli_static, silently missing ones would go unnoticed
+        print_error('No brotli package (see Pipfile), install it or pass --no-brotli for .gz files only')
+        sys.exit(1)
+    totals = compressor.compress_tree(root, jobs or os.cpu_count() or 1, with_brotli, force)
+    print('Compressed {compressed} of {files} file(s) ({skipped} up to date) in {seconds}s: '
+          '{bytes} -> gzip {gzip_bytes}, brotli {brotli_bytes} byte(s)'.format(**totals))
+
+
+def make_cli():
+    import click
+
+    @click.group()
+    def cli():
+        """Tool for service control"""
+        pass
+
+    @cli.command('install')
+    @click.argument('service')
+    @click.argument('config')
+    def install_command(service, config):
+        """Install service configuration"""
+        install(service, config)
+
+    @cli.command('uninstall')
+    @click.argument('service')
+    @click.argument('config')
+    def uninstall_command(service, config):
+        """Uninstall service configuration"""
+        uninstall(service, config)
+
+    @cli.command('install-all')
+    @click.option('--jobs', '-j', default=4, show_default=True, help='Number of parallel workers')
+    @click.argument('pairs', nargs=-1, metavar='[SERVICE:CONFIG]...')
+    def install_all_command(jobs, pairs):
+        """Install many service configurations at once (all from codons.yaml by default)"""
+        install_all(jobs, pairs)
+
+    @cli.command('uninstall-all')
+    @click.option('--jobs', '-j', default=4, show_default=True, help='Number of parallel workers')
+    @click.argument('pairs', nargs=-1, metavar='[SERVICE:CONFIG]...')
+    def uninstall_all_command(jobs, pairs):
+        """Uninstall many service configurations at once (all from codons.yaml by default)"""
+        uninstall_all(jobs, pairs)
+
+    @cli.command('plan')
+    @click.option('--jobs', '-j', default=4, show_default=True, help='Number of parallel workers')
+    @click.argument('pairs', nargs=-1, metavar='[SERVICE:CONFIG]...')
+    def plan_command(jobs, pairs):
+        """Show what install would change (all from codons.yaml by default), without changing anything"""
+        plan(jobs, pairs)
+
+    @cli.command('start')
+    @click.argument('service')
+    @click.argument('config')
+    def start_command(service, config):
+        """Start systemd service"""
+        start(service, config)
+
+    @cli.command('reload')
+    @click.argument('service')
+    @click.argument('config')
+    def reload_command(service, config):
+        """Reload service gracefully (restart when not supported)"""
+        reload(service, config)
+
+    @cli.command('stop')
+    @click.argument('service')
+    @click.argument('config')
+    def stop_command(service, config):
+        """Stop systemd service"""
+        stop(service, config)
+
+    @cli.command('bench')
+    @click.argument('config')
+    @click.option('--url', '-u', 'urls', multiple=True, default=['/health/'], show_default=True, help='Path to request, as PATH[:WEIGHT], may be repeated')
+    @click.option('--concurrency', '-c', default=32, show_default=True, help='Number of concurrent connections')
+    @click.option('--duration', '-d', default=10.0, show_default=True, help='Measured duration in seconds')
+    @click.option('--warmup', default=2.0, show_default=True, help='Seconds of load before measurement starts')
+    @click.option('--timeout', default=10.0, show_default=True, help='Per-request timeout in seconds')
+    @click.option('--nginx', 'with_nginx', is_flag=True, help='Drive load through local nginx with rendered nginxsite config')
+    @click.option('--output', '-o', help='Also write JSON report to this file')
+    def bench_command(config, urls, concurrency, duration, warmup, timeout, with_nginx, output):
+        """Load-test webapp config on temporary socket and report RPS and latency as JSON"""
+        bench(config, urls, concurrency, duration, warmup, timeout, with_nginx, output)
+
+    @cli.command('logstats')
+    @click.argument('service')
+    @click.argument('config')
+    @click.option('--file', '-f', 'files', multiple=True, help='Access log to read instead of service one (rotated copies are included), may be repeated')
+    @click.option('--follow', is_flag=True, help='Keep reading appended lines and report periodically')
+    @click.option('--interval', default=10.0, show_default=True, help='Seconds between reports in --follow mode')
+    @click.option('--jobs', '-j', default=0, help='Parallel parser processes  [default: CPU count]')
+    @click.option('--top', default=20, show_default=True, help='Number of busiest routes to report')
+    @click.option('--json', 'as_json', is_flag=True, help='Report as JSON')
+    def logstats_command(service, config, files, follow, interval, jobs, top, as_json):
+        """Latency percentiles per route, upstream vs Nginx time, cache hit ratio and status mix from access logs"""
+        logstats(service, config, files, follow, interval, jobs, top, as_json)
+
+    @cli.command('rotate-tickets')
+    @click.argument('config')
+    def rotate_tickets_command(config):
+        """Put new TLS session ticket key of nginxsite config first and reload Nginx (run daily, e.g. by cron)"""
+        rotate_tickets(config)
+
+    @cli.command('precompress')
+    @click.argument('root', required=False)
+    @click.option('--jobs', '-j', default=0, help='Parallel compressor processes  [default: CPU count]')
+    @click.option('--brotli/--no-brotli', 'with_brotli', default=True, show_default=True, help='Also make .br files (fails without brotli package)')
+    @click.option('--force', is_flag=True, help='Recompress files with up to date siblings too')
+    def precompress_command(root, jobs, with_brotli, force):
+        """Make .gz/.br siblings of collected static files (ROOT, default: STATIC_ROOT) for gzip_static of Nginx"""
+        precompress(root, jobs, with_brotli, force)
+
+    return cli
+
+
+# Commands with plain positional arguments dispatched without loading click
+FAST_COMMANDS = {
+    'start': start,
+    'reload': reload,
+    'stop': stop,
+}
+
+
+def profile_startup(argv, top=15):
+    """Run command under `python -X importtime` and report where startup time goes"""
+    command = [sys.executable, '-X', 'importtime', os.path.join(HERE, 'service.py')] + argv
+    started = time.perf_counter()
+    job = subprocess.run(command, stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - started
+    imports = []
+    for line in job.stderr.splitlines():
+        if not line.startswith('import time:'):
+            print(line, file=sys.stderr)
+            continue
+        fields = line[len('import time:'):].split('|')
+        try:
+            self_us, cumulative_us = int(fields[0]), int(fields[1])
+        except ValueError:
+            continue  # header line
+        name = fields[2].rstrip()
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((cumulative_us, self_us, depth, name.strip()))
+    toplevel = [entry for entry in imports if entry[2] == 0]
+    total_us = sum(entry[0] for entry in toplevel)
+    print('Startup profile: wall {:.1f} ms, imports {:.1f} ms in {} module(s)'.format(
+        elapsed * 1000.0, total_us / 1000.0, len(imports)), file=sys.stderr)
+    print('{:>12} {:>12}  {}'.format('cumul. [ms]', 'self [ms]', 'top-level import'), file=sys.stderr)
+    for cumulative_us, self_us, __, name in sorted(toplevel, reverse=True)[:top]:
+        print('{:>12.2f} {:>12.2f}  {}'.format(cumulative_us / 1000.0, self_us / 1000.0, name), file=sys.stderr)
+    return job.returncode
+
+
+def main(argv):
+    if '--profile-startup' in argv:
+        argv = [arg for arg in argv if arg != '--profile-startup']
+        sys.exit(profile_startup(argv))
+    if len(argv) == 3 and argv[0] in FAST_COMMANDS and not any(arg.startswith('-') for arg in argv):
+        FAST_COMMANDS[argv[0]](*argv[1:])
+        return
+    make_cli()(args=argv, prog_name='service.py')
@@ -1,8 +1,213 @@
 
+import gc
+import os
+import math
+import random
+import logging
 import multiprocessing
 
-MAX_WORKERS = 4
+from gunicorn import glogging
 
-workers = min(multiprocessing.cpu_count() + 1, MAX_WORKERS)
+# module itself is not imported here as its name is gunicorn setting
+from djangosite.mysite.logconfig import AsyncHandler, SharedFileHandler, log_options, flush_handlers
 
-max_requests = 1000
+# Every setting below may be overridden by GUNICORN_<NAME> environment variable,
+# which service.py renders into systemd unit from `gunicorn` section of webapp descriptor
+
+
+def setting(name, default, cast=int):
+    value = os.environ.get('GUNICORN_{}'.format(name.upper()))
+    if value is None or value == '':
+        return default
+    return cast(value)
+
+
+def flag(value):
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def cgroup_cpu_limit(proc='/proc', cgroupfs='/sys/fs/cgroup'):
+    """CPU quota (in CPUs) of the cgroup this process runs in, None if unlimited"""
+    limits = []
+    try:
+        with open(os.path.join(proc, 'self', 'cgroup')) as f:
+            lines = f.read().splitlines()
+    except OSError:
+        lines = []
+    for line in lines:
+        hierarchy, controllers, path = line.split(':', 2)
+        if hierarchy == '0':
+            # cgroup v2: check own cgroup and all its ancestors
+            path = path.strip('/')
+            while True:
+                try:
+                    with open(os.path.join(cgroupfs, path, 'cpu.max')) as f:
+                        quota, period = f.read().split()
+                    if quota != 'max':
+                        limits.append(int(quota) / int(period))
+                except (OSError, ValueError):
+                    pass
+                if not path:
+                    break
+                path = os.path.dirname(path)
+        elif 'cpu' in controllers.split(','):
+            # cgroup v1: mount point is named after controllers
+            for mount in (os.path.join(cgroupfs, 'cpu,cpuacct'), os.path.join(cgroupfs, 'cpu')):
+                for candidate in (os.path.join(mount, path.strip('/')), mount):
+                    try:
+                        with open(os.path.join(candidate, 'cpu.cfs_quota_us')) as f:
+                            quota = int(f.read())
+                        with open(os.path.join(candidate, 'cpu.cfs_period_us')) as f:
+                            period = int(f.read())
+                    except (OSError, ValueError):
+                        continue
+                    if quota > 0:
+                        limits.append(quota / period)
+                    break
+    return min(limits) if limits else None
+
+
+def available_cpus():
+    """Number of CPUs usable by this process: honors CPU affinity and cgroup quota"""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = multiprocessing.cpu_count()
+    limit = cgroup_cpu_limit()
+    if limit is not None:
+        cpus = min(cpus, max(1, math.ceil(limit)))
+    return cpus
+
+
+worker_class = setting('worker_class', 'sync', str)
+
+threads = setting('threads', 1)
+
+worker_connections = setting('worker_connections', 1000)
+
+
+def default_workers():
+    cpus = available_cpus()
+    if worker_class == 'sync':
+        return 2 * cpus + 1
+    # threaded and async workers multiplex connections themselves
+    return cpus + 1
+
+
+workers = setting('workers', 0) or default_workers()
+
+max_workers = setting('max_workers', 0)
+if max_workers:
+    workers = min(workers, max_workers)
+
+keepalive = setting('keepalive', 2)
+
+backlog = setting('backlog', 2048)
+
+timeout = setting('timeout', 30)
+
+graceful_timeout = setting('graceful_timeout', 30)
+
+max_requests = setting('max_requests', 1000)
+
+max_requests_jitter = setting('max_requests_jitter', 50)
+
+# master started by USR2 writes it with .2 suffix until old master exits, see `systemd_graceful_reload` of servicectl.py
+pidfile = setting('pidfile', None, str)
+
+# Opt-in: application is imported and warmed up by master before fork (see djangosite/mysite/warmup.py),
+# so workers share its memory copy-on-write and are fast from first request; code changes need re-exec (USR2), not HUP
+preload_app = setting('preload', False, flag)
+
+if preload_app:
+    # no collections in master until warmed up: freed objects would leave holes in pages shared with workers
+    gc.disable()
+
+# combined format plus request duration in microseconds, read by `service.py logstats`
+access_log_format = setting('access_log_format', '%(h)s %(l)s %(u)s %(t)s "%(r)s" %(s)s %(b)s "%(f)s" "%(a)s" %(D)s', str)
+
+
+class Logger(glogging.Logger):
+    """
+    Error and access logs written by listener threads (see djangosite/mysite/logconfig.py),
+    log files are rotated by LOG_MAX_BYTES / LOG_WHEN, access log is sampled by LOG_ACCESS_SAMPLE
+    (5xx responses are always logged).
+    """
+
+    def setup(self, cfg):
+        self.options = log_options()
+        super().setup(cfg)
+
+    def _set_handler(self, log, output, fmt, stream=None):
+        super()._set_handler(log, output, fmt, stream)
+        handler = self._get_gunicorn_handler(log)
+        if handler is None:
+            return
+        target = handler
+        if isinstance(handler, logging.FileHandler):
+            handler.close()
+            target = SharedFileHandler(
+                handler.baseFilename, self.options['max_bytes'], self.options['when'], self.options['backup_count'])
+        target.setFormatter(fmt)
+        log.removeHandler(handler)
+        wrapped = AsyncHandler(target, self.options['queue_size'])
+        wrapped._gunicorn = True
+        log.addHandler(wrapped)
+
+    def access(self, resp, req, environ, request_time):
+        sample = self.options['access_sample']
+        if sample < 1.0 and (resp.status_code or 0) < 500 and random.random() >= sample:
+            return
+        super().access(resp, req, environ, request_time)
+
+    def reopen_files(self):
+        super().reopen_files()
+        for log in glogging.loggers():
+            for handler in log.handlers:
+                if isinstance(handler, AsyncHandler):
+                    handler.reopen()
+
+
+logger_class = Logger
+
+
+def on_starting(server):
+    # metrics files left by previous master (e.g. killed) are folded into archive
+    from djangosite.mysite import metrics
+    metrics.collect_dead()
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from djangosite.mysite import warmup
+    loaded = warmup.warm_up()
+    # objects of master go to permanent generation, collections in workers do not touch (and copy) their pages
+    gc.freeze()
+    gc.enable()
+    server.log.info('Application warmed up: %s, %d object(s) frozen', ', '.join('{} {}'.format(v, k) for k, v in loaded.items()), gc.get_freeze_count())
+
+
+def on_reload(server):
+    # this module was executed again by HUP, no warm-up follows to enable collections
+    gc.enable()
+
+
+def post_fork(server, worker):
+    if not preload_app:
+        return
+    # connections opened by master (e.g. by application import) are not usable by several processes
+    from django.db import connections
+    for connection in connections.all():
+        connection.close()
+
+
+def child_exit(server, worker):
+    # keep counters of recycled worker, drop its in-flight gauge
+    from djangosite.mysite import metrics
+    metrics.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    # worker process ends by os._exit, so queued log records are written out here
+    flush_handlers()
@@ -0,0 +1,133 @@
+import gc
+import os
+import importlib.util
+
+import pytest
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+
+def load_config(monkeypatch, **env):
+    """Execute services/gunicorn_config.py as gunicorn does, with GUNICORN_* environment"""
+    for name in list(os.environ):
+        if name.startswith('GUNICORN_'):
+            monkeypatch.delenv(name)
+    for name, value in env.items():
+        monkeypatch.setenv('GUNICORN_{}'.format(name.upper()), value)
+    spec = importlib.util.spec_from_file_location('gunicorn_config', os.path.join(HERE, 'services', 'gunicorn_config.py'))
+    module = importlib.util.module_from_spec(spec)
+    try:
+        spec.loader.exec_module(module)
+    finally:
+        gc.enable()  # preload disables collections until warm-up
+    return module
+
+
+def test_settings_from_environment(monkeypatch):
+    config = load_config(monkeypatch, worker_class='gthread', threads='4', workers='6', max_workers='3',
+                         timeout='', preload='Yes', pidfile='/run/example.webapp.dev/gunicorn.pid')
+    assert (config.worker_class, config.threads, config.workers) == ('gthread', 4, 3)
+    assert config.timeout == 30  # empty value keeps default
+    assert config.preload_app is True
+    assert config.pidfile == '/run/example.webapp.dev/gunicorn.pid'
+    assert load_config(monkeypatch, preload='off').preload_app is False
+
+    with pytest.raises(ValueError):
+        load_config(monkeypatch, workers='four')
+
+
+def write(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_cgroup_cpu_limit_of_own_cgroup_and_ancestors(tmp_path, monkeypatch):
+    config = load_config(monkeypatch)
+    proc, cgroupfs = tmp_path / 'proc', tmp_path / 'cgroup'
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) is None  # no cgroup information at all
+
+    # cgroup v2: the tightest quota of the unit and its slices counts
+    write(proc / 'self' / 'cgroup', '0::/system.slice/example.webapp.dev.service\n')
+    write(cgroupfs / 'system.slice' / 'example.webapp.dev.service' / 'cpu.max', 'max 100000\n')
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) is None
+    write(cgroupfs / 'system.slice' / 'cpu.max', '250000 100000\n')
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) == 2.5
+    write(cgroupfs / 'system.slice' / 'example.webapp.dev.service' / 'cpu.max', '150000 100000\n')
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) == 1.5
+
+    # cgroup v1: cpu controller hierarchy, -1 is unlimited
+    write(proc / 'self' / 'cgroup', '4:memory:/docker/abc\n3:cpu,cpuacct:/docker/abc\n')
+    write(cgroupfs / 'cpu,cpuacct' / 'docker' / 'abc' / 'cpu.cfs_quota_us', '-1\n')
+    write(cgroupfs / 'cpu,cpuacct' / 'docker' / 'abc' / 'cpu.cfs_period_us', '100000\n')
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) is None
+    write(cgroupfs / 'cpu,cpuacct' / 'docker' / 'abc' / 'cpu.cfs_quota_us', '50000\n')
+    assert config.cgroup_cpu_limit(str(proc), str(cgroupfs)) == 0.5
+
+
+def test_workers_from_affinity_and_quota(monkeypatch):
+    config = load_config(monkeypatch)
+    monkeypatch.setattr(config.os, 'sched_getaffinity', lambda pid: {0, 1, 2, 3, 4, 5})
+    monkeypatch.setattr(config, 'cgroup_cpu_limit', lambda: None)
+    assert config.available_cpus() == 6
+    monkeypatch.setattr(config, 'cgroup_cpu_limit', lambda: 2.5)
+    assert config.available_cpus() == 3  # partial CPU of quota rounds up
+    assert config.default_workers() == 7
+    monkeypatch.setattr(config, 'cgroup_cpu_limit', lambda: 0.2)
+    assert config.available_cpus() == 1
+    monkeypatch.setattr(config, 'worker_class', 'gthread')
+    assert config.default_workers() == 2
+
+
+class FakeServer:
+    def __init__(self):
+        self.messages = []
+        self.log = self
+
+    def info(self, message, *args):
+        self.messages.append(message % args)
+
+
+def test_warm_up_only_when_preload_opted_in(monkeypatch):
+    from djangosite.mysite import warmup
+    calls = []
+    monkeypatch.setattr(warmup, 'warm_up', lambda: calls.append(True) or {'url pattern(s)': 3})
+
+    server = FakeServer()
+    load_config(monkeypatch).when_ready(server)
+    assert calls == [] and server.messages == []
+
+    config = load_config(monkeypatch, preload='true')
+    try:
+        config.when_ready(server)
+        assert calls == [True] and gc.isenabled()
+        assert server.messages[0].startswith('Application warmed up: 3 url pattern(s), ')
+    finally:
+        gc.unfreeze()
+
+
+class FakeConnection:
+    def __init__(self):
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class FakeConnections:
+    def __init__(self, count):
+        self.connections = [FakeConnection() for __ in range(count)]
+
+    def all(self):
+        return self.connections
+
+
+def test_post_fork_closes_connections_inherited_from_master(monkeypatch):
+    import django.db
+    inherited = FakeConnections(2)
+    monkeypatch.setattr(django.db, 'connections', inherited)
+
+    load_config(monkeypatch).post_fork(FakeServer(), None)
+    assert not any(connection.closed for connection in inherited.all())  # nothing opened by master without preload
+
+    load_config(monkeypatch, preload='1').post_fork(FakeServer(), None)
+    assert all(connection.closed for connection in inherited.all())
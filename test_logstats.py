@@ -0,0 +1,59 @@
+import gzip
+
+import logstats
+
+NGINX_LINE = '127.0.0.1 - - [18/Oct/2026:01:00:00 +0000] "GET /users/{}/?page=2 HTTP/1.1" {} 512 "-" "Mozilla/5.0" {} {} [{}]\n'
+GUNICORN_LINE = '127.0.0.1 - - [18/Oct/2026:01:00:00 +0000] "GET /health/ HTTP/1.0" 200 2 "-" "curl/8.0" {}\n'
+
+
+def test_scan_rotated_chunks_of_both_formats(tmp_path, monkeypatch):
+    monkeypatch.setattr(logstats, 'CHUNK_SIZE', 1000)  # several chunks per file
+    base = tmp_path / 'dev.access.log'
+    with gzip.open(str(base) + '.1.gz', 'wt') as ostream:
+        for i in range(50):
+            ostream.write(NGINX_LINE.format(i, 200, '0.011', 'HIT', '0.010'))
+    lines = [NGINX_LINE.format(i, 502, '0.101', 'MISS', '0.050, 0.050') for i in range(50)]
+    lines += [GUNICORN_LINE.format(2000)] * 100 + ['garbage\n']
+    base.write_text(''.join(lines))
+
+    paths = logstats.expand_rotated(str(base))
+    assert paths == [str(base) + '.1.gz', str(base)]
+    stats = logstats.scan(logstats.plan_chunks(paths), jobs=2)
+    summary = logstats.summarize(stats, top=10)
+
+    assert summary['lines'] == 201
+    assert summary['malformed'] == 1
+    users = summary['routes']['/users/{id}/']
+    assert users['requests'] == 100
+    assert users['cache_hit_ratio'] == 0.5
+    assert users['status'] == {'2xx': 0.5, '5xx': 0.5}
+    assert abs(users['p50_ms'] - 11) < 0.2 and abs(users['p99_ms'] - 101) < 1.1
+    assert abs(users['upstream_p99_ms'] - 100) < 1.1
+    assert abs(users['nginx_p50_ms'] - 1) < 0.1
+    health = summary['routes']['/health/']
+    assert health['requests'] == 100 and abs(health['p50_ms'] - 2) < 0.05
+    assert health['upstream_p50_ms'] is None
+
+
+def test_follow_waits_for_missing_access_log(tmp_path, monkeypatch):
+    import threading
+    import servicectl
+    monkeypatch.setattr(logstats, 'GUNICORN_LOG_DIR', str(tmp_path))
+    base = tmp_path / 'webapp.dev.access.log'
+    (tmp_path / 'webapp.dev.access.log.1').write_text(GUNICORN_LINE.format(1000))  # rotated copy only
+    reports = []
+
+    def format_table(summary):
+        reports.append(summary['lines'])
+        if summary['lines'] == 4 and reports.count(4) == 1:
+            raise KeyboardInterrupt  # stop following once appended lines were read
+        return ''
+
+    monkeypatch.setattr(logstats, 'format_table', format_table)
+    timer = threading.Timer(0.3, lambda: base.write_text(GUNICORN_LINE.format(2000) * 3))
+    timer.start()
+    try:
+        servicectl.logstats('webapp', 'dev', (), True, 0.1, 1, 10, False)
+    finally:
+        timer.cancel()
+    assert reports[0] == 1 and reports[-1] == 4
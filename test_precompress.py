@@ -0,0 +1,45 @@
+import os
+import gzip
+
+import precompress
+
+
+def test_compress_tree_keeps_only_worthwhile_siblings(tmp_path):
+    css = tmp_path / 'css' / 'base.0123456789ab.css'
+    css.parent.mkdir()
+    css.write_text('body { margin: 0; padding: 0; }\n' * 100)
+    tiny = tmp_path / 'tiny.js'
+    tiny.write_text('var a = 1;\n')
+    (tmp_path / 'tiny.js.gz').write_bytes(b'stale')
+    noise = tmp_path / 'noise.json'
+    noise.write_bytes(os.urandom(4096))
+    (tmp_path / 'noise.json.gz').write_bytes(b'stale')
+    (tmp_path / 'logo.png').write_bytes(b'\x89PNG' * 1000)
+
+    totals = precompress.compress_tree(str(tmp_path), jobs=2, with_brotli=False)
+
+    assert totals['files'] == 3 and totals['compressed'] == 1
+    assert gzip.decompress((tmp_path / 'css' / 'base.0123456789ab.css.gz').read_bytes()) == css.read_bytes()
+    assert not (tmp_path / 'tiny.js.gz').exists()
+    assert not (tmp_path / 'noise.json.gz').exists()  # incompressible, stale copy removed
+    assert not (tmp_path / 'logo.png.gz').exists()
+    first = (tmp_path / 'css' / 'base.0123456789ab.css.gz').read_bytes()
+
+    totals = precompress.compress_tree(str(tmp_path), jobs=1, with_brotli=False)
+    assert totals['skipped'] == 1  # css is up to date, others are rechecked
+
+    totals = precompress.compress_tree(str(tmp_path), jobs=1, with_brotli=False, force=True)
+    assert (tmp_path / 'css' / 'base.0123456789ab.css.gz').read_bytes() == first  # reproducible
+
+
+def test_compress_tree_makes_brotli_siblings(tmp_path):
+    brotli = precompress.brotli_module()
+    assert brotli is not None, 'brotli package of Pipfile is not installed'
+    js = tmp_path / 'app.0123456789ab.js'
+    js.write_text('function add(a, b) { return a + b; }\n' * 100)
+
+    totals = precompress.compress_tree(str(tmp_path), jobs=1)
+
+    assert totals['brotli'] and totals['brotli_bytes'] > 0
+    assert brotli.decompress((tmp_path / 'app.0123456789ab.js.br').read_bytes()) == js.read_bytes()
+    assert (tmp_path / 'app.0123456789ab.js.br').stat().st_mtime_ns == js.stat().st_mtime_ns
@@ -0,0 +1,441 @@
+import os
+import sys
+import json
+import subprocess
+import threading
+import time
+
+import pytest
+
+import servicectl
+
+HERE = os.path.abspath(os.path.dirname(__file__))
+
+
+class FakeSystemd:
+    """In-process stand-in for systemd backend: records requests, keeps enabled and active units"""
+
+    def __init__(self, unit_dir):
+        self.unit_dir = unit_dir
+        self.calls = []
+        self.active = set()
+        self.main_pids = {}
+
+    def unit_path(self, unit):
+        name, at, rest = unit.partition('@')
+        return os.path.join(self.unit_dir, '{}@{}'.format(name, rest[rest.index('.'):]) if at else unit)
+
+    def daemon_reload(self):
+        self.calls.append(('daemon_reload',))
+
+    def enable(self, units):
+        self.calls.append(('enable', list(units)))
+        for unit in units:
+            wants = os.path.join(self.unit_dir, 'sockets.target.wants' if unit.endswith('.socket') else 'multi-user.target.wants')
+            os.makedirs(wants, exist_ok=True)
+            if not os.path.lexists(os.path.join(wants, unit)):
+                os.symlink(self.unit_path(unit), os.path.join(wants, unit))
+
+    def disable(self, units):
+        self.calls.append(('disable', list(units)))
+        for wants in ('sockets.target.wants', 'multi-user.target.wants'):
+            for unit in units:
+                if os.path.lexists(os.path.join(self.unit_dir, wants, unit)):
+                    os.remove(os.path.join(self.unit_dir, wants, unit))
+
+    def start(self, units, request='start'):
+        self.calls.append((request, list(units)))
+        missing = [unit for unit in units if not os.path.exists(self.unit_path(unit))]
+        if missing:
+            raise servicectl.SystemdError('Unit not found: {}'.format(' '.join(missing)))
+        self.active.update(units)
+
+    def restart(self, units):
+        self.start(units, 'restart')
+
+    def reload(self, units):
+        self.calls.append(('reload', list(units)))
+
+    def stop(self, units):
+        self.calls.append(('stop', list(units)))
+        self.active.difference_update(units)
+
+    def properties(self, unit, *names):
+        active = unit in self.active
+        values = {'ActiveState': 'active' if active else 'inactive', 'SubState': 'running' if active else 'dead',
+                  'MainPID': str(self.main_pids.get(unit, 0) if active else 0)}
+        return {name: values[name] for name in names}
+
+
+def test_run_ordered_respects_dependencies():
+    events = []
+    lock = threading.Lock()
+
+    def func(svc, config):
+        with lock:
+            events.append(('start', svc))
+        time.sleep(0.01)
+        with lock:
+            events.append(('end', svc))
+        return None, None
+
+    items = [('nginxsite', 'dev'), ('webapp', 'dev'), ('nginxmain', 'dev')]
+    __, error = servicectl.run_ordered(items, func, servicectl.SERVICE_DEPENDENCIES, jobs=4)
+    assert error is None
+    assert events.index(('end', 'nginxmain')) < events.index(('start', 'nginxsite'))
+    assert events.index(('start', 'webapp')) < events.index(('end', 'nginxmain'))
+
+
+def test_run_ordered_stops_scheduling_after_error():
+    calls = []
+
+    def func(svc, config):
+        calls.append(svc)
+        return None, 'boom' if svc == 'nginxmain' else None
+
+    items = [('nginxmain', 'dev'), ('nginxsite', 'dev')]
+    __, error = servicectl.run_ordered(items, func, servicectl.SERVICE_DEPENDENCIES, jobs=2)
+    assert error == 'boom'
+    assert calls == ['nginxmain']
+
+
+def test_deploy_files_links_unchanged_and_switches_current(tmp_path):
+    srcdir = tmp_path / 'src'
+    (srcdir / 'static').mkdir(parents=True)
+    (srcdir / 'static' / 'a.css').write_text('a')
+    (srcdir / 'static' / 'b.js').write_text('b')
+    targetroot = tmp_path / 'dst'
+
+    (previous_id, first_id), error = servicectl.deploy_files(str(srcdir), str(targetroot))
+    assert error is None
+    assert previous_id is None
+    assert (targetroot / 'current' / 'static' / 'a.css').read_text() == 'a'
+
+    (srcdir / 'static' / 'b.js').write_text('bb')
+    (previous_id, second_id), error = servicectl.deploy_files(str(srcdir), str(targetroot))
+    assert error is None
+    assert previous_id == first_id != second_id
+    first = targetroot / 'releases' / first_id / 'static'
+    second = targetroot / 'releases' / second_id / 'static'
+    assert (first / 'a.css').stat().st_ino == (second / 'a.css').stat().st_ino
+    assert (second / 'b.js').read_text() == 'bb'
+    assert (first / 'b.js').read_text() == 'b'
+    assert (targetroot / 'current' / 'static' / 'b.js').read_text() == 'bb'
+
+    servicectl.switch_release(str(targetroot), first_id)
+    assert (targetroot / 'current' / 'static' / 'b.js').read_text() == 'b'
+
+    missing = str(tmp_path / 'project_static')
+    for result in (servicectl.plan_release(missing, str(targetroot)), servicectl.deploy_files(missing, str(targetroot))):
+        assert result == (None, 'Source directory not exists: {} (run `make build` first)'.format(missing))
+    assert (targetroot / 'current' / 'static' / 'b.js').read_text() == 'b'
+
+
+def test_nginx_site_serves_static_of_current_webapp_release(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'NGINX_ROOT', str(tmp_path))
+    webapp, __ = servicectl.load_settings('webapp', 'dev')
+
+    batch = servicectl.Batch()
+    assert servicectl.stage_install(batch, 'nginxsite', 'dev') == (None, None)
+    siteconf = (tmp_path / 'sites-available' / 'dev.conf').read_text()
+    assert '  set $project_root {}/current;\n  root $project_root;\n'.format(webapp['targetroot']) in siteconf
+    assert 'root $project_root;' in (tmp_path / 'includes' / 'dev' / 'static.conf').read_text()
+
+
+START_PROBE = """
+import sys, json
+import servicectl
+servicectl.load_settings('webapp', 'dev')
+heavy = ['click', 'jinja2', 'ruamel.yaml', 'http.client', 'concurrent.futures']
+print(json.dumps([m for m in heavy if m in sys.modules]))
+"""
+
+
+def test_start_cold_import_skips_heavy_modules(tmp_path):
+    # timing of the same path is measured by benchmarks/bench_startup.py
+    env = dict(os.environ, SERVICE_CACHE_DIR=str(tmp_path))
+    command = [sys.executable, '-c', START_PROBE]
+    subprocess.run(command, cwd=HERE, env=env, check=True, stdout=subprocess.PIPE)  # warm descriptor cache
+    assert json.loads(subprocess.run(command, cwd=HERE, env=env, check=True, stdout=subprocess.PIPE).stdout) == []
+
+
+def test_descriptor_cache_written_by_others_is_ignored(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'CACHE_DIR', str(tmp_path / 'cache'))
+    monkeypatch.setattr(servicectl, '_descriptors', {})
+    filepath = os.path.join(HERE, 'services', 'webapp.yaml')
+    descriptor = servicectl.load_descriptor(filepath)
+    cachepath, = (tmp_path / 'cache' / 'descriptors').iterdir()
+    entry = json.loads(cachepath.read_text())
+    assert entry['descriptor'] == descriptor
+
+    entry['descriptor']['configs']['dev']['run'] = 'touch /tmp/owned'
+    cachepath.write_text(json.dumps(entry))
+    monkeypatch.setattr(servicectl, '_descriptors', {})
+    assert servicectl.load_descriptor(filepath)['configs']['dev']['run'] == 'touch /tmp/owned'  # own entry is trusted
+    cachepath.chmod(0o666)
+    monkeypatch.setattr(servicectl, '_descriptors', {})
+    assert servicectl.load_descriptor(filepath) == descriptor
+
+
+def test_restore_files_rewrites_only_changed_entries(tmp_path):
+    (tmp_path / 'sites-available').mkdir()
+    (tmp_path / 'sites-enabled').mkdir()
+    (tmp_path / 'includes' / 'dev').mkdir(parents=True)
+    (tmp_path / 'sites-available' / 'dev.conf').write_text('site')
+    (tmp_path / 'sites-enabled' / 'dev.conf').symlink_to(tmp_path / 'sites-available' / 'dev.conf')
+    (tmp_path / 'includes' / 'dev' / 'static.conf').write_text('static')
+    (tmp_path / 'includes' / 'dev' / 'keep.conf').write_text('keep')
+    relpaths = servicectl.nginx_site_paths('dev')
+    snapshot = servicectl.snapshot_files(str(tmp_path), relpaths)
+    keep_inode = (tmp_path / 'includes' / 'dev' / 'keep.conf').stat().st_ino
+
+    (tmp_path / 'includes' / 'dev' / 'static.conf').write_text('changed')
+    (tmp_path / 'includes' / 'dev' / 'extra.conf').write_text('extra')
+    (tmp_path / 'sites-enabled' / 'dev.conf').unlink()
+    (tmp_path / 'certs' / 'dev').mkdir(parents=True)
+
+    servicectl.restore_files(str(tmp_path), relpaths, snapshot)
+    assert servicectl.snapshot_files(str(tmp_path), relpaths) == snapshot
+    assert (tmp_path / 'includes' / 'dev' / 'keep.conf').stat().st_ino == keep_inode
+    assert not (tmp_path / 'certs' / 'dev').exists()
+
+
+def test_taskworker_units_per_queue(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'missing_celery_packages', lambda settings: [])
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    monkeypatch.setattr(servicectl, 'host_resources', lambda: (8, 16 * 1024 * 1024))
+    (tmp_path / 'example.taskworker.dev.removed.service').write_text('stale')
+    settings, error = servicectl.load_settings('taskworker', 'dev')
+    assert error is None
+    settings['queues'] = {'cpu': None, 'reports': {'max_memory_per_child': 4 * 1024 * 1024}, 'io': {'pool': 'threads'}}
+
+    batch = servicectl.Batch()
+    servicectl.stage_celery_install(batch, 'taskworker', 'dev', settings)
+    assert batch.disable == ['example.taskworker.dev.removed.service']
+    assert sorted(batch.enable) == [
+        'example.taskworker.dev.cpu.service', 'example.taskworker.dev.io.service', 'example.taskworker.dev.reports.service']
+    cpu_unit = (tmp_path / 'example.taskworker.dev.cpu.service').read_text()
+    assert '--queues cpu --pool prefork --concurrency 4 ' in cpu_unit  # CPUs shared by two prefork queues
+    assert 'taskworker.dev.cpu.log' in cpu_unit
+    assert '--concurrency 1 ' in (tmp_path / 'example.taskworker.dev.reports.service').read_text()  # 80% of 16G / 2 queues / 4G
+    assert '--pool threads --concurrency 32 ' in (tmp_path / 'example.taskworker.dev.io.service').read_text()
+
+
+def test_celery_services_refused_without_celery(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    monkeypatch.setattr(servicectl.sys, 'executable', str(tmp_path / 'venv' / 'bin' / 'python'))  # without celery next to it
+    batch = servicectl.Batch()
+    __, error = servicectl.stage_install(batch, 'taskplanner', 'dev')
+    assert 'needs package(s) not installed' in error and ': celery' in error
+    assert batch.changes == [] and not os.listdir(str(tmp_path))
+
+
+def test_unchanged_install_skips_reloads(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'missing_celery_packages', lambda settings: [])
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    monkeypatch.setattr(servicectl, 'NGINX_ROOT', str(tmp_path / 'nginx'))
+    unit = 'example.taskplanner.dev.service'
+
+    batch = servicectl.Batch()
+    assert servicectl.stage_install(batch, 'taskplanner', 'dev') == (None, None)
+    assert batch.systemd_changed and batch.enable == [unit]
+    (tmp_path / 'multi-user.target.wants').mkdir()
+    (tmp_path / 'multi-user.target.wants' / unit).symlink_to(tmp_path / unit)
+
+    batch = servicectl.Batch()
+    assert servicectl.stage_install(batch, 'taskplanner', 'dev') == (None, None)
+    assert (batch.systemd_changed, batch.enable, batch.changes) == (False, [], [])
+
+    batch = servicectl.Batch(dry_run=True)
+    assert servicectl.stage_install(batch, 'nginxsite', 'dev') == (None, None)
+    assert not (tmp_path / 'nginx').exists()
+    assert batch.nginx_changed
+    plan = servicectl.format_plan(batch)
+    assert '+ {}/nginx/sites-available/dev.conf (none -> '.format(tmp_path) in plan
+    assert '+<secret, sha256 ' in plan and 'PRIVATE KEY' not in plan
+    assert plan.endswith('Actions: nginx -t && nginx -s reload')
+
+
+def test_session_ticket_keys_created_once_and_rotated(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'NGINX_ROOT', str(tmp_path))
+    reloads = []
+    monkeypatch.setattr(servicectl, 'test_nginx_config', lambda: None)
+    monkeypatch.setattr(servicectl, 'reload_nginx_config', lambda: reloads.append(True))
+    settings, __ = servicectl.load_settings('nginxsite', 'dev')
+    paths = servicectl.ticket_key_paths('dev', settings['tls']['ticket_keys'])
+
+    batch = servicectl.Batch()
+    assert servicectl.stage_ticket_keys(batch, 'dev', settings)
+    keys = [open(path, 'rb').read() for path in paths]
+    assert [len(key) for key in keys] == [80] * len(paths) and len(set(keys)) == len(paths)
+    assert all(os.stat(path).st_mode & 0o777 == 0o600 for path in paths)
+    assert not servicectl.stage_ticket_keys(servicectl.Batch(), 'dev', settings)  # reinstall keeps keys
+
+    assert servicectl.rotate_ticket_keys('dev') == (len(paths), None)
+    rotated = [open(path, 'rb').read() for path in paths]
+    assert rotated[1:] == keys[:-1] and rotated[0] not in keys
+    assert reloads == [True]
+
+
+def test_batch_applied_by_few_systemd_requests(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'missing_celery_packages', lambda settings: [])
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    monkeypatch.setattr(servicectl, 'host_resources', lambda: (4, 8 * 1024 * 1024))
+    monkeypatch.setitem(servicectl.READINESS_DEFAULTS, 'settle', 0.0)
+    fake = FakeSystemd(str(tmp_path))
+    monkeypatch.setattr(servicectl, '_systemd', fake)
+
+    items = [('taskworker', 'dev'), ('taskplanner', 'dev')]
+    assert servicectl.run_batch(items, servicectl.stage_install, servicectl.SERVICE_DEPENDENCIES, jobs=2) == (None, None)
+    units = ['example.taskplanner.dev.service', 'example.taskworker.dev.default.service', 'example.taskworker.dev.io.service']
+    assert [call[0] for call in fake.calls] == ['daemon_reload', 'enable']
+    assert sorted(fake.calls[1][1]) == units
+
+    fake.calls = []
+    servicectl.start('taskworker', 'dev')
+    assert fake.calls == [('restart', [units[1]]), ('restart', [units[2]])]
+    fake.calls = []
+    servicectl.stop('taskworker', 'dev')
+    assert fake.calls == [('stop', units[1:])]
+    assert fake.active == set()
+
+    fake.calls = []
+    assert servicectl.run_batch(items, servicectl.stage_install, servicectl.SERVICE_DEPENDENCIES, jobs=2) == (None, None)
+    assert fake.calls == []
+
+
+def test_hung_health_probe_retried_until_deadline(tmp_path, monkeypatch):
+    import socket
+    socket_path = os.path.join(str(tmp_path), 'probe.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(8)
+    accepted = []
+
+    def serve():
+        hung, __ = server.accept()  # starting service accepts first connection but does not answer it
+        accepted.append(hung)
+        conn, __ = server.accept()
+        with conn:
+            conn.recv(1024)
+            conn.sendall(b'HTTP/1.0 200 OK\r\n\r\n')
+
+    thread = threading.Thread(target=serve, daemon=True)
+    thread.start()
+    monkeypatch.setattr(servicectl, 'systemd_state', lambda name: ('active', 'running'))
+    readiness = dict(servicectl.READINESS_DEFAULTS, deadline=10.0, probe_timeout=0.2, socket_path=socket_path, http_path='/health/')
+    try:
+        elapsed, error = servicectl.wait_until_ready('example.webapp.dev.service', readiness)
+    finally:
+        thread.join(1.0)
+        server.close()
+        for conn in accepted:
+            conn.close()
+    assert error is None and len(accepted) == 1
+    assert elapsed < 2.0  # not the whole deadline spent on the first probe
+
+
+def test_resource_directives_checked_against_host():
+    host = dict(cpus=[0, 1, 2, 3], memory_kib=8 * 1024 * 1024, nr_open=1048576)
+    assert servicectl.resource_directives({
+        'CPUQuota': 1.5, 'CPUWeight': 1000, 'AllowedCPUs': '0,1,2', 'MemoryHigh': '50%', 'MemoryMax': '6G',
+        'LimitNOFILE': '65536:1000000', 'Nice': -5}, **host) == [
+        'CPUQuota=150%', 'CPUWeight=1000', 'AllowedCPUs=0-2', 'MemoryHigh=4194304K', 'MemoryMax=6291456K',
+        'LimitNOFILE=65536:1000000', 'Nice=-5']
+    for resources in ({'CPUQuota': '500%'}, {'AllowedCPUs': '2-5'}, {'MemoryMax': '16G'}, {'IOWeight': 0},
+                      {'MemoryHigh': '2G', 'MemoryMax': '1G'}, {'LimitNOFILE': 2000000}, {'Nice': 20}, {'CPUShares': 10}):
+        with pytest.raises(Exception):
+            servicectl.resource_directives(resources, **host)
+    assert servicectl.budget_resources({'AllowedCPUs': '0-5', 'CPUQuota': '250%', 'MemoryHigh': '1G'}, 8, 16 * 1024 * 1024) == (3, 1024 * 1024)
+
+
+def test_webapp_instances_scale_out_and_in(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    monkeypatch.setattr(servicectl, 'numa_nodes', lambda: {0: [0, 1, 2, 3], 1: [4, 5, 6, 7]})
+    monkeypatch.setattr(os, 'sched_getaffinity', lambda pid: set(range(8)))
+    (tmp_path / 'multi-user.target.wants').mkdir()
+    settings, error = servicectl.load_settings('webapp', 'dev')
+    assert error is None
+    settings.update(instances=4, cpu_affinity='auto', GUNICORN_CMD='gunicorn', GUNICORN_CONFIG_PATH='gunicorn_config.py', GUNICORN_ENV={})
+
+    batch = servicectl.Batch()
+    servicectl.stage_webapp_units(batch, 'webapp', 'dev', settings)
+    assert batch.enable == ['example.webapp.dev@{}.socket'.format(i) for i in range(1, 5)] + ['example.webapp.dev@{}.service'.format(i) for i in range(1, 5)]
+    unit = (tmp_path / 'example.webapp.dev@.service').read_text()
+    assert 'Requires=example.webapp.dev@%i.socket' in unit
+    assert '--bind unix:/run/example.webapp.dev@%i.socket' in unit
+    assert 'Environment=METRICS_DIR=/run/example.webapp.dev/%i/metrics' in unit
+    assert (tmp_path / 'example.webapp.dev@4.service.d' / 'cpus.conf').read_text() == '[Service]\nCPUAffinity=6-7\nNUMAPolicy=bind\nNUMAMask=1\n'
+
+    for instance in range(1, 5):
+        (tmp_path / 'multi-user.target.wants' / 'example.webapp.dev@{}.service'.format(instance)).write_text('')
+    settings.update(instances=2, cpu_affinity=['0-2', '3'])
+    batch = servicectl.Batch()
+    servicectl.stage_webapp_units(batch, 'webapp', 'dev', settings)
+    assert batch.disable == ['example.webapp.dev@3.service', 'example.webapp.dev@4.service', 'example.webapp.dev@3.socket', 'example.webapp.dev@4.socket']
+    assert batch.remove == []
+    assert (tmp_path / 'example.webapp.dev@2.service.d' / 'cpus.conf').read_text() == '[Service]\nCPUAffinity=3\n'
+    assert not (tmp_path / 'example.webapp.dev@4.service.d' / 'cpus.conf').exists()
+    assert servicectl.derive_systemd_units('webapp', 'dev')[:2] == ['example.webapp.dev@1.service', 'example.webapp.dev@1.socket']
+
+
+def test_webapp_unit_reloadable_by_new_master(tmp_path, monkeypatch):
+    monkeypatch.setattr(servicectl, 'systemd_service_path', lambda name: os.path.join(str(tmp_path), name))
+    settings, error = servicectl.load_settings('webapp', 'dev')
+    assert error is None
+    settings.update(GUNICORN_CMD='gunicorn', GUNICORN_CONFIG_PATH='gunicorn_config.py', GUNICORN_ENV={})
+
+    servicectl.stage_webapp_units(servicectl.Batch(), 'webapp', 'dev', settings)
+    lines = (tmp_path / 'example.webapp.dev.service').read_text().splitlines()
+    assert 'Requires=example.webapp.dev.socket' in lines and 'After=example.webapp.dev.socket' in lines
+    assert 'ExecReload=/bin/kill -s HUP $MAINPID' in lines
+    assert 'NotifyAccess=all' in lines  # MAINPID notification sent on behalf of new master
+    assert 'RuntimeDirectory=example.webapp.dev' in lines
+    assert 'Environment=GUNICORN_PIDFILE={}'.format(servicectl.gunicorn_pidfile('webapp', 'dev')) in lines
+
+
+@pytest.mark.parametrize('new_master_ready', [True, False])
+def test_graceful_reload_switches_to_ready_master_only(tmp_path, monkeypatch, new_master_ready):
+    import signal
+    service = 'example.webapp.dev.service'
+    old_pid, new_pid, new_worker = 1001, 2002, 2003
+    pidfile = tmp_path / 'gunicorn.pid'
+    fake = FakeSystemd(str(tmp_path))
+    fake.active.add(service)
+    fake.main_pids[service] = old_pid
+    monkeypatch.setattr(servicectl, '_systemd', fake)
+    alive = {old_pid, old_pid + 1}
+    signals = []
+    notified = []
+
+    def kill(pid, signum):
+        signals.append((pid, signum))
+        if signum == signal.SIGUSR2:  # gunicorn re-executes master, which writes own pidfile
+            alive.update((new_pid, new_worker))
+            (tmp_path / 'gunicorn.pid.2').write_text('{}\n'.format(new_pid))
+        elif signum == signal.SIGTERM:
+            alive.discard(pid)
+
+    def probe_response(socket_path, http_path, timeout):
+        # until new workers are ready only old ones answer
+        return 200, {'x-worker-pid': str(new_worker if new_master_ready else old_pid + 1)}
+
+    monkeypatch.setattr(servicectl.os, 'kill', kill)
+    monkeypatch.setattr(servicectl, 'pid_exists', lambda pid: pid in alive)
+    monkeypatch.setattr(servicectl, 'child_pids', lambda pid: [new_worker] if pid == new_pid else [old_pid + 1])
+    monkeypatch.setattr(servicectl, 'probe_response', probe_response)
+    monkeypatch.setattr(servicectl, 'notify_main_pid', notified.append)
+    readiness = dict(servicectl.READINESS_DEFAULTS, deadline=0.3, initial_delay=0.01, max_delay=0.05,
+                     http_path='/health/', socket_path='/run/example.webapp.dev.socket', pidfile=str(pidfile))
+
+    elapsed, error = servicectl.systemd_graceful_reload(service, readiness)
+    if new_master_ready:
+        assert error is None and elapsed < 0.3
+        assert notified == [new_pid]
+        assert signals == [(old_pid, signal.SIGUSR2), (old_pid, signal.SIGTERM)]
+        assert new_pid in alive and old_pid not in alive
+    else:
+        assert error == 'New master not ready within 0.3 second(s), old one keeps serving: {}'.format(service)
+        assert notified == []
+        assert signals == [(old_pid, signal.SIGUSR2), (new_pid, signal.SIGTERM)]
+        assert old_pid in alive and new_pid not in alive